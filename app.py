@@ -1,18 +1,37 @@
 # =============================================
 # IMPORTS
 # =============================================
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, flash, current_app, make_response
+from flask import Flask, Request, render_template, request, redirect, url_for, send_file, session, flash, current_app, make_response, stream_with_context, has_request_context
 from datetime import datetime, timedelta
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
 import sqlite3
 import uuid
 import copy
 import os
+import csv
 import json
 import secrets
 import io
 import PyPDF2
 import base64
-from werkzeug.utils import secure_filename
+import hashlib
+import zlib
+import mimetypes
+import re
+import shutil
+import zipfile
+import time
+import random
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from flask.cli import AppGroup
+import click
 from pathlib import Path
 
 # =============================================
@@ -35,10 +54,39 @@ try:
 except ImportError:
     WEASYPRINT_AVAILABLE = False
 
+try:
+    import pikepdf
+    PIKEPDF_AVAILABLE = True
+except ImportError:
+    PIKEPDF_AVAILABLE = False
+
+try:
+    import pymupdf
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    PYMUPDF_AVAILABLE = False
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 # =============================================
 # INIZIALIZZAZIONE APP
 # =============================================
+class RichiestaDuvri(Request):
+    """Richiesta Flask con un limite di dimensione più alto per l'importazione"""
+
+    @property
+    def max_content_length(self):
+        # Il file di importazione può contenere gli allegati: vale il limite degli upload a blocchi
+        if self.endpoint == 'importa':
+            return current_app.config['UPLOAD_DIMENSIONE_MAX_MB'] * 1024 * 1024
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = RichiestaDuvri
 app.secret_key = os.environ.get('SECRET_KEY', 'fallback-development-key')
 
 # Aggiungi dopo la secret key
@@ -47,9 +95,72 @@ app.config.update(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
     PERMANENT_SESSION_LIFETIME=timedelta(hours=24),
-    MAX_CONTENT_LENGTH=16 * 1024 * 1024  # 16MB max upload
+    MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB max upload
+    # Accoda al DUVRI generato i paragrafi 3.3.x della parte statica applicabili
+    ALLEGA_PARAGRAFI_RISCHI=os.environ.get('ALLEGA_PARAGRAFI_RISCHI', '1') == '1',
+    # In produzione i template non vengono ricontrollati su disco ad ogni render
+    TEMPLATES_AUTO_RELOAD=os.environ.get('FLASK_ENV') != 'production',
+    # Le sezioni statiche di pdf_template.html sono renderizzate una volta per versione
+    CACHE_FRAMMENTI_PDF=os.environ.get('CACHE_FRAMMENTI_PDF', '1') == '1',
+    # I capitoli statici sono convertiti in PDF una volta per versione e uniti alle parti dinamiche
+    PDF_CAPITOLI_STATICI=os.environ.get('PDF_CAPITOLI_STATICI', '1') == '1',
+    # Salvataggio HTML di debug in output/: sempre (flag) o a campione (0.0 - 1.0)
+    PDF_DEBUG_HTML=os.environ.get('PDF_DEBUG_HTML') == '1',
+    PDF_DEBUG_CAMPIONAMENTO=float(os.environ.get('PDF_DEBUG_CAMPIONAMENTO') or 0),
+    # Spazio massimo per i PDF generati in output/artefatti (0 = illimitato)
+    ARTEFATTI_BUDGET_MB=int(os.environ.get('ARTEFATTI_BUDGET_MB', '500')),
+    # Genera in background il PDF per firma quando il DUVRI diventa completo
+    PRERENDER_PER_FIRMA=os.environ.get('PRERENDER_PER_FIRMA', '1') == '1',
+    # PDF identici byte per byte a parità di input (date dal DUVRI, /ID dall'impronta)
+    PDF_RIPRODUCIBILE=os.environ.get('PDF_RIPRODUCIBILE', '1') == '1',
+    # Ottimizzazione senza perdita dei PDF uniti (richiede pikepdf); i firmati non vengono mai toccati
+    PDF_OTTIMIZZAZIONE=os.environ.get('PDF_OTTIMIZZAZIONE', '1') == '1',
+    # Riduzione delle immagini scansionate oltre questa risoluzione (0 = disattivata)
+    PDF_OTTIMIZZAZIONE_DPI=int(os.environ.get('PDF_OTTIMIZZAZIONE_DPI') or 0),
+    # Upload a blocchi: dimensione massima del file e di ogni blocco (indipendenti da MAX_CONTENT_LENGTH)
+    UPLOAD_DIMENSIONE_MAX_MB=int(os.environ.get('UPLOAD_DIMENSIONE_MAX_MB', '200')),
+    UPLOAD_BLOCCO_MB=int(os.environ.get('UPLOAD_BLOCCO_MB', '4')),
+    # Miniature della prima pagina degli allegati, generate in background (PDF richiede PyMuPDF)
+    MINIATURE_ALLEGATI=os.environ.get('MINIATURE_ALLEGATI', '1') == '1',
+    MINIATURE_WORKERS=int(os.environ.get('MINIATURE_WORKERS', '2')),
+    # Processi per la conversione in parallelo dei documenti del workflow extra-costi
+    DOCUMENTI_WORKERS=int(os.environ.get('DOCUMENTI_WORKERS', '2')),
+    # Storico revisioni: un'istantanea completa ogni N revisioni, differenze JSON nelle altre
+    REVISIONI_CHECKPOINT=int(os.environ.get('REVISIONI_CHECKPOINT', '20')),
+    # Scrive anche il file .txt dei metadati accanto a ogni firma (le firme sono nella tabella firme_digitali)
+    FIRME_ESPORTA_TXT=os.environ.get('FIRME_ESPORTA_TXT') == '1',
+    # Backup online di database e file caricati: cartella, worker orario e retention degli snapshot
+    BACKUP_FOLDER=os.environ.get('BACKUP_FOLDER') or os.path.join(BASE_DIR, 'backup'),
+    BACKUP_AUTOMATICO=os.environ.get('BACKUP_AUTOMATICO') == '1',
+    BACKUP_ORARI=int(os.environ.get('BACKUP_ORARI', '24')),
+    BACKUP_GIORNALIERI=int(os.environ.get('BACKUP_GIORNALIERI', '30')),
+    BACKUP_PAGINE_PER_PASSO=int(os.environ.get('BACKUP_PAGINE_PER_PASSO', '256')),
+    BACKUP_RIAVVII_MAX=int(os.environ.get('BACKUP_RIAVVII_MAX', '20')),
+    # Archivio dei DUVRI chiusi: database collegato, cartella dei file e giorni dall'ultima modifica (0 = mai)
+    ARCHIVIO_DB=os.environ.get('ARCHIVIO_DB') or os.path.join(BASE_DIR, 'duvri_archivio.db'),
+    ARCHIVIO_BLOB_FOLDER=os.environ.get('ARCHIVIO_BLOB_FOLDER') or os.path.join(BASE_DIR, 'archivio', 'blob'),
+    ARCHIVIO_GIORNI=int(os.environ.get('ARCHIVIO_GIORNI', '365')),
+    # I DUVRI eliminati vengono cancellati definitivamente (righe e file) dopo queste ore
+    PURGA_DOPO_ORE=int(os.environ.get('PURGA_DOPO_ORE', '24')),
+    # Worker di manutenzione (purga ed archiviazione) e intervallo tra due passaggi
+    MANUTENZIONE_AUTOMATICA=os.environ.get('MANUTENZIONE_AUTOMATICA', '1') == '1',
+    MANUTENZIONE_INTERVALLO_MINUTI=int(os.environ.get('MANUTENZIONE_INTERVALLO_MINUTI', '60')),
+    # Trasferimento dei file delegato al web server: '' (nessuno), 'x-sendfile' o 'x-accel'
+    DOWNLOAD_OFFLOAD=os.environ.get('DOWNLOAD_OFFLOAD', ''),
+    # Location interna nginx che mappa la cartella dell'app (solo per 'x-accel')
+    DOWNLOAD_ACCEL_PREFISSO=os.environ.get('DOWNLOAD_ACCEL_PREFISSO', '/_protetto/')
 )
 
+# ReportLab (motore di xhtml2pdf) senza date e identificativi casuali nel PDF
+if XHTML2PDF_AVAILABLE and app.config['PDF_RIPRODUCIBILE']:
+    from reportlab import rl_config
+    rl_config.invariant = 1
+
+# Bytecode dei template Jinja compilato una volta e riusato tra i processi
+JINJA_CACHE_FOLDER = os.path.join(BASE_DIR, 'cache', 'jinja')
+os.makedirs(JINJA_CACHE_FOLDER, exist_ok=True)
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(JINJA_CACHE_FOLDER)}
+
 # =============================================
 # CONFIGURAZIONE UPLOAD DUVRI ESTAR
 # =============================================
@@ -67,20 +178,41 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def salva_duvri_estar(file, duvri_id):
-    """Salva il file DUVRI ESTAR e restituisce il nome file"""
+    """Salva il file DUVRI ESTAR nello store per contenuto e restituisce (nome file, sha256)"""
     if file and allowed_file(file.filename):
         # Nome file sicuro
         filename = secure_filename(file.filename)
         # Aggiungi prefisso DUVRI ID per evitare conflitti
         safe_filename = f"{duvri_id}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER_DUVRI_ESTAR'], safe_filename)
-        
+
         # Salva file
-        file.save(filepath)
-        print(f"✅ DUVRI ESTAR salvato: {safe_filename}")
-        
-        return safe_filename
-    return None
+        tmp_path = percorso_temporaneo_upload()
+        file.save(tmp_path)
+        blob = archivia_upload(tmp_path)
+        print(f"✅ DUVRI ESTAR salvato: {safe_filename} ({blob['sha256'][:12]})")
+
+        return safe_filename, blob['sha256']
+    return None, None
+
+def percorso_duvri_estar(filename, sha256):
+    """Percorso del DUVRI ESTAR: blob per contenuto o, se caricato prima dello store, cartella ESTAR"""
+    if sha256:
+        return percorso_blob_upload(sha256)
+    return os.path.join(app.config['UPLOAD_FOLDER_DUVRI_ESTAR'], filename)
+
+def get_duvri_estar(duvri_id):
+    """DUVRI ESTAR collegato al DUVRI come dict (filename, sha256, path), None se assente"""
+    conn = get_db_connection()
+    duvri = conn.execute('SELECT duvri_estar_filename, duvri_estar_sha256 FROM duvri WHERE id = ?',
+                         (duvri_id,)).fetchone()
+    conn.close()
+    if not duvri or not duvri['duvri_estar_filename']:
+        return None
+    return {
+        'filename': duvri['duvri_estar_filename'],
+        'sha256': duvri['duvri_estar_sha256'],
+        'path': percorso_duvri_estar(duvri['duvri_estar_filename'], duvri['duvri_estar_sha256'])
+    }
 
 # =============================================
 # PERCORSI ASSOLUTI (PythonAnywhere compatibili)
@@ -192,10 +324,11 @@ def safe_float(value, default=0.0):
 # FUNZIONI DATABASE SQLite
 # =============================================
 def get_db_connection():
-    """Crea connessione al database SQLite"""
+    """Crea connessione al database SQLite (con il database di archivio collegato come schema archivio)"""
     db_path = os.path.join(BASE_DIR, 'duvri.db')
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
+    conn.execute('ATTACH DATABASE ? AS archivio', (app.config['ARCHIVIO_DB'],))
     return conn
 
 
@@ -245,7 +378,11 @@ def init_db():
         ("importo_gara_base", "REAL"),
         ("costi_inclusi_gara", "INTEGER DEFAULT 0"),
         ("costi_sicurezza_gara", "REAL"),
-        ("duvri_estar_filename", "TEXT")
+        ("duvri_estar_filename", "TEXT"),
+        ("duvri_estar_sha256", "TEXT"),
+        ("committente_da", "TEXT"),
+        ("appaltatore_da", "TEXT"),
+        ("eliminato_il", "TIMESTAMP")
     ]
     
     for colonna, tipo in colonne_da_aggiungere:
@@ -332,19 +469,152 @@ def init_db():
                 print(f"⚠️ Errore ALTER TABLE extra_costi_sicurezza {colonna}: {e}")
         except Exception as e:
             print(f"⚠️ Errore generico {colonna}: {e}")
-    
+
+    # 🆕 Registro allegati (compilato una sola volta all'upload)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS allegati (
+            id TEXT PRIMARY KEY,
+            duvri_id TEXT REFERENCES duvri(id),
+            nome_originale TEXT,
+            path TEXT,
+            dimensione INTEGER,
+            sha256 TEXT,
+            mime_type TEXT,
+            num_pagine INTEGER,
+            preflight TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_allegati_duvri ON allegati(duvri_id)')
+    conn.commit()
+    print("✅ Tabella allegati verificata")
+
+    # 🆕 Registro artefatti generati (blob per contenuto in output/artefatti)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS artefatti (
+            id TEXT PRIMARY KEY,
+            duvri_id TEXT REFERENCES duvri(id),
+            tipo TEXT,
+            hash_input TEXT,
+            motore TEXT,
+            dimensione INTEGER,
+            sha256 TEXT,
+            path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_access TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_artefatti_chiave ON artefatti(duvri_id, tipo, hash_input)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_artefatti_lru ON artefatti(last_access)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_artefatti_sha ON artefatti(sha256)')
+    conn.commit()
+    print("✅ Tabella artefatti verificata")
+
+    # 🆕 Upload a blocchi in corso (riprendibili dall'ultimo offset confermato)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessioni (
+            id TEXT PRIMARY KEY,
+            duvri_id TEXT REFERENCES duvri(id),
+            destinazione TEXT,
+            nome_originale TEXT,
+            dimensione INTEGER,
+            ricevuti INTEGER DEFAULT 0,
+            sha256_atteso TEXT,
+            parametri TEXT,
+            tmp_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    print("✅ Tabella upload_sessioni verificata")
+
+    # 🆕 Blob dei file caricati con conteggio dei riferimenti (uploads/blob)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blob_upload (
+            sha256 TEXT PRIMARY KEY,
+            dimensione INTEGER,
+            riferimenti INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    print("✅ Tabella blob_upload verificata")
+
+    # 🆕 Registro firme digitali (una riga per ogni PDF firmato caricato)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS firme_digitali (
+            id TEXT PRIMARY KEY,
+            duvri_id TEXT REFERENCES duvri(id),
+            ruolo TEXT,
+            firmatario TEXT,
+            data_firma TEXT,
+            nome_file TEXT,
+            sha256 TEXT,
+            path TEXT,
+            dimensione INTEGER,
+            origine TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_firme_duvri ON firme_digitali(duvri_id, ruolo, data_firma)')
+    try:
+        # Revisione dei dati al momento della firma (storico revisioni)
+        c.execute('ALTER TABLE firme_digitali ADD COLUMN revisione INTEGER')
+    except sqlite3.OperationalError:
+        pass
+    conn.commit()
+    print("✅ Tabella firme_digitali verificata")
+
+    # 🆕 Storico revisioni dei dati DUVRI (istantanee e differenze compresse)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revisioni_duvri (
+            duvri_id TEXT REFERENCES duvri(id),
+            numero INTEGER,
+            istantanea INTEGER DEFAULT 0,
+            dati BLOB,
+            dimensione INTEGER,
+            dimensione_completa INTEGER,
+            origine TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (duvri_id, numero)
+        )
+    ''')
+    conn.commit()
+    print("✅ Tabella revisioni_duvri verificata")
+
+    # 🆕 Vista duvri_completi e trigger delle sezioni condivise tra DUVRI duplicati
+    crea_copia_su_scrittura(conn)
+    print("✅ Vista duvri_completi verificata")
+
+    # 🆕 Indice di ricerca full-text (DUVRI e testo dei PDF caricati)
+    crea_indice_ricerca(conn)
+    print(f"✅ Indice ricerca verificato{'' if FTS5_AVAILABLE else ' (FTS5 non disponibile: ricerca disattivata)'}")
+
+    # 🆕 Database di archivio dei DUVRI chiusi (stesse tabelle, collegato a ogni connessione)
+    crea_archivio(conn)
+    print("✅ Archivio DUVRI verificato")
+
     conn.close()
+
+    # Registra gli allegati e le firme già presenti su disco prima dell'introduzione delle tabelle
+    importa_allegati_da_disco()
+    importa_firme_da_disco()
+    registra_revisioni_mancanti()
+    pianifica_testi_mancanti()
     print("✅ Database inizializzato")
 def get_current_duvri_data():
     """Ottiene i dati del DUVRI corrente"""
-    duvri_id = session.get('current_duvri_id')
+    return get_duvri_data(session.get('current_duvri_id'))
 
+def get_duvri_data(duvri_id):
+    """Ottiene i dati di un DUVRI dal database (utilizzabile anche fuori da una richiesta)"""
     if not duvri_id:
         return {"committente": {}, "appaltatore": {}, "signatures": {}}
 
     try:
         conn = get_db_connection()
-        duvri = conn.execute('SELECT * FROM duvri WHERE id = ?', (duvri_id,)).fetchone()
+        duvri = conn.execute('SELECT * FROM duvri_completi WHERE id = ?', (duvri_id,)).fetchone()
         conn.close()
 
         if not duvri:
@@ -393,6 +663,7 @@ def save_current_duvri_data(data):
         conn.commit()
         conn.close()
 
+        registra_revisione(duvri_id)
         sync_db_to_memory(duvri_id)
         return True
 
@@ -432,6 +703,7 @@ def save_current_duvri_data(data):
         conn.commit()
         conn.close()
 
+        registra_revisione(duvri_id)
         sync_db_to_memory(duvri_id)
         return True
 
@@ -443,7 +715,7 @@ def sync_db_to_memory(duvri_id):
     """Sincronizza i dati dal database alla memoria"""
     try:
         conn = get_db_connection()
-        duvri_db = conn.execute('SELECT * FROM duvri WHERE id = ?', (duvri_id,)).fetchone()
+        duvri_db = conn.execute('SELECT * FROM duvri_completi WHERE id = ?', (duvri_id,)).fetchone()
         conn.close()
 
         if not duvri_db:
@@ -466,11 +738,18 @@ def sync_all_duvri_from_db():
     """Sincronizza TUTTI i DUVRI dal database alla memoria"""
     try:
         conn = get_db_connection()
-        duvri_from_db = conn.execute('SELECT * FROM duvri').fetchall()
+        duvri_from_db = conn.execute('SELECT * FROM duvri_completi').fetchall()
+        ritirati = conn.execute(
+            'SELECT id FROM duvri WHERE eliminato_il IS NOT NULL UNION SELECT id FROM archivio.duvri'
+        ).fetchall() if duvri_list else []
         conn.close()
 
         print(f"📊 Trovati {len(duvri_from_db)} DUVRI nel database")
 
+        # DUVRI eliminati o archiviati (anche da un altro processo) escono dalla memoria
+        for riga in ritirati:
+            duvri_list.pop(riga['id'], None)
+
         for duvri_db in duvri_from_db:
             duvri_id = duvri_db['id']
             if duvri_id not in duvri_list:
@@ -495,7 +774,7 @@ def load_all_duvri_from_db():
     """Carica tutti i DUVRI dal database alla memoria all'avvio"""
     try:
         conn = get_db_connection()
-        duvri_from_db = conn.execute('SELECT * FROM duvri').fetchall()
+        duvri_from_db = conn.execute('SELECT * FROM duvri_completi').fetchall()
         conn.close()
 
         print(f"📊 Caricamento DUVRI dal database: {len(duvri_from_db)} trovati")
@@ -612,7 +891,7 @@ def prepara_dati_per_pdf(duvri_id, data):
     # Solo se DUVRI completato con appaltatore
     if data.get('appaltatore') and data.get('appaltatore').get('max_addetti'):
         try:
-            confronto_costi = calcola_e_confronta_costi(duvri_id)
+            confronto_costi = calcola_e_confronta_costi(duvri_id, data)
             print(f"✅ [PDF Helper] Confronto costi calcolato: {confronto_costi.get('stato') if confronto_costi else 'None'}")
             
             if confronto_costi and confronto_costi.get('richiede_azione'):
@@ -710,7 +989,7 @@ def trova_duvri_per_link(link_univoco):
         
         # 🆕 Cerca nella colonna link_appaltatore
         cursor.execute("""
-            SELECT * FROM duvri 
+            SELECT * FROM duvri_completi 
             WHERE link_appaltatore = ?
         """, (link_univoco,))
         
@@ -795,13 +1074,24 @@ def salva_dati_appaltatore_unificato(duvri_id, dati_appaltatore):
     
     save_current_duvri_data(current_data)
 
-    # Aggiorna stato
-    if duvri_id in duvri_list:
-        duvri = duvri_list[duvri_id]
-        if duvri.get('dati_committente'):
-            duvri['stato'] = 'completato'
-        else:
-            duvri['stato'] = 'in compilazione'
+    aggiorna_stato_compilazione(duvri_id)
+
+def aggiorna_stato_compilazione(duvri_id):
+    """
+    Aggiorna lo stato di compilazione del DUVRI
+
+    Quando committente e appaltatore hanno entrambi salvato i dati gli input
+    del PDF sono definitivi: il PDF per la firma viene preparato in background.
+    """
+    duvri = duvri_list.get(duvri_id)
+    if not duvri:
+        return
+
+    if duvri.get('dati_committente') and duvri.get('dati_appaltatore'):
+        duvri['stato'] = 'completato'
+        pianifica_prerender_per_firma(duvri_id)
+    else:
+        duvri['stato'] = 'in compilazione'
 
 def valida_duvri_access(duvri_id):
     """Valida l'accesso a un DUVRI"""
@@ -810,33 +1100,283 @@ def valida_duvri_access(duvri_id):
         return False, redirect(url_for('admin_dashboard'))
     return True, None
 
+def calcola_sha256(filepath):
+    """Calcola lo SHA-256 di un file leggendolo a blocchi"""
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for blocco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(blocco)
+    return h.hexdigest()
+
+def preflight_pdf(filepath):
+    """
+    Verifica un PDF una sola volta all'upload
+
+    Returns:
+        tuple: (num_pagine, preflight) con preflight 'ok', 'cifrato' o 'illeggibile'
+    """
+    try:
+        reader = PyPDF2.PdfReader(filepath)
+        if reader.is_encrypted:
+            return None, 'cifrato'
+        return len(reader.pages), 'ok'
+    except Exception as e:
+        print(f"⚠️ Preflight PDF fallito per {os.path.basename(filepath)}: {e}")
+        return None, 'illeggibile'
+
+# =============================================
+# ARCHIVIO UPLOAD PER CONTENUTO
+# =============================================
+# Allegati, DUVRI ESTAR e PDF firmati sono salvati una sola volta per
+# contenuto in uploads/blob/<sha[:2]>/<sha>: lo stesso certificato caricato
+# su più DUVRI occupa un solo file. La tabella blob_upload conta i
+# riferimenti (righe allegati, DUVRI ESTAR, firme) e il blob viene eliminato
+# solo quando l'ultimo riferimento è rilasciato. Le operazioni sullo store
+# avvengono dentro una transazione BEGIN IMMEDIATE, così spostamento del
+# file e contatore restano coerenti anche con più worker.
+BLOB_UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads", "blob")
+BLOB_UPLOAD_TMP_FOLDER = os.path.join(BLOB_UPLOAD_FOLDER, "tmp")
+
+def percorso_blob_upload(sha256):
+    """Percorso del blob con il contenuto indicato"""
+    return os.path.join(BLOB_UPLOAD_FOLDER, sha256[:2], sha256)
+
+def is_blob_upload(filepath):
+    """True se il percorso è nello store per contenuto (e non un file caricato prima dello store)"""
+    return os.path.dirname(os.path.dirname(os.path.abspath(filepath))) == BLOB_UPLOAD_FOLDER
+
+def percorso_temporaneo_upload():
+    """Percorso univoco dove ricevere un file prima di archiviarlo (stesso filesystem dello store)"""
+    os.makedirs(BLOB_UPLOAD_TMP_FOLDER, exist_ok=True)
+    return os.path.join(BLOB_UPLOAD_TMP_FOLDER, uuid.uuid4().hex)
+
+def archivia_upload(sorgente_path, sha256=None):
+    """
+    Sposta un file caricato nello store per contenuto e aggiunge un riferimento
+
+    Se il contenuto è già presente il file ricevuto viene scartato.
+    sha256 può essere passato se già calcolato durante la ricezione.
+
+    Returns:
+        dict: sha256, path e dimensione del blob
+    """
+    sha256 = sha256 or calcola_sha256(sorgente_path)
+    blob_path = percorso_blob_upload(sha256)
+    dimensione = os.path.getsize(sorgente_path)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        if os.path.exists(blob_path):
+            os.remove(sorgente_path)
+            print(f"♻️ Contenuto già archiviato: {sha256[:12]} ({dimensione} bytes risparmiati)")
+        else:
+            shutil.move(sorgente_path, blob_path)
+        conn.execute('''
+            INSERT INTO blob_upload (sha256, dimensione, riferimenti, created_at)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT(sha256) DO UPDATE SET riferimenti = riferimenti + 1
+        ''', (sha256, dimensione, datetime.now()))
+        conn.commit()
+    finally:
+        conn.close()
+
+    pianifica_estrazione_testo(sha256, blob_path)
+    return {'sha256': sha256, 'path': blob_path, 'dimensione': dimensione}
+
+def rilascia_upload(sha256):
+    """
+    Rilascia un riferimento al blob e lo elimina quando non ne restano
+
+    Returns:
+        int: byte liberati su disco
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'UPDATE blob_upload SET riferimenti = riferimenti - 1 WHERE sha256 = ? AND riferimenti > 0',
+            (sha256,)
+        )
+        blob = conn.execute('SELECT riferimenti, dimensione FROM blob_upload WHERE sha256 = ?', (sha256,)).fetchone()
+        liberati = 0
+        if blob and blob['riferimenti'] <= 0:
+            conn.execute('DELETE FROM blob_upload WHERE sha256 = ?', (sha256,))
+            blob_path = percorso_blob_upload(sha256)
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+                liberati = blob['dimensione']
+            rimuovi_miniatura(sha256)
+            conn.execute("DELETE FROM ricerca_contenuti WHERE tipo = 'testo' AND chiave = ?", (sha256,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    if liberati:
+        print(f"🧹 Blob {sha256[:12]} senza più riferimenti: liberati {liberati} bytes")
+    return liberati
+
+def rimuovi_file_caricato(filepath, sha256):
+    """Rilascia il blob di un file caricato; i file precedenti allo store vengono eliminati direttamente"""
+    if filepath and is_blob_upload(filepath):
+        return rilascia_upload(sha256)
+    if filepath and os.path.exists(filepath):
+        dimensione = os.path.getsize(filepath)
+        os.remove(filepath)
+        return dimensione
+    return 0
+
+def registra_allegato(duvri_id, filepath, nome_originale, sha256=None, archivia=True):
+    """
+    Registra un allegato nella tabella allegati (hash, MIME, pagine, preflight)
+
+    sha256 può essere passato se già calcolato durante la ricezione del file.
+    Con archivia=True il file viene spostato nello store per contenuto;
+    archivia=False registra il file dove si trova (allegati già su disco).
+    """
+    mime_type = mimetypes.guess_type(nome_originale)[0] or 'application/octet-stream'
+    num_pagine, preflight = None, 'non_pdf'
+    if mime_type == 'application/pdf':
+        num_pagine, preflight = preflight_pdf(filepath)
+
+    dimensione = os.path.getsize(filepath)
+    sha256 = sha256 or calcola_sha256(filepath)
+    if archivia:
+        filepath = archivia_upload(filepath, sha256)['path']
+
+    allegato_id = str(uuid.uuid4())[:8]
+
+    conn = get_db_connection()
+    # Un upload con lo stesso nome sostituisce il precedente
+    precedenti = conn.execute(
+        'SELECT id, path, sha256 FROM allegati WHERE duvri_id = ? AND nome_originale = ?',
+        (duvri_id, nome_originale)
+    ).fetchall()
+    conn.execute('DELETE FROM allegati WHERE duvri_id = ? AND nome_originale = ?', (duvri_id, nome_originale))
+    conn.execute('''
+        INSERT INTO allegati
+        (id, duvri_id, nome_originale, path, dimensione, sha256, mime_type, num_pagine, preflight, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        allegato_id,
+        duvri_id,
+        nome_originale,
+        filepath,
+        dimensione,
+        sha256,
+        mime_type,
+        num_pagine,
+        preflight,
+        datetime.now()
+    ))
+    conn.commit()
+    conn.close()
+
+    # Il nuovo riferimento è già acquisito: un contenuto identico non viene mai eliminato
+    for precedente in precedenti:
+        if archivia or precedente['path'] != filepath:
+            rimuovi_file_caricato(precedente['path'], precedente['sha256'])
+
+    print(f"✅ Allegato registrato: {nome_originale} ({preflight}, {num_pagine or 0} pagine)")
+    pianifica_miniatura({'sha256': sha256, 'path': filepath, 'mime_type': mime_type, 'preflight': preflight})
+    return allegato_id
+
+def importa_allegati_da_disco():
+    """Registra una tantum gli allegati presenti su disco ma non ancora in tabella"""
+    if not os.path.exists(ALLEGATI_FOLDER):
+        return 0
+
+    try:
+        conn = get_db_connection()
+        registrati = {row['path'] for row in conn.execute('SELECT path FROM allegati').fetchall()}
+        conn.close()
+
+        importati = 0
+        for cartella in os.listdir(ALLEGATI_FOLDER):
+            cartella_path = os.path.join(ALLEGATI_FOLDER, cartella)
+            if not cartella.startswith('duvri_') or not os.path.isdir(cartella_path):
+                continue
+
+            duvri_id = cartella[len('duvri_'):]
+            for filename in sorted(os.listdir(cartella_path)):
+                filepath = os.path.join(cartella_path, filename)
+                if os.path.isfile(filepath) and filepath not in registrati:
+                    registra_allegato(duvri_id, filepath, filename, archivia=False)
+                    importati += 1
+
+        if importati:
+            print(f"📎 Importati {importati} allegati esistenti nel registro")
+        return importati
+
+    except Exception as e:
+        print(f"❌ Errore importazione allegati da disco: {e}")
+        return 0
+
+def get_allegato(duvri_id, allegato_id):
+    """Recupera un singolo allegato del DUVRI dal registro"""
+    conn = get_db_connection()
+    allegato = conn.execute(
+        'SELECT * FROM allegati WHERE id = ? AND duvri_id = ?',
+        (allegato_id, duvri_id)
+    ).fetchone()
+    conn.close()
+    return dict(allegato) if allegato else None
+
 def get_allegati_list(duvri_id):
-    """Restituisce la lista degli allegati per un DUVRI"""
-    allegati_dir = os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}")
-    allegati = []
+    """Restituisce la lista degli allegati per un DUVRI (dal registro, senza accedere al disco)"""
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT * FROM allegati
+            WHERE duvri_id = ?
+            ORDER BY nome_originale
+        ''', (duvri_id,)).fetchall()
+        conn.close()
+    except Exception as e:
+        print(f"❌ Errore lettura registro allegati: {e}")
+        return []
 
-    if os.path.exists(allegati_dir):
-        for filename in os.listdir(allegati_dir):
-            filepath = os.path.join(allegati_dir, filename)
-            if os.path.isfile(filepath):
-                stat = os.stat(filepath)
-                allegati.append({
-                    'nome_originale': filename,
-                    'data_upload': datetime.fromtimestamp(stat.st_mtime).strftime('%d/%m/%Y %H:%M'),
-                    'dimensione': stat.st_size
-                })
+    allegati = []
+    for row in rows:
+        allegato = dict(row)
+        try:
+            allegato['data_upload'] = datetime.fromisoformat(str(allegato['created_at'])).strftime('%d/%m/%Y %H:%M')
+        except (TypeError, ValueError):
+            allegato['data_upload'] = allegato['created_at'] or ''
+        allegati.append(allegato)
 
     return allegati
 
 # =============================================
 # FUNZIONE COSTI
 # =============================================
-def calcola_e_confronta_costi(duvri_id):
+_cache_confronto_costi = {}
+
+def calcola_e_confronta_costi(duvri_id, data=None):
+    """
+    Confronto costi del DUVRI, ricalcolato solo quando cambiano i dati
+
+    Il risultato è in cache per DUVRI insieme all'impronta dei dati da cui
+    deriva: pagina extra-costi, PDF e documenti del workflow lo condividono.
+    """
+    if data is None:
+        data = get_duvri_data(duvri_id)
+
+    impronta = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    in_cache = _cache_confronto_costi.get(duvri_id)
+    if in_cache and in_cache[0] == impronta:
+        return copy.deepcopy(in_cache[1])
+
+    confronto = _calcola_confronto_costi(duvri_id, data)
+    _cache_confronto_costi[duvri_id] = (impronta, copy.deepcopy(confronto))
+    return confronto
+
+def _calcola_confronto_costi(duvri_id, data):
     """
     VERSIONE CORRETTA con gestione completa dei 2 scenari normativi
     """
     
-    data = get_current_duvri_data()
     committente = data.get('committente', {})
     appaltatore = data.get('appaltatore', {})
     
@@ -1589,6 +2129,7 @@ def admin_dashboard():
     """Dashboard solo per l'amministratore - vede tutti i DUVRI"""
     # 🔥 FORZA SINCRONIZZAZIONE
     sync_all_duvri_from_db()
+    avvia_manutenzione()
 
     return render_template('admin_dashboard.html',
                          duvri_list=duvri_list,
@@ -1603,21 +2144,20 @@ def scarica_duvri_estar(duvri_id):
         flash('Accesso negato', 'danger')
         return redirect(url_for('admin_dashboard'))
     
-    # Recupera filename dal database
-    conn = get_db_connection()
-    duvri = conn.execute('SELECT duvri_estar_filename FROM duvri WHERE id = ?', 
-                         (duvri_id,)).fetchone()
-    conn.close()
+    # Recupera filename e blob dal database
+    estar = get_duvri_estar(duvri_id)
     
-    if not duvri or not duvri['duvri_estar_filename']:
+    if not estar:
         flash('File non trovato', 'warning')
         return redirect(url_for('committente_form'))
     
-    filename = duvri['duvri_estar_filename']
-    filepath = os.path.join(app.config['UPLOAD_FOLDER_DUVRI_ESTAR'], filename)
-    
-    if os.path.exists(filepath):
-        return send_file(filepath, as_attachment=True)
+    if os.path.exists(estar['path']):
+        return invia_file(
+            estar['path'],
+            'caricato',
+            download_name=estar['filename'],
+            mimetype=mimetypes.guess_type(estar['filename'])[0]
+        )
     else:
         flash('File non trovato sul server', 'danger')
         return redirect(url_for('committente_form'))
@@ -1721,15 +2261,34 @@ def compila_committente():
         }
         
         # 🆕 GESTIONE UPLOAD DUVRI ESTAR
-        duvri_estar_filename = None
+        estar_precedente = get_duvri_estar(duvri_id)
+        duvri_estar_filename, duvri_estar_sha256 = None, None
         if 'duvri_estar_file' in request.files:
             file = request.files['duvri_estar_file']
             if file.filename != '':
-                duvri_estar_filename = salva_duvri_estar(file, duvri_id)
+                duvri_estar_filename, duvri_estar_sha256 = salva_duvri_estar(file, duvri_id)
                 if duvri_estar_filename:
-                    dati_committente['duvri_estar_filename'] = duvri_estar_filename
                     flash('✅ DUVRI ESTAR caricato con successo', 'success')
 
+        # File già ricevuto con l'upload a blocchi (/upload/sessioni)
+        caricato = os.path.basename(request.form.get('duvri_estar_caricato', ''))
+        caricato_path = os.path.join(app.config['UPLOAD_FOLDER_DUVRI_ESTAR'], caricato)
+        if not duvri_estar_filename and caricato.startswith(f"{duvri_id}_") and os.path.isfile(caricato_path):
+            duvri_estar_filename = caricato
+            duvri_estar_sha256 = archivia_upload(caricato_path)['sha256']
+            flash('✅ DUVRI ESTAR caricato con successo', 'success')
+
+        if duvri_estar_sha256 and estar_precedente and estar_precedente['sha256'] == duvri_estar_sha256:
+            # Stesso contenuto già collegato: basta il riferimento esistente
+            rilascia_upload(duvri_estar_sha256)
+
+        # Senza un nuovo file resta il DUVRI ESTAR già caricato
+        if not duvri_estar_filename and estar_precedente:
+            duvri_estar_filename = estar_precedente['filename']
+            duvri_estar_sha256 = estar_precedente['sha256']
+        if duvri_estar_filename:
+            dati_committente['duvri_estar_filename'] = duvri_estar_filename
+
         # Salva i dati in memoria
         duvri['dati_committente'] = dati_committente
         current_data = get_current_duvri_data()
@@ -1746,6 +2305,7 @@ def compila_committente():
                     costi_inclusi_gara = ?,
                     costi_sicurezza_gara = ?,
                     duvri_estar_filename = ?,
+                    duvri_estar_sha256 = ?,
                     committente_data = ?,
                     updated_at = ?
                 WHERE id = ?
@@ -1756,12 +2316,17 @@ def compila_committente():
                 1 if dati_committente.get('costi_inclusi_gara') else 0,
                 float(dati_committente.get('costi_sicurezza_gara') or 0),
                 duvri_estar_filename,
+                duvri_estar_sha256,
                 json.dumps(dati_committente),
                 datetime.now(),
                 duvri_id
             ))
             conn.commit()
             conn.close()
+
+            # Il DUVRI ESTAR sostituito rilascia il suo blob
+            if estar_precedente and duvri_estar_sha256 != estar_precedente['sha256']:
+                rimuovi_file_caricato(estar_precedente['path'], estar_precedente['sha256'])
             
             print(f"✅ Dati committente salvati - DUVRI {duvri_id}")
             print(f"   Tipo: {dati_committente.get('tipo_duvri')}")
@@ -1774,11 +2339,7 @@ def compila_committente():
         
         save_current_duvri_data(current_data)
 
-        # Aggiorna stato
-        if duvri['dati_appaltatore']:
-            duvri['stato'] = 'completato'
-        else:
-            duvri['stato'] = 'in compilazione'
+        aggiorna_stato_compilazione(duvri_id)
 
         flash('✅ Dati committente salvati con successo!', 'success')
         return redirect(url_for('summary'))
@@ -1986,7 +2547,7 @@ def emergency_recover():
     """Recupera tutti i DUVRI dal database - SOLO EMERGENZA"""
     try:
         conn = get_db_connection()
-        duvri_from_db = conn.execute('SELECT * FROM duvri').fetchall()
+        duvri_from_db = conn.execute('SELECT * FROM duvri_completi').fetchall()
         conn.close()
 
         recovered_count = 0
@@ -2089,6 +2650,7 @@ def aggiorna_note_costi():
     ''', (json.dumps(data.get('appaltatore')), duvri_id))
     conn.commit()
     conn.close()
+    registra_revisione(duvri_id)
     
     flash('✅ Note sui costi aggiornate', 'success')
     return redirect(url_for('summary'))
@@ -2189,7 +2751,7 @@ def summary():
     # Aggiungi lista allegati ai dati
     if 'appaltatore' not in data:
         data['appaltatore'] = {}
-    data['appaltatore']['allegati'] = get_allegati_list(duvri_id)
+    data['appaltatore']['allegati'] = aggiungi_miniature(get_allegati_list(duvri_id))
     
     # ========================================
     # CALCOLO COSTI - RISPETTA MODALITÀ MANUALE
@@ -2240,6 +2802,7 @@ def summary():
     return render_template('summary.html',
                          data=data,
                          confronto_costi=confronto_costi,
+                         firme_digitali=get_firme_digitali(duvri_id),
                          duvri_list=duvri_list,
                          current_duvri_id=duvri_id,
                          WEASYPRINT_AVAILABLE=WEASYPRINT_AVAILABLE,
@@ -2470,39 +3033,311 @@ def comunica_impresa(duvri_id):
     
     return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
     
+# =============================================
+# DOCUMENTI WORKFLOW EXTRA-COSTI
+# =============================================
+# Nota tecnica, prospetto, determina e clausola condividono intestazione,
+# stile e confronto costi in cache. Sono convertiti insieme in un pool di
+# processi (xhtml2pdf/ReportLab è codice Python CPU-bound con stato globale,
+# in un pool di thread non andrebbe in parallelo) e registrati tra gli
+# artefatti; la colonna doc_* conserva per ciascuno l'impronta degli input e
+# lo stato del workflow in cui è stato prodotto, così un documento viene
+# rigenerato solo se i suoi input cambiano.
+DOCUMENTI_EXTRA_COSTI = {
+    'nota_tecnica': {'titolo': 'Nota Tecnica SPP', 'template': 'extra_costi/nota_tecnica.html', 'colonna': 'doc_nota_tecnica'},
+    'prospetto_costi': {'titolo': 'Prospetto Costi Analitico', 'template': 'extra_costi/prospetto_costi.html', 'colonna': 'doc_prospetto_costi'},
+    'determina': {'titolo': 'Bozza Determina Dirigenziale', 'template': 'extra_costi/determina.html', 'colonna': 'doc_determina'},
+    'clausola': {'titolo': 'Clausola Contrattuale', 'template': 'extra_costi/clausola.html', 'colonna': 'doc_clausola'}
+}
+
+# Voci della tabella costi (stesse descrizioni della sezione 2.6.3 del DUVRI)
+VOCI_COSTI_SICUREZZA = [
+    ('costo_incontri', 'Incontri, riunioni, sopralluoghi di coordinamento'),
+    ('costo_dpi', 'DPI specifici per rischi da interferenza'),
+    ('costo_impiantistica', 'Impiantistica ausiliaria di sicurezza'),
+    ('costo_segnaletica', 'Segnaletica e delimitazioni di sicurezza'),
+    ('costo_presidi', 'Presidi antincendio/primo soccorso'),
+    ('costo_controlli', 'Controlli sanitari specifici'),
+    ('costo_altre_misure', 'Altre misure di sicurezza e costi base')
+]
+
+_pool_documenti = None
+_pool_documenti_lock = threading.Lock()
+
+def get_documento_extra_costi(extra_costo, chiave):
+    """Documento registrato nella colonna doc_* (None se mai generato o non più su disco)"""
+    valore = (extra_costo or {}).get(DOCUMENTI_EXTRA_COSTI[chiave]['colonna'])
+    if not valore:
+        return None
+    try:
+        documento = json.loads(valore)
+    except ValueError:
+        return None
+    return documento if os.path.exists(documento.get('path', '')) else None
+
+def _converti_documento(html_content, riproducibile):
+    """Worker: converte l'HTML di un documento in un PDF temporaneo"""
+    output_path = percorso_temporaneo_artefatto()
+    motore = genera_pdf_da_html(html_content, output_path)
+    if not motore:
+        return None, None
+    if riproducibile:
+        normalizza_pdf(output_path, *riproducibile)
+    return output_path, motore
+
+def _invia_conversione_documento(html_content, riproducibile):
+    """Accoda la conversione al pool dei documenti, ricreandolo se un processo è caduto"""
+    global _pool_documenti
+
+    with _pool_documenti_lock:
+        for tentativo in range(2):
+            if _pool_documenti is None:
+                _pool_documenti = ProcessPoolExecutor(
+                    max_workers=min(app.config['DOCUMENTI_WORKERS'], len(DOCUMENTI_EXTRA_COSTI)))
+            try:
+                return _pool_documenti.submit(_converti_documento, html_content, riproducibile)
+            except (BrokenProcessPool, RuntimeError):
+                if tentativo:
+                    raise
+                print("❌ Pool documenti extra-costi interrotto: verrà ricreato")
+                _pool_documenti = None
+
+def genera_documenti_extra_costi(duvri_id, data=None):
+    """
+    Genera in parallelo i documenti del workflow extra-costi i cui input sono cambiati
+
+    Returns:
+        dict: chiave documento -> record doc_* aggiornato
+    """
+    extra_costo = get_extra_costo(duvri_id)
+    if not extra_costo:
+        return {}
+    if data is None:
+        data = get_duvri_data(duvri_id)
+
+    istante = get_istante_documento(duvri_id) if app.config.get('PDF_RIPRODUCIBILE') else None
+    contesto = {
+        'duvri_id': duvri_id,
+        'data': data,
+        'confronto': calcola_e_confronta_costi(duvri_id, data),
+        # I riferimenti ai documenti già generati non sono input
+        'extra_costo': {k: v for k, v in extra_costo.items() if not k.startswith('doc_')},
+        'voci_costi': VOCI_COSTI_SICUREZZA,
+        'datetime': OrologioDocumento(istante) if istante else datetime
+    }
+    impronta_contesto = json.dumps(_normalizza_per_impronta(contesto), sort_keys=True, default=str)
+
+    documenti = {}
+    in_corso = {}
+    for chiave, documento in DOCUMENTI_EXTRA_COSTI.items():
+        h = hashlib.sha256(impronta_contesto.encode('utf-8'))
+        h.update(f"{chiave}:{istante}".encode('utf-8'))
+        for nome in (documento['template'], 'extra_costi/documento_base.html'):
+            h.update(impronta_template(nome).encode('utf-8'))
+        hash_input = h.hexdigest()
+
+        esistente = get_documento_extra_costi(extra_costo, chiave)
+        if esistente and esistente['hash_input'] == hash_input:
+            documenti[chiave] = esistente
+            continue
+
+        # Il render Jinja resta nel contesto dell'app, la conversione PDF va nel pool
+        html_content = render_template(documento['template'], titolo_documento=documento['titolo'], **contesto)
+        riproducibile = (istante, hash_input) if istante else None
+        in_corso[chiave] = (hash_input, _invia_conversione_documento(html_content, riproducibile))
+
+    for chiave, (hash_input, futuro) in in_corso.items():
+        try:
+            output_path, motore = futuro.result()
+        except Exception as e:
+            print(f"❌ Errore generazione {chiave} per DUVRI {duvri_id}: {e}")
+            continue
+        if not output_path:
+            print(f"❌ Nessun motore PDF disponibile per {chiave}")
+            continue
+
+        artefatto = salva_artefatto(duvri_id, chiave, output_path, hash_input, motore)
+        rimuovi_artefatti_superati(duvri_id, chiave, hash_input)
+        documenti[chiave] = {
+            'artefatto_id': artefatto['id'],
+            'path': artefatto['path'],
+            'hash_input': hash_input,
+            'stato': extra_costo['stato'],
+            'generato_il': datetime.now().isoformat(timespec='seconds')
+        }
+        aggiorna_extra_costo(duvri_id, **{DOCUMENTI_EXTRA_COSTI[chiave]['colonna']: json.dumps(documenti[chiave])})
+
+    if in_corso:
+        print(f"📄 Documenti extra-costi DUVRI {duvri_id}: rigenerati {', '.join(in_corso)}")
+    return documenti
+
+def scarica_documento_extra_costi(duvri_id, chiave):
+    """Genera (se necessario) i documenti del workflow e scarica quello richiesto"""
+    if session.get('current_duvri_id') != duvri_id:
+        flash('Accesso negato', 'danger')
+        return redirect(url_for('admin_dashboard'))
+
+    extra_costo = get_extra_costo(duvri_id)
+    if not extra_costo or not extra_costo['approvato_rup']:
+        flash('Richiesta approvazione RUP prima di generare i documenti', 'warning')
+        return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+
+    try:
+        documento = genera_documenti_extra_costi(duvri_id).get(chiave)
+    except Exception as e:
+        print(f"❌ Errore documenti extra-costi: {e}")
+        documento = None
+
+    if not documento:
+        flash('Errore nella generazione del documento', 'danger')
+        return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+
+    return invia_file(
+        documento['path'],
+        'artefatto',
+        download_name=f"{secure_filename(DOCUMENTI_EXTRA_COSTI[chiave]['titolo'])}_{duvri_id}.pdf",
+        etag=f"{chiave}-{documento['hash_input'][:40]}"
+    )
+
 @app.route('/genera_nota_tecnica/<duvri_id>')
 def genera_nota_tecnica(duvri_id):
-    """Genera nota tecnica SPP (PLACEHOLDER)"""
-    flash('🚧 Generazione nota tecnica - In sviluppo', 'info')
-    return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+    """Genera nota tecnica SPP"""
+    return scarica_documento_extra_costi(duvri_id, 'nota_tecnica')
 
 
 @app.route('/genera_prospetto_costi/<duvri_id>')
 def genera_prospetto_costi(duvri_id):
-    """Genera prospetto costi analitico (PLACEHOLDER)"""
-    flash('🚧 Generazione prospetto costi - In sviluppo', 'info')
-    return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+    """Genera prospetto costi analitico"""
+    return scarica_documento_extra_costi(duvri_id, 'prospetto_costi')
 
 
 @app.route('/genera_determina/<duvri_id>')
 def genera_determina(duvri_id):
-    """Genera bozza determina dirigenziale (PLACEHOLDER)"""
-    flash('🚧 Generazione determina - In sviluppo', 'info')
-    return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+    """Genera bozza determina dirigenziale"""
+    return scarica_documento_extra_costi(duvri_id, 'determina')
 
 
 @app.route('/genera_clausola/<duvri_id>')
 def genera_clausola(duvri_id):
-    """Genera clausola contrattuale (PLACEHOLDER)"""
-    flash('🚧 Generazione clausola - In sviluppo', 'info')
-    return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+    """Genera clausola contrattuale"""
+    return scarica_documento_extra_costi(duvri_id, 'clausola')
+
+
+# Estensioni già compresse: nello ZIP vengono solo archiviate (ZIP_STORED)
+ESTENSIONI_GIA_COMPRESSE = {'.pdf', '.docx', '.xlsx', '.zip', '.png', '.jpg', '.jpeg', '.p7m'}
+
+class _FlussoZip:
+    """Destinazione non ricercabile per ZipFile: accumula i byte scritti fino al prossimo invio"""
+
+    def __init__(self):
+        self._blocchi = []
 
+    def write(self, dati):
+        self._blocchi.append(bytes(dati))
+        return len(dati)
+
+    def flush(self):
+        pass
+
+    def svuota(self):
+        dati = b''.join(self._blocchi)
+        self._blocchi = []
+        return dati
+
+def zip_in_streaming(voci, dimensione_blocco=64 * 1024):
+    """
+    Genera uno ZIP a blocchi senza copie in memoria o su disco dell'archivio
+
+    Args:
+        voci: iterabile di (percorso_file, nome_nell_archivio)
+    """
+    flusso = _FlussoZip()
+    with zipfile.ZipFile(flusso, 'w') as archivio:
+        for filepath, arcname in voci:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+                sorgente = open(filepath, 'rb')
+            except OSError as e:
+                print(f"⚠️ Pacchetto: file saltato {arcname}: {e}")
+                continue
+
+            estensione = os.path.splitext(arcname)[1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if estensione in ESTENSIONI_GIA_COMPRESSE else zipfile.ZIP_DEFLATED
+            with sorgente, archivio.open(zinfo, 'w') as destinazione:
+                for blocco in iter(lambda: sorgente.read(dimensione_blocco), b''):
+                    destinazione.write(blocco)
+                    dati = flusso.svuota()
+                    if dati:
+                        yield dati
+            yield flusso.svuota()
+    # Directory centrale
+    yield flusso.svuota()
+
+def voci_pacchetto_duvri(duvri_id):
+    """Elenca i file del fascicolo completo del DUVRI come (percorso, nome nell'archivio)"""
+    voci = []
+
+    # PDF generati dal registro artefatti
+    base = trova_artefatto(duvri_id, 'base')
+    if base:
+        voci.append((base['path'], 'DUVRI_base.pdf'))
+    unito = trova_artefatto(duvri_id, 'completo') or trova_artefatto(duvri_id, 'per_firma')
+    if unito:
+        voci.append((unito['path'], 'DUVRI_completo_con_allegati.pdf'))
+
+    # PDF firmati digitalmente dalle parti
+    firme = get_firme_digitali(duvri_id)
+    if firme:
+        for ruolo, firma in firme.items():
+            voci.append((firma['path'], f"firme/{firma['nome_file']}"))
+    else:
+        for i, firmato in enumerate(get_artefatti(duvri_id, 'firmato'), 1):
+            voci.append((firmato['path'], f"firme/firmato_{i}.pdf"))
+
+    # Allegati caricati
+    for allegato in get_allegati_list(duvri_id):
+        voci.append((allegato['path'], f"allegati/{allegato['nome_originale']}"))
+
+    # DUVRI ESTAR
+    estar = get_duvri_estar(duvri_id)
+    if estar:
+        voci.append((estar['path'], f"duvri_estar/{estar['filename']}"))
+
+    # Documenti del workflow extra-costi
+    extra = get_extra_costo(duvri_id)
+    if extra:
+        for chiave, documento in DOCUMENTI_EXTRA_COSTI.items():
+            registrato = get_documento_extra_costi(extra, chiave)
+            if registrato:
+                voci.append((registrato['path'], f"extra_costi/{secure_filename(documento['titolo'])}.pdf"))
+
+    return [(percorso, arcname) for percorso, arcname in voci if os.path.isfile(percorso)]
 
 @app.route('/scarica_pacchetto_completo/<duvri_id>')
 def scarica_pacchetto_completo(duvri_id):
-    """Scarica ZIP con tutti i documenti (PLACEHOLDER)"""
-    flash('🚧 Generazione pacchetto ZIP - In sviluppo', 'info')
-    return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+    """Scarica in streaming lo ZIP con tutti i documenti del DUVRI"""
+
+    if session.get('current_duvri_id') != duvri_id:
+        flash('Accesso negato', 'danger')
+        return redirect(url_for('admin_dashboard'))
+
+    voci = voci_pacchetto_duvri(duvri_id)
+    if not voci:
+        flash('Nessun documento disponibile per il pacchetto', 'warning')
+        return redirect(url_for('gestione_extra_costi', duvri_id=duvri_id))
+
+    nome_progetto = duvri_list.get(duvri_id, {}).get('nome_progetto', duvri_id)
+    nome_zip = secure_filename(f"DUVRI_{nome_progetto}_{datetime.now().strftime('%Y-%m-%d')}.zip") or f"DUVRI_{duvri_id}.zip"
+    print(f"📦 Pacchetto DUVRI {duvri_id}: {len(voci)} file in streaming")
+
+    response = app.response_class(
+        stream_with_context(zip_in_streaming(voci)),
+        mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="{nome_zip}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
 # =============================================
 # ROUTES SECONDARIE E LEGACY
 # =============================================
@@ -2540,7 +3375,8 @@ def select_role():
 @app.route('/elimina_duvri/<duvri_id>', methods=['POST'])
 def elimina_duvri(duvri_id):
     """
-    Elimina un DUVRI e tutti i dati associati
+    Elimina un DUVRI: sparisce subito da dashboard e ricerca, righe collegate
+    e file vengono cancellati dalla purga dopo PURGA_DOPO_ORE
     """
     try:
         # Verifica che il DUVRI esista nella memoria
@@ -2554,11 +3390,12 @@ def elimina_duvri(duvri_id):
         # 1. Elimina il DUVRI dalla memoria
         del duvri_list[duvri_id]
 
-        # 2. Elimina il DUVRI dal database SQLite
+        # 2. Segna il DUVRI come eliminato: righe collegate e file restano fino alla purga
         conn = get_db_connection()
-        conn.execute('DELETE FROM duvri WHERE id = ?', (duvri_id,))
+        conn.execute('UPDATE duvri SET eliminato_il = ? WHERE id = ?', (datetime.now(), duvri_id))
         conn.commit()
         conn.close()
+        avvia_manutenzione()
 
         # 3. Se era il DUVRI corrente, resetta la selezione nella sessione
         if session.get('current_duvri_id') == duvri_id:
@@ -2571,82 +3408,176 @@ def elimina_duvri(duvri_id):
 
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/duplica_duvri/<duvri_id>')
-def duplica_duvri(duvri_id):
+# =============================================
+# DUPLICAZIONE DUVRI (COPIA SU SCRITTURA)
+# =============================================
+# I contratti di manutenzione ricorrenti si creano duplicando un DUVRI
+# esistente. La copia non duplica né i dati né i file: le sezioni
+# committente e appaltatore restano NULL con <sezione>_da che punta al DUVRI
+# che le contiene, e gli allegati e il DUVRI ESTAR aggiungono un riferimento
+# agli stessi blob. La lettura passa dalla vista duvri_completi, che risolve
+# le sezioni condivise; i trigger materializzano una sezione solo quando
+# cambia: la copia quando viene modificata, le copie che ne dipendono quando
+# cambia (o viene eliminato) l'originale. <sezione>_da punta sempre a un
+# DUVRI che ha la sezione materializzata, quindi la risoluzione è a un passo.
+SEZIONI_CONDIVISIBILI = ('committente', 'appaltatore')
+
+def crea_copia_su_scrittura(conn):
+    """(Ri)crea la vista duvri_completi e i trigger che materializzano le sezioni condivise"""
+    colonne = [row['name'] for row in conn.execute('PRAGMA table_info(duvri)')]
+    sezioni_dati = {f'{sezione}_data': sezione for sezione in SEZIONI_CONDIVISIBILI}
+    select = ', '.join(
+        f'coalesce(d.{colonna}, origine_{sezioni_dati[colonna]}.{colonna}) AS {colonna}'
+        if colonna in sezioni_dati else f'd.{colonna}'
+        for colonna in colonne
+    )
+    join = ' '.join(
+        f'LEFT JOIN duvri origine_{sezione} ON origine_{sezione}.id = d.{sezione}_da'
+        for sezione in SEZIONI_CONDIVISIBILI
+    )
+    script = f'''
+        DROP VIEW IF EXISTS duvri_completi;
+        CREATE VIEW duvri_completi AS SELECT {select} FROM duvri d {join} WHERE d.eliminato_il IS NULL;
+    '''
+
+    for s in SEZIONI_CONDIVISIBILI:
+        script += f'''
+            DROP TRIGGER IF EXISTS cow_{s}_modificata;
+            DROP TRIGGER IF EXISTS cow_{s}_origine_modificata;
+            DROP TRIGGER IF EXISTS cow_{s}_origine_eliminata;
+
+            -- Scrittura sulla copia: se il contenuto è identico all'origine resta condiviso
+            CREATE TRIGGER cow_{s}_modificata AFTER UPDATE OF {s}_data ON duvri
+            WHEN NEW.{s}_da IS NOT NULL AND NEW.{s}_data IS NOT NULL
+            BEGIN
+                UPDATE duvri SET
+                    {s}_data = CASE WHEN NEW.{s}_data = (SELECT {s}_data FROM duvri WHERE id = NEW.{s}_da)
+                                    THEN NULL ELSE NEW.{s}_data END,
+                    {s}_da = CASE WHEN NEW.{s}_data = (SELECT {s}_data FROM duvri WHERE id = NEW.{s}_da)
+                                  THEN NEW.{s}_da ELSE NULL END
+                WHERE id = NEW.id;
+            END;
+
+            -- Modifica o eliminazione dell'origine: le copie ricevono la versione che condividevano
+            CREATE TRIGGER cow_{s}_origine_modificata AFTER UPDATE OF {s}_data ON duvri
+            WHEN OLD.{s}_data IS NOT NULL AND NEW.{s}_data IS NOT OLD.{s}_data
+            BEGIN
+                UPDATE duvri SET {s}_data = OLD.{s}_data, {s}_da = NULL WHERE {s}_da = OLD.id;
+            END;
+
+            CREATE TRIGGER cow_{s}_origine_eliminata AFTER DELETE ON duvri
+            WHEN OLD.{s}_data IS NOT NULL
+            BEGIN
+                UPDATE duvri SET {s}_data = OLD.{s}_data, {s}_da = NULL WHERE {s}_da = OLD.id;
+            END;
+        '''
+    conn.executescript(script)
+
+def copia_duvri(duvri_id):
     """
-    Duplica un DUVRI esistente con un nuovo ID e link univoco
-    """
-    try:
-        # Verifica che il DUVRI esista nella memoria
-        if duvri_id not in duvri_list:
-            flash('DUVRI non trovato.', 'danger')
-            return redirect(url_for('admin_dashboard'))
-
-        # Recupera il DUVRI originale
-        duvri_originale = duvri_list[duvri_id]
+    Crea una copia completa del DUVRI che condivide sezioni e file con l'originale
 
-        # Genera un nuovo ID univoco
-        nuovo_id = str(uuid.uuid4())
+    Firme, stato e link appaltatore ripartono da zero; l'extra-costo viene
+    copiato come 'rilevato' perché validazioni e determina riguardano il
+    contratto originale.
 
-        # Crea una copia profonda del DUVRI originale
-        nuovo_duvri = copy.deepcopy(duvri_originale)
-
-        # Aggiorna i campi univoci
-        nuovo_duvri['id'] = nuovo_id
-        nuovo_duvri['link_appaltatore'] = str(uuid.uuid4())
-        nuovo_duvri['created_at'] = datetime.now().strftime("%Y-%m-%d %H:%M")
-
-        # Modifica il nome per indicare che è una copia
-        nome_originale = nuovo_duvri.get('nome_progetto', 'DUVRI senza nome')
-        nuovo_duvri['nome_progetto'] = f"{nome_originale} (Copia)"
-
-        # Resetta lo stato a "bozza" se non è già in bozza
-        if nuovo_duvri.get('stato') != 'bozza':
-            nuovo_duvri['stato'] = 'bozza'
-
-        # Resetta le firme se presenti
-        if 'signatures' in nuovo_duvri:
-            nuovo_duvri['signatures'] = {}
-
-        # Resetta i timestamp di firma
-        if 'firmato_il' in nuovo_duvri:
-            del nuovo_duvri['firmato_il']
-
-        # IMPORTANTE: Mantieni tutti i dati dei form ma resetta alcuni campi temporanei
-        # Mantieni dati committente
-        if 'dati_committente' in nuovo_duvri:
-            # Resetta solo la data di compilazione
-            nuovo_duvri['dati_committente']['compilato_il'] = datetime.now().strftime('%Y-%m-%d %H:%M')
-
-        # Mantieni dati appaltatore
-        if 'dati_appaltatore' in nuovo_duvri:
-            # Resetta solo la data di compilazione
-            nuovo_duvri['dati_appaltatore']['compilato_il'] = datetime.now().strftime("%Y-%m-%d %H:%M")
+    Returns:
+        str: id del nuovo DUVRI, None se l'originale non esiste
+    """
+    conn = get_db_connection()
+    originale = conn.execute('SELECT * FROM duvri WHERE id = ?', (duvri_id,)).fetchone()
+    allegati = [dict(row) for row in conn.execute('SELECT * FROM allegati WHERE duvri_id = ?', (duvri_id,))]
+    conn.close()
+    if not originale:
+        return None
 
-        # 1. Aggiungi il nuovo DUVRI alla memoria
-        duvri_list[nuovo_id] = nuovo_duvri
+    # I file caricati prima dello store vengono archiviati una volta per poterli condividere
+    estar_sha256 = originale['duvri_estar_sha256']
+    estar_legacy = None
+    if originale['duvri_estar_filename'] and not estar_sha256:
+        estar_path = percorso_duvri_estar(originale['duvri_estar_filename'], None)
+        if os.path.exists(estar_path):
+            tmp_path = percorso_temporaneo_upload()
+            shutil.copyfile(estar_path, tmp_path)
+            estar_legacy = archivia_upload(tmp_path)['sha256']
+    blob_condivisi = [estar_sha256] if estar_sha256 else []
+    for allegato in allegati:
+        if is_blob_upload(allegato['path']):
+            blob_condivisi.append(allegato['sha256'])
+        elif os.path.exists(allegato['path']):
+            tmp_path = percorso_temporaneo_upload()
+            shutil.copyfile(allegato['path'], tmp_path)
+            allegato['path'] = archivia_upload(tmp_path, allegato['sha256'])['path']
+
+    nuovo_id = str(uuid.uuid4())[:8]
+    adesso = datetime.now()
+    colonne = originale.keys()
+    valori = {colonna: f'o.{colonna}' for colonna in colonne}
+    valori.update({
+        'id': ':id',
+        'nome_progetto': "coalesce(o.nome_progetto, 'DUVRI senza nome') || ' (Copia)'",
+        'link_appaltatore': ':link',
+        'signatures': "'{}'",
+        'stato': "'bozza'",
+        'eliminato_il': 'NULL',
+        'duvri_estar_sha256': 'coalesce(:estar_sha256, o.duvri_estar_sha256)',
+        'created_at': ':adesso',
+        'updated_at': ':adesso',
+    })
+    for sezione in SEZIONI_CONDIVISIBILI:
+        valori[f'{sezione}_data'] = 'NULL'
+        valori[f'{sezione}_da'] = f'CASE WHEN o.{sezione}_data IS NULL THEN o.{sezione}_da ELSE o.id END'
 
-        # 2. Salva il nuovo DUVRI nel database SQLite
-        conn = get_db_connection()
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
         conn.execute(
-            'INSERT INTO duvri (id, nome_progetto, committente_data, appaltatore_data, signatures, stato, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (
-                nuovo_id,
-                nuovo_duvri['nome_progetto'],
-                json.dumps(nuovo_duvri.get('dati_committente', {})),
-                json.dumps(nuovo_duvri.get('dati_appaltatore', {})),
-                json.dumps(nuovo_duvri.get('signatures', {})),
-                nuovo_duvri['stato'],
-                datetime.now(),
-                datetime.now()
-            )
+            f"INSERT INTO duvri ({', '.join(colonne)}) "
+            f"SELECT {', '.join(valori[colonna] for colonna in colonne)} FROM duvri o WHERE o.id = :originale",
+            {'id': nuovo_id, 'link': str(uuid.uuid4()), 'estar_sha256': estar_legacy,
+             'adesso': adesso, 'originale': duvri_id}
         )
+        for allegato in allegati:
+            allegato.update(id=str(uuid.uuid4())[:8], duvri_id=nuovo_id)
+            conn.execute(
+                f"INSERT INTO allegati ({', '.join(allegato)}) VALUES ({', '.join('?' * len(allegato))})",
+                list(allegato.values())
+            )
+        for sha256 in blob_condivisi:
+            conn.execute('UPDATE blob_upload SET riferimenti = riferimenti + 1 WHERE sha256 = ?', (sha256,))
+        extra_costo = conn.execute('''
+            SELECT importo, descrizione FROM extra_costi_sicurezza
+            WHERE duvri_id = ? ORDER BY created_at DESC LIMIT 1
+        ''', (duvri_id,)).fetchone()
+        if extra_costo:
+            conn.execute('''
+                INSERT INTO extra_costi_sicurezza
+                (id, duvri_id, importo, descrizione, stato, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'rilevato', ?, ?)
+            ''', (str(uuid.uuid4())[:8], nuovo_id, extra_costo['importo'], extra_costo['descrizione'], adesso, adesso))
         conn.commit()
+    finally:
         conn.close()
 
-        # 3. Imposta come DUVRI corrente
+    registra_revisione(nuovo_id)
+    print(f"📑 DUVRI {duvri_id} duplicato in {nuovo_id} ({len(allegati)} allegati condivisi)")
+    return nuovo_id
+
+@app.route('/duplica_duvri/<duvri_id>')
+def duplica_duvri(duvri_id):
+    """
+    Duplica un DUVRI esistente con un nuovo ID e link univoco
+    """
+    try:
+        nuovo_id = copia_duvri(duvri_id)
+        if not nuovo_id:
+            flash('DUVRI non trovato.', 'danger')
+            return redirect(url_for('admin_dashboard'))
+
+        # Imposta come DUVRI corrente (la dashboard lo carica in memoria)
         session['current_duvri_id'] = nuovo_id
 
+        nome_originale = duvri_list.get(duvri_id, {}).get('nome_progetto', 'DUVRI senza nome')
         flash(f'DUVRI "{nome_originale}" duplicato con successo con tutti i dati!', 'success')
 
     except Exception as e:
@@ -2709,263 +3640,3415 @@ def sign(role):
     flash(f"Firma registrata per {role}")
     return redirect(url_for("summary"))
 
-@app.route("/pdf")
-def generate_pdf():
-    """Genera PDF del DUVRI - VERSIONE CON DEBUG COMPLETO"""
-    print("\n" + "="*80)
-    print("🚀 INIZIO GENERAZIONE PDF")
-    print("="*80)
+# =============================================
+# DOWNLOAD FILE (CACHE HTTP, RANGE, OFFLOAD)
+# =============================================
+# Tutti i download passano da invia_file: richieste condizionali
+# (ETag / Last-Modified), Range per riprendere download interrotti e
+# Cache-Control per tipo di file. Con DOWNLOAD_OFFLOAD il file viene
+# trasferito dal web server frontale (X-Sendfile o X-Accel-Redirect).
+POLITICHE_CACHE_DOWNLOAD = {
+    # Documenti di riferimento ESTAR e paragrafi: cambiano solo con una nuova revisione
+    'riferimento': 'public, max-age=86400',
+    # Un allegato non cambia contenuto a parità di ID (un nuovo upload crea un nuovo ID)
+    'allegato': 'private, max-age=86400',
+    # PDF generati, firmati e caricati: sempre rivalidati, la rivalidazione costa un 304
+    'artefatto': 'private, no-cache',
+    'firmato': 'private, no-cache',
+    'caricato': 'private, no-cache',
+    # Miniatura di un allegato: come l'allegato, non cambia a parità di ID
+    'miniatura': 'private, max-age=31536000, immutable'
+}
+
+def invia_file(filepath, tipo, download_name=None, as_attachment=True, mimetype=None, etag=True):
+    """
+    Invia un file con validatori HTTP, supporto Range e politica di cache del tipo
+
+    Args:
+        tipo: chiave di POLITICHE_CACHE_DOWNLOAD
+        etag: ETag forte già noto (es. hash del contenuto), True per calcolarlo dal file
+    """
+    filepath = os.path.join(BASE_DIR, filepath)
+    modalita = app.config.get('DOWNLOAD_OFFLOAD')
+    interno = os.path.relpath(filepath, BASE_DIR)
+    if modalita == 'x-accel' and interno.startswith('..'):
+        # Fuori dalla cartella esposta al web server: trasferimento dal worker
+        modalita = None
+
+    environ = request.environ
+    if modalita:
+        # Con l'offload i Range sono gestiti dal web server sul file completo
+        environ = {k: v for k, v in environ.items() if k not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+
+    response = werkzeug_send_file(
+        filepath,
+        environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag,
+        use_x_sendfile=bool(modalita),
+        response_class=app.response_class
+    )
+
+    if modalita == 'x-accel' and response.headers.get('X-Sendfile'):
+        del response.headers['X-Sendfile']
+        prefisso = app.config.get('DOWNLOAD_ACCEL_PREFISSO', '/_protetto/')
+        response.headers['X-Accel-Redirect'] = prefisso.rstrip('/') + '/' + interno.replace(os.sep, '/')
+
+    response.headers['Cache-Control'] = POLITICHE_CACHE_DOWNLOAD[tipo]
+    return response
+
+
+# =============================================
+# REGISTRO ARTEFATTI GENERATI
+# =============================================
+# I PDF generati (base, per firma, completo) e gli originali firmati sono
+# salvati una sola volta per contenuto in output/artefatti/<sha[:2]>/<sha>.pdf
+# e indicizzati nella tabella artefatti per (duvri_id, tipo, hash_input).
+# Lo spazio occupato è limitato da ARTEFATTI_BUDGET_MB: oltre il budget
+# vengono rimossi gli artefatti usati meno di recente, mai i firmati.
+ARTEFATTI_FOLDER = os.path.join(BASE_DIR, "output", "artefatti")
+ARTEFATTI_TMP_FOLDER = os.path.join(ARTEFATTI_FOLDER, "tmp")
+TIPI_ARTEFATTO = ('base', 'per_firma', 'completo', 'firmato',
+                  'nota_tecnica', 'prospetto_costi', 'determina', 'clausola')
+
+# Chiavi che cambiano ad ogni salvataggio senza modificare il contenuto del PDF
+_CHIAVI_ESCLUSE_IMPRONTA = {'datetime', 'created_at', 'updated_at'}
+
+def _normalizza_per_impronta(valore):
+    """Rimuove timestamp e oggetti non serializzabili dai dati di input"""
+    if isinstance(valore, dict):
+        return {
+            str(k): _normalizza_per_impronta(v)
+            for k, v in valore.items()
+            if k not in _CHIAVI_ESCLUSE_IMPRONTA
+        }
+    if isinstance(valore, (list, tuple)):
+        return [_normalizza_per_impronta(v) for v in valore]
+    return valore
+
+def impronta_template(nome_template):
+    """Versione di un template PDF e dei frammenti condivisi in templates/pdf"""
+    cartella_frammenti = os.path.join(app.template_folder, 'pdf')
+    file_coinvolti = [os.path.join(app.template_folder, nome_template)] + [
+        os.path.join(cartella_frammenti, nome) for nome in sorted(os.listdir(cartella_frammenti))
+    ]
+    return ';'.join(_impronta_file(filepath) for filepath in file_coinvolti)
+
+def impronta_input_pdf(duvri_id, dati_pdf):
+    """
+    Hash degli input che determinano il PDF di un DUVRI
+
+    Comprende i dati del template, la versione del template, gli allegati PDF
+    inclusi e il documento da cui sono estratti i paragrafi dei rischi.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(_normalizza_per_impronta(dati_pdf), sort_keys=True, default=str).encode('utf-8'))
+    h.update(impronta_template('pdf_template.html').encode('utf-8'))
+    for allegato in get_allegati_list(duvri_id):
+        if allegato['mime_type'] == 'application/pdf' and allegato['preflight'] == 'ok':
+            h.update(f"{allegato['nome_originale']}:{allegato['sha256']}".encode('utf-8'))
+    if app.config.get('ALLEGA_PARAGRAFI_RISCHI') and os.path.exists(PDF_RIFERIMENTO_PARAGRAFI):
+        h.update(_impronta_file(PDF_RIFERIMENTO_PARAGRAFI).encode('utf-8'))
+    return h.hexdigest()
+
+def percorso_temporaneo_artefatto(suffisso='.pdf'):
+    """Percorso univoco dove generare un PDF prima di registrarlo"""
+    os.makedirs(ARTEFATTI_TMP_FOLDER, exist_ok=True)
+    return os.path.join(ARTEFATTI_TMP_FOLDER, f"{uuid.uuid4().hex}{suffisso}")
+
+def salva_artefatto(duvri_id, tipo, sorgente_path, hash_input=None, motore=None, sposta=True):
+    """
+    Registra un file generato nel registro artefatti
+
+    Il file viene spostato (o copiato, se sposta=False) nello store per
+    contenuto: due artefatti identici occupano un solo blob su disco.
+
+    Returns:
+        dict: record dell'artefatto registrato
+    """
+    if tipo not in TIPI_ARTEFATTO:
+        raise ValueError(f"Tipo artefatto non valido: {tipo}")
+
+    sha256 = calcola_sha256(sorgente_path)
+    blob_path = os.path.join(ARTEFATTI_FOLDER, sha256[:2], f"{sha256}.pdf")
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    if os.path.exists(blob_path):
+        if sposta:
+            os.remove(sorgente_path)
+    elif sposta:
+        shutil.move(sorgente_path, blob_path)
+    else:
+        shutil.copyfile(sorgente_path, blob_path)
+
+    adesso = datetime.now()
+    artefatto = {
+        'id': str(uuid.uuid4())[:8],
+        'duvri_id': duvri_id,
+        'tipo': tipo,
+        'hash_input': hash_input or sha256,
+        'motore': motore,
+        'dimensione': os.path.getsize(blob_path),
+        'sha256': sha256,
+        'path': blob_path,
+        'created_at': adesso,
+        'last_access': adesso
+    }
+
+    conn = get_db_connection()
+    # Stessi input per lo stesso DUVRI e tipo: il nuovo artefatto sostituisce il precedente
+    precedente = conn.execute(
+        'SELECT id, sha256, path FROM artefatti WHERE duvri_id = ? AND tipo = ? AND hash_input = ?',
+        (duvri_id, tipo, artefatto['hash_input'])
+    ).fetchone()
+    if precedente:
+        conn.execute('DELETE FROM artefatti WHERE id = ?', (precedente['id'],))
+    conn.execute('''
+        INSERT OR REPLACE INTO artefatti
+        (id, duvri_id, tipo, hash_input, motore, dimensione, sha256, path, created_at, last_access)
+        VALUES (:id, :duvri_id, :tipo, :hash_input, :motore, :dimensione, :sha256, :path, :created_at, :last_access)
+    ''', artefatto)
+    if precedente:
+        _rimuovi_blob_se_orfano(conn, precedente['sha256'], precedente['path'])
+    conn.commit()
+    conn.close()
+
+    print(f"🗄️ Artefatto {tipo} registrato per DUVRI {duvri_id}: {sha256[:12]} ({artefatto['dimensione']} bytes)")
+    applica_budget_artefatti()
+    return artefatto
+
+def trova_artefatto(duvri_id, tipo, hash_input=None):
+    """
+    Cerca un artefatto nel registro (tramite indice, senza scansioni del disco)
+
+    Senza hash_input restituisce il più recente del tipo richiesto.
+    """
+    conn = get_db_connection()
+    if hash_input:
+        row = conn.execute(
+            'SELECT * FROM artefatti WHERE duvri_id = ? AND tipo = ? AND hash_input = ?',
+            (duvri_id, tipo, hash_input)
+        ).fetchone()
+    else:
+        row = conn.execute(
+            'SELECT * FROM artefatti WHERE duvri_id = ? AND tipo = ? ORDER BY created_at DESC LIMIT 1',
+            (duvri_id, tipo)
+        ).fetchone()
+
+    if row and not os.path.exists(row['path']):
+        # Blob rimosso a mano: il record non è più valido
+        conn.execute('DELETE FROM artefatti WHERE id = ?', (row['id'],))
+        conn.commit()
+        row = None
+
+    if row:
+        conn.execute('UPDATE artefatti SET last_access = ? WHERE id = ?', (datetime.now(), row['id']))
+        conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+def rimuovi_artefatti_superati(duvri_id, tipo, hash_input):
+    """Elimina gli artefatti del DUVRI generati da input non più attuali"""
+    conn = get_db_connection()
+    superati = conn.execute(
+        'SELECT id, sha256, path FROM artefatti WHERE duvri_id = ? AND tipo = ? AND hash_input != ?',
+        (duvri_id, tipo, hash_input)
+    ).fetchall()
+    for artefatto in superati:
+        conn.execute('DELETE FROM artefatti WHERE id = ?', (artefatto['id'],))
+        _rimuovi_blob_se_orfano(conn, artefatto['sha256'], artefatto['path'])
+    conn.commit()
+    conn.close()
+    return len(superati)
+
+def get_artefatti(duvri_id, tipo):
+    """Tutti gli artefatti di un tipo per il DUVRI, dal più vecchio"""
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT * FROM artefatti WHERE duvri_id = ? AND tipo = ? ORDER BY created_at',
+        (duvri_id, tipo)
+    ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def _rimuovi_blob_se_orfano(conn, sha256, path):
+    """Elimina il blob su disco se nessun artefatto lo referenzia più"""
+    ancora_usato = conn.execute('SELECT 1 FROM artefatti WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+    if not ancora_usato and os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+def applica_budget_artefatti():
+    """
+    Mantiene lo store artefatti entro ARTEFATTI_BUDGET_MB (LRU)
+
+    Gli originali firmati non vengono mai rimossi.
+
+    Returns:
+        int: byte liberati su disco
+    """
+    budget = app.config.get('ARTEFATTI_BUDGET_MB', 0) * 1024 * 1024
+    if budget <= 0:
+        return 0
 
+    liberati = 0
     try:
-        # STEP 1: Recupero dati
-        print("\n📊 STEP 1: Recupero dati DUVRI")
-        data = get_current_duvri_data()
-        duvri_id = session.get('current_duvri_id', 'unknown')
-        print(f"✅ duvri_id: {duvri_id}")
-        print(f"✅ Dati recuperati: {bool(data)}")
+        conn = get_db_connection()
+        # Spazio reale su disco: ogni blob conta una sola volta
+        occupato = conn.execute(
+            'SELECT COALESCE(SUM(dimensione), 0) FROM (SELECT DISTINCT sha256, dimensione FROM artefatti)'
+        ).fetchone()[0]
+        if occupato <= budget:
+            conn.close()
+            return 0
 
-        # STEP 2: Controllo firme
-        print("\n✍️ STEP 2: Controllo firme")
-        firme = data.get("signatures", {})
-        print(f"📊 Firme presenti: {firme}")
+        candidati = conn.execute(
+            "SELECT id, sha256, path, dimensione FROM artefatti WHERE tipo != 'firmato' ORDER BY last_access"
+        ).fetchall()
+        for candidato in candidati:
+            if occupato <= budget:
+                break
+            conn.execute('DELETE FROM artefatti WHERE id = ?', (candidato['id'],))
+            if _rimuovi_blob_se_orfano(conn, candidato['sha256'], candidato['path']):
+                occupato -= candidato['dimensione']
+                liberati += candidato['dimensione']
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"❌ Errore applicazione budget artefatti: {e}")
 
-        if not (firme.get("committente") and firme.get("appaltatore")):
-            print("❌ BLOCCO: Firme mancanti")
-            flash("❌ Entrambe le parti devono firmare prima di generare il PDF")
-            return redirect(url_for("summary"))
-        print("✅ Firme OK")
+    if liberati:
+        print(f"🧹 Store artefatti: liberati {liberati} bytes (budget {budget} bytes)")
+    return liberati
 
-        # STEP 3: Preparazione nomi file
-        print("\n📝 STEP 3: Preparazione nomi file")
-        nome_ditta = "Ditta"
-        if data.get('appaltatore', {}).get('ragione_sociale'):
-            nome_ditta = data['appaltatore']['ragione_sociale']
-            nome_ditta = "".join(c for c in nome_ditta if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            nome_ditta = nome_ditta.replace(' ', '_')[:30]
-        print(f"✅ Nome ditta sanitizzato: {nome_ditta}")
+def nome_download_duvri(data, suffisso=''):
+    """Nome file descrittivo per il download: DUVRI_<ditta>_<data><suffisso>.pdf"""
+    nome_ditta = "Ditta"
+    if data.get('appaltatore', {}).get('ragione_sociale'):
+        nome_ditta = data['appaltatore']['ragione_sociale']
+        nome_ditta = "".join(c for c in nome_ditta if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        nome_ditta = nome_ditta.replace(' ', '_')[:30]
+    return f"DUVRI_{nome_ditta}_{datetime.now().strftime('%Y-%m-%d')}{suffisso}.pdf"
 
-        data_oggi = datetime.now().strftime('%Y-%m-%d')
-        filename_base = f"DUVRI_{nome_ditta}_{data_oggi}.pdf"
-        filename_completo = f"DUVRI_{nome_ditta}_{data_oggi}_completo.pdf"
-        print(f"✅ Filename base: {filename_base}")
-        print(f"✅ Filename completo: {filename_completo}")
-
-        # STEP 4: Preparazione directory
-        print("\n📁 STEP 4: Preparazione directory output")
-        output_folder = os.path.join(current_app.root_path, "output")
-        print(f"📂 Output folder: {output_folder}")
-        os.makedirs(output_folder, exist_ok=True)
-
-        output_path_base = os.path.join(output_folder, filename_base)
-        output_path_completo = os.path.join(output_folder, filename_completo)
-        print(f"✅ Path PDF base: {output_path_base}")
-        print(f"✅ Path PDF completo: {output_path_completo}")
-
-        # STEP 5: Render HTML
-        # STEP 5: Render HTML
-        print("\n🎨 STEP 5: Rendering template HTML")
-        try:
-        # 🆕 Usa helper unificato per preparare dati PDF
-            dati_pdf = prepara_dati_per_pdf(duvri_id, data)
-            
-            html_content = render_template("pdf_template.html", **dati_pdf)
-            print(f"✅ HTML generato: {len(html_content)} caratteri")
-            # Salva HTML per debug
-            html_debug_path = os.path.join(output_folder, f"DEBUG_{filename_base}.html")
-            with open(html_debug_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
-            print(f"💾 HTML salvato per debug in: {html_debug_path}")
-        except Exception as e:
-            print(f"❌ ERRORE rendering HTML: {str(e)}")
-            raise
 
-        pdf_base_path = None
+# =============================================
+# PDF RIPRODUCIBILI
+# =============================================
+# Con PDF_RIPRODUCIBILE attivo, a parità di input il PDF generato è identico
+# byte per byte: le date nel template e nei metadati sono quelle dell'ultima
+# modifica del DUVRI e l'identificativo del documento deriva dall'impronta
+# degli input. Così il registro artefatti deduplica davvero e l'ETag può
+# essere calcolato prima di generare il documento.
+class OrologioDocumento:
+    """Sostituisce datetime nel contesto del template: now() restituisce la data del documento"""
+
+    def __init__(self, istante):
+        self.istante = istante
+
+    def now(self, tz=None):
+        return self.istante
+
+    def __getattr__(self, nome):
+        return getattr(datetime, nome)
+
+def get_istante_documento(duvri_id):
+    """Data dell'ultima modifica del DUVRI (updated_at), usata come data del documento"""
+    try:
+        conn = get_db_connection()
+        row = conn.execute('SELECT updated_at, created_at FROM duvri WHERE id = ?', (duvri_id,)).fetchone()
+        conn.close()
+        if row:
+            valore = row['updated_at'] or row['created_at']
+            if valore:
+                return datetime.fromisoformat(str(valore)).replace(microsecond=0)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"⚠️ Data documento non disponibile per DUVRI {duvri_id}: {e}")
+    return datetime.now().replace(microsecond=0)
+
+def input_pdf_duvri(duvri_id, data):
+    """
+    Prepara il contesto del template e l'impronta degli input del PDF
+
+    Returns:
+        tuple: (dati_pdf, hash_input)
+    """
+    dati_pdf = prepara_dati_per_pdf(duvri_id, data)
+    if app.config.get('PDF_RIPRODUCIBILE'):
+        istante = get_istante_documento(duvri_id)
+        dati_pdf['datetime'] = OrologioDocumento(istante)
+        dati_pdf['istante_documento'] = istante.isoformat()
+    return dati_pdf, impronta_input_pdf(duvri_id, dati_pdf)
+
+def scrivi_pdf_riproducibile(merger, output_path, istante, hash_input):
+    """Scrive il PDF con date e identificativo fissati dagli input"""
+    data_pdf = istante.strftime("D:%Y%m%d%H%M%S")
+    merger.add_metadata({
+        '/CreationDate': data_pdf,
+        '/ModDate': data_pdf,
+        '/Producer': 'DUVRI ESTAR'
+    })
+    id_documento = PyPDF2.generic.ByteStringObject(bytes.fromhex(hash_input[:32]))
+    # PyPDF2 non espone un'API pubblica per l'/ID del trailer
+    merger.output._ID = PyPDF2.generic.ArrayObject([id_documento, id_documento])
+    merger.write(output_path)
+
+def normalizza_pdf(pdf_path, istante, hash_input):
+    """Riscrive un PDF generato dal motore con metadati riproducibili"""
+    merger = PyPDF2.PdfMerger()
+    merger.append(pdf_path)
+    temporaneo = pdf_path + '.tmp'
+    scrivi_pdf_riproducibile(merger, temporaneo, istante, hash_input)
+    merger.close()
+    os.replace(temporaneo, pdf_path)
+
+def etag_artefatto(tipo, hash_input):
+    """ETag forte: cambia solo se cambiano il tipo di documento o i suoi input"""
+    return f"{tipo}-{hash_input[:40]}"
+
+def etag_download(artefatto):
+    """ETag con cui servire un artefatto: dagli input se riproducibile, altrimenti dal contenuto"""
+    if app.config.get('PDF_RIPRODUCIBILE'):
+        return etag_artefatto(artefatto['tipo'], artefatto['hash_input'])
+    return artefatto['sha256']
+
+def risposta_non_modificata(etag):
+    """Risposta 304 per un client che ha già la versione corrente del documento"""
+    response = make_response('', 304)
+    response.set_etag(etag)
+    return response
+
+
+# =============================================
+# OTTIMIZZAZIONE PDF
+# =============================================
+# I PDF uniti incorporano così come sono le scansioni degli allegati e dei
+# paragrafi: prima della registrazione vengono riscritti con object stream e
+# xref stream compressi, le immagini e i font identici presenti in più
+# documenti uniti sono tenuti una volta sola e, se configurato, le immagini
+# scansionate oltre PDF_OTTIMIZZAZIONE_DPI vengono ridotte. I PDF firmati non
+# passano mai da qui: qualsiasi riscrittura invaliderebbe la firma.
+TIPI_ESENTI_OTTIMIZZAZIONE = {'firmato'}
+
+def _flusso_deduplicabile(obj):
+    """Immagini e file dei font incorporati (i flussi che pesano nei PDF uniti)"""
+    if obj.get('/Subtype') == pikepdf.Name.Image:
+        return True
+    return any(chiave in obj.stream_dict for chiave in ('/Length1', '/Length2', '/Length3')) or \
+        obj.get('/Subtype') in (pikepdf.Name('/Type1C'), pikepdf.Name('/CIDFontType0C'), pikepdf.Name('/OpenType'))
+
+def _sostituisci_riferimenti(contenitore, sostituzioni):
+    """Punta alla copia canonica i riferimenti ai flussi duplicati, anche negli oggetti diretti annidati"""
+    if isinstance(contenitore, pikepdf.Dictionary):
+        voci = [(chiave, contenitore.get(chiave)) for chiave in contenitore.keys()]
+    elif isinstance(contenitore, pikepdf.Array):
+        voci = list(enumerate(contenitore))
+    else:
+        return
+
+    for chiave, valore in voci:
+        if not isinstance(valore, pikepdf.Object):
+            continue
+        if valore.is_indirect:
+            if valore.objgen in sostituzioni:
+                contenitore[chiave] = sostituzioni[valore.objgen]
+        else:
+            _sostituisci_riferimenti(valore, sostituzioni)
+
+def _deduplica_flussi(pdf):
+    """Sostituisce i riferimenti a immagini e font duplicati con un'unica copia"""
+    rimossi = 0
+    # Più passaggi: una volta unificate le SMask anche le immagini che le usano diventano identiche
+    for _ in range(3):
+        canonici, sostituzioni = {}, {}
+        for obj in pdf.objects:
+            if not isinstance(obj, pikepdf.Stream) or not _flusso_deduplicabile(obj):
+                continue
+            chiave = (
+                hashlib.sha256(obj.read_raw_bytes()).hexdigest(),
+                pikepdf.Dictionary({k: v for k, v in obj.stream_dict.items() if k != '/Length'}).unparse()
+            )
+            if chiave in canonici:
+                sostituzioni[obj.objgen] = canonici[chiave]
+            else:
+                canonici[chiave] = obj
+        if not sostituzioni:
+            break
+
+        for obj in pdf.objects:
+            _sostituisci_riferimenti(obj.stream_dict if isinstance(obj, pikepdf.Stream) else obj, sostituzioni)
+        rimossi += len(sostituzioni)
+    return rimossi
 
-        # STEP 6: Tentativo con xhtml2pdf
-        print("\n🔧 STEP 6: Tentativo generazione con xhtml2pdf")
-        print(f"📊 xhtml2pdf disponibile: {XHTML2PDF_AVAILABLE}")
+def _riduci_immagini(pdf, dpi_massimo):
+    """
+    Ricampiona le immagini scansionate oltre dpi_massimo
 
-        if XHTML2PDF_AVAILABLE:
+    La risoluzione è stimata per difetto supponendo l'immagine estesa a tutta
+    la pagina; le immagini con maschere, Decode o spazi colore diversi da
+    RGB/grigio restano invariate, così come quelle che non diventano più piccole.
+    """
+    ridotte, viste = 0, set()
+    for pagina in pdf.pages:
+        larghezza_pt = float(pagina.mediabox[2]) - float(pagina.mediabox[0])
+        altezza_pt = float(pagina.mediabox[3]) - float(pagina.mediabox[1])
+        for _, obj in pagina.images.items():
+            if obj.objgen in viste:
+                continue
+            viste.add(obj.objgen)
+            if any(chiave in obj for chiave in ('/SMask', '/Mask', '/Decode', '/ImageMask')):
+                continue
+            if obj.get('/ColorSpace') not in (pikepdf.Name.DeviceRGB, pikepdf.Name.DeviceGray) or obj.get('/BitsPerComponent') != 8:
+                continue
+
+            dpi_stimati = max(int(obj.Width) / (larghezza_pt / 72), int(obj.Height) / (altezza_pt / 72))
+            if dpi_stimati <= dpi_massimo:
+                continue
             try:
-                print("⚙️ Avvio xhtml2pdf...")
-                pdf_bytes = io.BytesIO()
-                pisa_status = pisa.CreatePDF(html_content, dest=pdf_bytes)
-
-                print(f"📊 Pisa status err: {pisa_status.err}")
-                print(f"📊 Pisa status log: {pisa_status.log}")
-
-                if not pisa_status.err:
-                    with open(output_path_base, 'wb') as f:
-                        f.write(pdf_bytes.getvalue())
-                    pdf_base_path = output_path_base
-                    print(f"✅ PDF generato con xhtml2pdf: {output_path_base}")
-                    print(f"📊 Dimensione file: {os.path.getsize(output_path_base)} bytes")
+                immagine = pikepdf.PdfImage(obj).as_pil_image()
+                fattore = dpi_massimo / dpi_stimati
+                immagine = immagine.resize((max(1, round(immagine.width * fattore)), max(1, round(immagine.height * fattore))))
+
+                buffer = io.BytesIO()
+                if obj.get('/Filter') == pikepdf.Name.DCTDecode:
+                    immagine.save(buffer, format='JPEG', quality=85, optimize=True)
+                    filtro = pikepdf.Name.DCTDecode
                 else:
-                    print(f"⚠️ xhtml2pdf ha restituito errori: {pisa_status.err}")
+                    buffer.write(zlib.compress(immagine.tobytes(), 9))
+                    filtro = pikepdf.Name.FlateDecode
+                if buffer.tell() >= len(obj.read_raw_bytes()):
+                    continue
+
+                obj.write(buffer.getvalue(), filter=filtro)
+                obj.Width, obj.Height = immagine.width, immagine.height
+                if '/DecodeParms' in obj:
+                    del obj['/DecodeParms']
+                ridotte += 1
             except Exception as e:
-                print(f"❌ Errore xhtml2pdf: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
+                print(f"⚠️ Immagine {obj.objgen} non ridotta: {e}")
+    return ridotte
 
-                        # STEP 7: Tentativo con WeasyPrint
-        print("\n🔧 STEP 7: Tentativo generazione con WeasyPrint")
-        print(f"📊 WeasyPrint disponibile: {WEASYPRINT_AVAILABLE}")
-        print(f"📊 PDF già generato: {bool(pdf_base_path)}")
+def ottimizza_pdf(pdf_path, tipo):
+    """
+    Riscrive un PDF unito riducendone le dimensioni senza perdita
 
-        if not pdf_base_path and WEASYPRINT_AVAILABLE:
-            try:
-                print("⚙️ Avvio WeasyPrint...")
-                from weasyprint import HTML
-                HTML(string=html_content).write_pdf(target=output_path_base)
-                pdf_base_path = output_path_base
-                print(f"✅ PDF generato con WeasyPrint: {output_path_base}")
-                print(f"📊 Dimensione file: {os.path.getsize(output_path_base)} bytes")
-            except Exception as e:
-                print(f"❌ Errore WeasyPrint: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
-
-        # STEP 8: Verifica PDF generato
-        print("\n🔍 STEP 8: Verifica PDF base")
-        if not pdf_base_path:
-            print("❌ BLOCCO: Nessun motore PDF ha funzionato")
-            flash("❌ Nessun motore PDF funzionante. Installa xhtml2pdf o WeasyPrint.")
-            return redirect(url_for("summary"))
+    Returns:
+        dict: dimensioni prima/dopo, durata e interventi; None se l'ottimizzazione
+              non si applica (disattivata, pikepdf assente, tipo esente o PDF firmato)
+    """
+    if not app.config.get('PDF_OTTIMIZZAZIONE') or not PIKEPDF_AVAILABLE or tipo in TIPI_ESENTI_OTTIMIZZAZIONE:
+        return None
+
+    inizio = time.perf_counter()
+    prima = os.path.getsize(pdf_path)
+    try:
+        with pikepdf.open(pdf_path, allow_overwriting_input=True) as pdf:
+            acroform = pdf.Root.get('/AcroForm')
+            if acroform is not None and int(acroform.get('/SigFlags', 0)) & 1:
+                print(f"⚠️ {os.path.basename(pdf_path)} contiene firme: ottimizzazione saltata")
+                return None
+
+            flussi_duplicati = _deduplica_flussi(pdf)
+            immagini_ridotte = 0
+            if app.config.get('PDF_OTTIMIZZAZIONE_DPI'):
+                immagini_ridotte = _riduci_immagini(pdf, app.config['PDF_OTTIMIZZAZIONE_DPI'])
+            pdf.save(
+                pdf_path,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                deterministic_id=True
+            )
+    except Exception as e:
+        print(f"⚠️ Ottimizzazione di {os.path.basename(pdf_path)} non riuscita: {e}")
+        return None
+
+    esito = {
+        'prima_bytes': prima,
+        'dopo_bytes': os.path.getsize(pdf_path),
+        'durata_ms': round((time.perf_counter() - inizio) * 1000, 1),
+        'flussi_duplicati': flussi_duplicati,
+        'immagini_ridotte': immagini_ridotte
+    }
+    riduzione = 100 * (1 - esito['dopo_bytes'] / prima) if prima else 0
+    print(f"🗜️ PDF ottimizzato: {prima} → {esito['dopo_bytes']} bytes (-{riduzione:.1f}%) in {esito['durata_ms']} ms "
+          f"({flussi_duplicati} duplicati, {immagini_ridotte} immagini ridotte)")
+    return esito
+
+# =============================================
+# STRUMENTAZIONE PIPELINE PDF
+# =============================================
+# Ogni generazione registra i tempi per fase (dati, costi, template, motore,
+# unione, invio), il motore usato e le dimensioni. Le metriche aggregate e le
+# ultime tracce sono esposte su /metriche_pdf; ogni risposta PDF porta
+# l'header Server-Timing e l'id della traccia.
+_metriche_pdf = {'generazioni': 0, 'errori': 0, 'fasi': {}, 'motori': {}}
+_tracce_pdf = deque(maxlen=200)
+_metriche_lock = threading.Lock()
+
+class TracciaPDF:
+    """Tempi e dimensioni per fase di una singola generazione PDF"""
+
+    def __init__(self, operazione, duvri_id):
+        self.id = uuid.uuid4().hex[:12]
+        self.operazione = operazione
+        self.duvri_id = duvri_id
+        self.avviata_il = datetime.now()
+        self.fasi = []
+        self.info = {}
+        self._inizio = time.perf_counter()
+
+    @contextmanager
+    def fase(self, nome):
+        """Misura la durata di una fase della pipeline"""
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.fasi.append((nome, (time.perf_counter() - inizio) * 1000))
+
+    def registra(self, **info):
+        """Aggiunge informazioni alla traccia (motore, dimensioni, ...)"""
+        self.info.update(info)
+
+    def server_timing(self):
+        """Valore dell'header Server-Timing per la risposta"""
+        return ', '.join(f"{nome};dur={ms:.1f}" for nome, ms in self.fasi)
+
+    def chiudi(self, esito='ok'):
+        """Chiude la traccia e aggiorna le metriche aggregate"""
+        traccia = {
+            'id': self.id,
+            'operazione': self.operazione,
+            'duvri_id': self.duvri_id,
+            'avviata_il': self.avviata_il.isoformat(timespec='seconds'),
+            'esito': esito,
+            'totale_ms': round((time.perf_counter() - self._inizio) * 1000, 1),
+            'fasi_ms': {nome: round(ms, 1) for nome, ms in self.fasi},
+            **self.info
+        }
+
+        with _metriche_lock:
+            _tracce_pdf.append(traccia)
+            _metriche_pdf['generazioni'] += 1
+            if esito != 'ok':
+                _metriche_pdf['errori'] += 1
+            for nome, ms in self.fasi:
+                fase = _metriche_pdf['fasi'].setdefault(nome, {'conteggio': 0, 'totale_ms': 0.0, 'max_ms': 0.0})
+                fase['conteggio'] += 1
+                fase['totale_ms'] += ms
+                fase['max_ms'] = max(fase['max_ms'], ms)
+            if self.info.get('motore'):
+                motore = self.info['motore']
+                _metriche_pdf['motori'][motore] = _metriche_pdf['motori'].get(motore, 0) + 1
+
+        print(f"📊 PDF {self.operazione} [{self.id}] DUVRI {self.duvri_id}: {esito} in {traccia['totale_ms']} ms "
+              f"({self.server_timing()})")
+        return traccia
+
+def salva_html_debug(html_content, output_folder, filename_base):
+    """
+    Salva l'HTML renderizzato solo se richiesto
+
+    Attivo con PDF_DEBUG_HTML oppure per una frazione di richieste pari a
+    PDF_DEBUG_CAMPIONAMENTO (0.0 - 1.0).
+    """
+    campionamento = app.config.get('PDF_DEBUG_CAMPIONAMENTO', 0.0)
+    if not (app.config.get('PDF_DEBUG_HTML') or (campionamento > 0 and random.random() < campionamento)):
+        return None
+
+    html_debug_path = os.path.join(output_folder, f"DEBUG_{filename_base}.html")
+    with open(html_debug_path, 'w', encoding='utf-8') as f:
+        f.write(html_content)
+    print(f"💾 HTML salvato per debug in: {html_debug_path}")
+    return html_debug_path
+
+def _pdf_con_xhtml2pdf(html_content, output_path):
+    """Conversione HTML -> PDF con xhtml2pdf; True se riuscita"""
+    if not XHTML2PDF_AVAILABLE:
+        return False
+    try:
+        pdf_bytes = io.BytesIO()
+        pisa_status = pisa.CreatePDF(html_content, dest=pdf_bytes, link_callback=pdf_link_callback)
+        if not pisa_status.err:
+            if hasattr(output_path, 'write'):
+                output_path.write(pdf_bytes.getvalue())
+            else:
+                with open(output_path, 'wb') as f:
+                    f.write(pdf_bytes.getvalue())
+            return True
+        print(f"⚠️ xhtml2pdf ha restituito {pisa_status.err} errori")
+    except Exception as e:
+        print(f"❌ Errore xhtml2pdf: {str(e)}")
+    return False
+
+def _pdf_con_weasyprint(html_content, output_path):
+    """Conversione HTML -> PDF con WeasyPrint; True se riuscita"""
+    if not WEASYPRINT_AVAILABLE:
+        return False
+    try:
+        HTML(string=html_content, url_fetcher=pdf_url_fetcher).write_pdf(output_path)
+        return True
+    except Exception as e:
+        print(f"❌ Errore WeasyPrint: {str(e)}")
+    return False
+
+MOTORI_PDF = {'xhtml2pdf': _pdf_con_xhtml2pdf, 'weasyprint': _pdf_con_weasyprint}
+
+def genera_pdf_da_html(html_content, output_path, preferenza='xhtml2pdf'):
+    """
+    Converte l'HTML in PDF con il primo motore disponibile
+
+    Args:
+        output_path: percorso del file oppure oggetto file (es. BytesIO)
+        preferenza: motore da provare per primo; l'altro resta come ripiego
+
+    Returns:
+        str: nome del motore usato ('xhtml2pdf' o 'weasyprint'), None se nessuno ha funzionato
+    """
+    ordine = [preferenza] + [motore for motore in MOTORI_PDF if motore != preferenza]
+    for motore in ordine:
+        if MOTORI_PDF[motore](html_content, output_path):
+            return motore
+    return None
+
+def risposta_con_traccia(response, traccia):
+    """Aggiunge alla risposta l'id della traccia e l'header Server-Timing"""
+    response.headers['X-Traccia-PDF'] = traccia.id
+    response.headers['Server-Timing'] = traccia.server_timing()
+    return response
+
+@app.route('/metriche_pdf')
+def metriche_pdf():
+    """Metriche aggregate della pipeline PDF e ultime tracce"""
+    with _metriche_lock:
+        fasi = {
+            nome: {
+                'conteggio': fase['conteggio'],
+                'media_ms': round(fase['totale_ms'] / fase['conteggio'], 1),
+                'max_ms': round(fase['max_ms'], 1)
+            }
+            for nome, fase in _metriche_pdf['fasi'].items()
+        }
+        return {
+            'generazioni': _metriche_pdf['generazioni'],
+            'errori': _metriche_pdf['errori'],
+            'motori': dict(_metriche_pdf['motori']),
+            'fasi': fasi,
+            'ultime_tracce': list(_tracce_pdf)[-20:]
+        }
+
+@app.route('/metriche_pdf/<traccia_id>')
+def traccia_pdf(traccia_id):
+    """Dettaglio di una singola traccia di generazione PDF"""
+    with _metriche_lock:
+        for traccia in _tracce_pdf:
+            if traccia['id'] == traccia_id:
+                return traccia
+    return {'errore': 'Traccia non trovata'}, 404
+
+def genera_artefatto_duvri(duvri_id, data, tipo, traccia, input_pdf=None):
+    """
+    Restituisce il PDF del DUVRI unito agli allegati, dal registro se gli input non sono cambiati
+
+    Args:
+        input_pdf: (dati_pdf, hash_input) già calcolati da input_pdf_duvri, se disponibili
+
+    Returns:
+        dict: artefatto registrato (tipo richiesto, oppure 'base' se l'unione è fallita),
+              None se nessun motore PDF è disponibile
+    """
+    if input_pdf is None:
+        with traccia.fase('costi'):
+            input_pdf = input_pdf_duvri(duvri_id, data)
+    dati_pdf, hash_input = input_pdf
+    riproducibile = None
+    if app.config.get('PDF_RIPRODUCIBILE'):
+        riproducibile = (datetime.fromisoformat(dati_pdf['istante_documento']), hash_input)
+
+    with traccia.fase('registro'):
+        artefatto = trova_artefatto(duvri_id, tipo, hash_input)
+    if artefatto:
+        traccia.registra(da_registro=True, pdf_finale_bytes=artefatto['dimensione'])
+        return artefatto
+
+    base_path = percorso_temporaneo_artefatto()
+    motore = genera_pdf_duvri(dati_pdf, base_path, traccia, f"{duvri_id}_{tipo}")
+    if not motore or not os.path.exists(base_path):
+        return None
+    if riproducibile:
+        normalizza_pdf(base_path, *riproducibile)
+    traccia.registra(motore=motore, pdf_base_bytes=os.path.getsize(base_path))
+
+    # Unione con paragrafi e allegati (in caso di errore unisci_pdf_duvri restituisce il PDF base)
+    completo_path = percorso_temporaneo_artefatto()
+    with traccia.fase('unione'):
+        pdf_finale_path = unisci_pdf_duvri(duvri_id, base_path, completo_path, riproducibile)
+    if pdf_finale_path == completo_path:
+        with traccia.fase('ottimizzazione'):
+            ottimizzazione = ottimizza_pdf(completo_path, tipo)
+        if ottimizzazione:
+            traccia.registra(ottimizzazione=ottimizzazione)
+
+    with traccia.fase('salvataggio'):
+        artefatto = salva_artefatto(duvri_id, 'base', base_path, hash_input, motore)
+        if pdf_finale_path == completo_path:
+            artefatto = salva_artefatto(duvri_id, tipo, completo_path, hash_input, motore)
+        # Le versioni generate prima dell'ultima modifica dei dati non servono più
+        for tipo_superato in {'base', artefatto['tipo']}:
+            rimuovi_artefatti_superati(duvri_id, tipo_superato, hash_input)
+    traccia.registra(pdf_finale_bytes=artefatto['dimensione'])
+    return artefatto
+
+# =============================================
+# PRE-RENDER PDF PER FIRMA
+# =============================================
+# Il download per la firma dell'appaltatore è l'operazione più lenta: quando
+# il DUVRI diventa completo il PDF viene generato in background e registrato
+# tra gli artefatti. Ogni modifica successiva cambia l'impronta degli input,
+# quindi la copia pronta viene superata e ne viene pianificata una nuova.
+_coda_prerender = queue.Queue()
+_prerender_in_attesa = set()
+_prerender_lock = threading.Lock()
+_prerender_worker = None
+
+def pianifica_prerender_per_firma(duvri_id):
+    """Accoda la generazione in background del PDF per firma (una sola volta per DUVRI in attesa)"""
+    global _prerender_worker
+
+    if not app.config.get('PRERENDER_PER_FIRMA'):
+        return False
+    if duvri_list.get(duvri_id, {}).get('stato') != 'completato':
+        return False
+
+    with _prerender_lock:
+        if duvri_id in _prerender_in_attesa:
+            return False
+        _prerender_in_attesa.add(duvri_id)
+
+        if _prerender_worker is None or not _prerender_worker.is_alive():
+            _prerender_worker = threading.Thread(target=_esegui_prerender, name='prerender-pdf', daemon=True)
+            _prerender_worker.start()
+
+    _coda_prerender.put(duvri_id)
+    print(f"⏳ Pre-render PDF per firma pianificato per DUVRI {duvri_id}")
+    return True
+
+def _esegui_prerender():
+    """Worker: genera i PDF per firma accodati, leggendo i dati più recenti dal database"""
+    while True:
+        duvri_id = _coda_prerender.get()
+        # Le modifiche arrivate durante la generazione ripianificano il DUVRI
+        with _prerender_lock:
+            _prerender_in_attesa.discard(duvri_id)
+
+        traccia = TracciaPDF('prerender', duvri_id)
+        try:
+            with app.app_context():
+                data = get_duvri_data(duvri_id)
+                artefatto = genera_artefatto_duvri(duvri_id, data, 'per_firma', traccia)
+            traccia.chiudi('ok' if artefatto else 'nessun_motore')
+        except Exception as e:
+            print(f"❌ Errore pre-render PDF per firma DUVRI {duvri_id}: {e}")
+            traccia.chiudi('errore')
+        finally:
+            _coda_prerender.task_done()
+
+# =============================================
+# MINIATURE ALLEGATI
+# =============================================
+# La prima pagina di ogni allegato PDF (o immagine) viene rasterizzata in una
+# miniatura JPEG in cache/miniature/<sha[:2]>/<sha>.jpg. La chiave è l'hash
+# del contenuto: un file sostituito ha una nuova miniatura, lo stesso file su
+# più DUVRI ne ha una sola. Le miniature sono generate da un pool di
+# processi (MuPDF non è thread-safe e un PDF malformato non deve far cadere
+# il worker web); le richieste non le generano mai, al più le accodano.
+# Quando un processo cade tutte le miniature in coda falliscono insieme: sono
+# solo "sospette" e vengono ritentate una alla volta nel pool di isolamento
+# (un solo processo), così finisce nell'elenco delle fallite soltanto il file
+# che causa davvero il crash.
+MINIATURE_CACHE_FOLDER = os.path.join(BASE_DIR, "cache", "miniature")
+MINIATURA_LATO_MAX = 240  # pixel, lato lungo
+
+_pool_miniature = None
+_pool_isolamento = None
+_miniature_isolamento = []  # sospette inviate al pool di isolamento, in ordine di esecuzione
+_miniature_in_attesa = set()
+_miniature_fallite = set()
+_miniature_sospette = set()
+_miniature_lock = threading.Lock()
+
+def percorso_miniatura(sha256):
+    """Percorso in cache della miniatura del contenuto indicato"""
+    return os.path.join(MINIATURE_CACHE_FOLDER, sha256[:2], f"{sha256}.jpg")
+
+def miniatura_supportata(allegato):
+    """True se per l'allegato si può generare una miniatura con le librerie installate"""
+    if not PIL_AVAILABLE:
+        return False
+    if allegato['mime_type'] == 'application/pdf':
+        return PYMUPDF_AVAILABLE and allegato['preflight'] == 'ok'
+    return (allegato['mime_type'] or '').startswith('image/')
+
+def genera_miniatura(sorgente_path, mime_type, destinazione_path):
+    """Rasterizza la prima pagina del PDF (o riduce l'immagine) in una miniatura JPEG"""
+    if mime_type == 'application/pdf':
+        with pymupdf.open(sorgente_path) as documento:
+            pagina = documento[0]
+            scala = MINIATURA_LATO_MAX / max(pagina.rect.width, pagina.rect.height)
+            pixmap = pagina.get_pixmap(matrix=pymupdf.Matrix(scala, scala), alpha=False)
+            immagine = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    else:
+        with Image.open(sorgente_path) as originale:
+            # Per i JPEG la decodifica avviene direttamente a risoluzione ridotta
+            originale.draft('RGB', (MINIATURA_LATO_MAX, MINIATURA_LATO_MAX))
+            immagine = originale.convert('RGB')
+        immagine.thumbnail((MINIATURA_LATO_MAX, MINIATURA_LATO_MAX))
+
+    os.makedirs(os.path.dirname(destinazione_path), exist_ok=True)
+    tmp_path = f"{destinazione_path}.{uuid.uuid4().hex}.tmp"
+    immagine.save(tmp_path, 'JPEG', quality=80, optimize=True)
+    os.replace(tmp_path, destinazione_path)
+    return os.path.getsize(destinazione_path)
+
+def pianifica_miniatura(allegato):
+    """Accoda la miniatura dell'allegato se non è già in cache, in coda o fallita"""
+    global _pool_miniature, _pool_isolamento
+
+    if not app.config.get('MINIATURE_ALLEGATI') or not miniatura_supportata(allegato):
+        return False
+    sha256 = allegato['sha256']
+    if os.path.exists(percorso_miniatura(sha256)):
+        return False
+
+    inizio = time.perf_counter()
+    with _miniature_lock:
+        if sha256 in _miniature_in_attesa or sha256 in _miniature_fallite:
+            return False
+        isolato = sha256 in _miniature_sospette
+        if isolato:
+            # Coinvolta in un crash: ritentata nel pool con un solo processo
+            if _pool_isolamento is None:
+                _pool_isolamento = ProcessPoolExecutor(max_workers=1)
+            pool = _pool_isolamento
+        else:
+            if _pool_miniature is None:
+                _pool_miniature = ProcessPoolExecutor(max_workers=app.config['MINIATURE_WORKERS'])
+            pool = _pool_miniature
+        try:
+            futuro = pool.submit(genera_miniatura, allegato['path'], allegato['mime_type'],
+                                 percorso_miniatura(sha256))
+        except (BrokenProcessPool, RuntimeError) as e:
+            # Pool caduto ma non ancora ricreato dalla callback: la miniatura sarà accodata più avanti
+            if pool is _pool_isolamento:
+                _pool_isolamento = None
+                _miniature_isolamento.clear()
+            elif pool is _pool_miniature:
+                _pool_miniature = None
+            print(f"⚠️ Pool miniature non disponibile per {sha256[:12]}: {e}")
+            return False
+        _miniature_in_attesa.add(sha256)
+        if isolato:
+            _miniature_isolamento.append(sha256)
+
+    futuro.add_done_callback(lambda f: _miniatura_completata(sha256, f, inizio, pool, isolato))
+    return True
+
+def _miniatura_completata(sha256, futuro, inizio, pool, isolato):
+    """Callback del pool: registra l'esito e ricrea il pool se un processo è caduto"""
+    global _pool_miniature, _pool_isolamento
+
+    with _miniature_lock:
+        _miniature_in_attesa.discard(sha256)
+        try:
+            dimensione = futuro.result()
+            _miniature_sospette.discard(sha256)
+            print(f"🖼️ Miniatura {sha256[:12]} generata in {(time.perf_counter() - inizio) * 1000:.0f} ms ({dimensione} bytes)")
+        except BrokenProcessPool:
+            if isolato and pool is _pool_isolamento:
+                # Con un solo processo il crash è della prima sospetta non ancora completata:
+                # quella non viene più ritentata, le altre restano sospette
+                colpevole = _miniature_isolamento[0] if _miniature_isolamento else sha256
+                _miniature_sospette.discard(colpevole)
+                _miniature_fallite.add(colpevole)
+                _pool_isolamento = None
+                _miniature_isolamento.clear()
+                print(f"❌ Miniatura {colpevole[:12]} fa cadere il processo: non verrà ritentata")
+            elif sha256 not in _miniature_fallite:
+                # Non sappiamo quale file ha causato il crash: verrà riaccodato alla prossima richiesta
+                _miniature_sospette.add(sha256)
+                if pool is _pool_miniature:
+                    _pool_miniature = None
+                    print(f"❌ Pool miniature interrotto durante {sha256[:12]}: verrà ricreato")
+        except Exception as e:
+            _miniature_sospette.discard(sha256)
+            _miniature_fallite.add(sha256)
+            print(f"⚠️ Miniatura non generata per {sha256[:12]}: {e}")
+        if isolato and pool is _pool_isolamento and sha256 in _miniature_isolamento:
+            _miniature_isolamento.remove(sha256)
+
+def rimuovi_miniatura(sha256):
+    """Elimina la miniatura in cache di un contenuto non più caricato"""
+    miniatura_path = percorso_miniatura(sha256)
+    if os.path.exists(miniatura_path):
+        os.remove(miniatura_path)
+
+def aggiungi_miniature(allegati):
+    """Indica per ogni allegato se la miniatura è pronta; quelle mancanti vengono accodate"""
+    for allegato in allegati:
+        allegato['miniatura'] = os.path.exists(percorso_miniatura(allegato['sha256']))
+        allegato['miniatura_in_coda'] = not allegato['miniatura'] and (
+            pianifica_miniatura(allegato) or allegato['sha256'] in _miniature_in_attesa
+        )
+    return allegati
+
+@app.route('/miniatura_allegato/<allegato_id>')
+def miniatura_allegato(allegato_id):
+    """Miniatura di un allegato dalla cache (mai generata durante la richiesta)"""
+    allegato = get_allegato(session.get('current_duvri_id'), allegato_id)
+    if not allegato:
+        return "Allegato non trovato", 404
+
+    miniatura_path = percorso_miniatura(allegato['sha256'])
+    if not os.path.exists(miniatura_path):
+        pianifica_miniatura(allegato)
+        return "Miniatura non ancora disponibile", 404
+
+    return invia_file(miniatura_path, 'miniatura', as_attachment=False,
+                      mimetype='image/jpeg', etag=allegato['sha256'])
+
+# =============================================
+# RICERCA FULL-TEXT
+# =============================================
+# Indice FTS5 su dati dei DUVRI e testo dei PDF caricati. La tabella
+# ricerca_contenuti contiene i documenti indicizzati ('duvri' per id DUVRI,
+# 'testo' per sha256 del file caricato) e l'indice ricerca la usa come
+# contenuto esterno. Le righe 'duvri' sono aggiornate da trigger sulla
+# tabella duvri, quindi ogni salvataggio le mantiene allineate senza codice
+# nelle route; il testo dei PDF viene estratto da un worker in background
+# una sola volta per contenuto (lo stesso certificato su più DUVRI è
+# indicizzato una volta e trovato su tutti).
+RICERCA_MAX_PAGINE = 200
+RICERCA_MAX_CARATTERI = 500_000
+RICERCA_MAX_RISULTATI = 50
+
+# Marcatori di evidenziazione: caratteri di controllo che non compaiono nel testo
+_INIZIO_EVIDENZIA, _FINE_EVIDENZIA = '\x02', '\x03'
+
+_coda_estrazione = queue.Queue()
+_estrazioni_in_attesa = set()
+_estrazione_lock = threading.Lock()
+_estrazione_worker = None
+
+def _fts5_disponibile():
+    """True se la libreria SQLite in uso è compilata con FTS5"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('CREATE VIRTUAL TABLE prova USING fts5(testo)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+FTS5_AVAILABLE = _fts5_disponibile()
+
+def _sql_testo_json(colonna):
+    """Espressione SQL che concatena tutti i valori testuali del JSON in colonna"""
+    return (f"(SELECT group_concat(value, ' ') FROM json_tree("
+            f"CASE WHEN json_valid({colonna}) THEN {colonna} ELSE '{{}}' END) WHERE type = 'text')")
+
+def _sql_sezione_risolta(riga, sezione):
+    """Sezione JSON del DUVRI, anche se condivisa con il DUVRI da cui è stato duplicato"""
+    return f"coalesce({riga}.{sezione}_data, (SELECT {sezione}_data FROM duvri WHERE id = {riga}.{sezione}_da))"
+
+def _sql_testo_duvri(riga):
+    """Testo indicizzato di un DUVRI: valori dei dati committente e appaltatore"""
+    return (f"trim(coalesce({_sql_testo_json(_sql_sezione_risolta(riga, 'committente'))}, '') || ' ' || "
+            f"coalesce({_sql_testo_json(_sql_sezione_risolta(riga, 'appaltatore'))}, ''))")
+
+def crea_tabelle_ricerca(conn, schema='main'):
+    """Tabella dei contenuti e indice FTS5 con i trigger di sincronizzazione (anche nell'archivio)"""
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.ricerca_contenuti (
+            id INTEGER PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            chiave TEXT NOT NULL,
+            titolo TEXT,
+            testo TEXT,
+            UNIQUE(tipo, chiave)
+        )
+    ''')
+    if not FTS5_AVAILABLE:
+        return
+
+    nuovo_indice = not conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'ricerca'"
+    ).fetchone()
+    conn.executescript(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.ricerca USING fts5(
+            titolo, testo,
+            content = 'ricerca_contenuti', content_rowid = 'id',
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS {schema}.ricerca_contenuti_ai AFTER INSERT ON ricerca_contenuti BEGIN
+            INSERT INTO ricerca (rowid, titolo, testo) VALUES (NEW.id, NEW.titolo, NEW.testo);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {schema}.ricerca_contenuti_ad AFTER DELETE ON ricerca_contenuti BEGIN
+            INSERT INTO ricerca (ricerca, rowid, titolo, testo) VALUES ('delete', OLD.id, OLD.titolo, OLD.testo);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {schema}.ricerca_contenuti_au AFTER UPDATE ON ricerca_contenuti BEGIN
+            INSERT INTO ricerca (ricerca, rowid, titolo, testo) VALUES ('delete', OLD.id, OLD.titolo, OLD.testo);
+            INSERT INTO ricerca (rowid, titolo, testo) VALUES (NEW.id, NEW.titolo, NEW.testo);
+        END;
+    ''')
+    if nuovo_indice:
+        # Il nome progetto pesa più del testo; il ranking resta nella configurazione dell'indice
+        conn.execute(f"INSERT INTO {schema}.ricerca (ricerca, rank) VALUES ('rank', 'bm25(5.0, 1.0)')")
+        conn.execute(f"INSERT INTO {schema}.ricerca (ricerca) VALUES ('rebuild')")
+
+def crea_indice_ricerca(conn):
+    """Crea tabelle, indice FTS5 e trigger di sincronizzazione, e indicizza i DUVRI mancanti"""
+    crea_tabelle_ricerca(conn)
+
+    # I trigger sui DUVRI sono ricreati a ogni avvio, così seguono le modifiche al testo indicizzato
+    conn.executescript(f'''
+        DROP TRIGGER IF EXISTS ricerca_duvri_ai;
+        DROP TRIGGER IF EXISTS ricerca_duvri_au;
+        DROP TRIGGER IF EXISTS ricerca_duvri_ad;
+
+        CREATE TRIGGER ricerca_duvri_ai AFTER INSERT ON duvri BEGIN
+            INSERT INTO ricerca_contenuti (tipo, chiave, titolo, testo)
+            VALUES ('duvri', NEW.id, NEW.nome_progetto, {_sql_testo_duvri('NEW')})
+            ON CONFLICT(tipo, chiave) DO UPDATE SET titolo = excluded.titolo, testo = excluded.testo;
+        END;
+
+        CREATE TRIGGER ricerca_duvri_au AFTER UPDATE OF nome_progetto, committente_data, appaltatore_data ON duvri
+        WHEN NEW.nome_progetto IS NOT OLD.nome_progetto
+          OR NEW.committente_data IS NOT OLD.committente_data
+          OR NEW.appaltatore_data IS NOT OLD.appaltatore_data
+        BEGIN
+            INSERT INTO ricerca_contenuti (tipo, chiave, titolo, testo)
+            VALUES ('duvri', NEW.id, NEW.nome_progetto, {_sql_testo_duvri('NEW')})
+            ON CONFLICT(tipo, chiave) DO UPDATE SET titolo = excluded.titolo, testo = excluded.testo;
+        END;
+
+        CREATE TRIGGER ricerca_duvri_ad AFTER DELETE ON duvri BEGIN
+            DELETE FROM ricerca_contenuti WHERE tipo = 'duvri' AND chiave = OLD.id;
+        END;
+    ''')
+
+    # DUVRI creati prima dell'indice (o eliminati senza trigger)
+    conn.execute(f'''
+        INSERT INTO ricerca_contenuti (tipo, chiave, titolo, testo)
+        SELECT 'duvri', d.id, d.nome_progetto, {_sql_testo_duvri('d')} FROM duvri d
+        WHERE d.id NOT IN (SELECT chiave FROM ricerca_contenuti WHERE tipo = 'duvri')
+    ''')
+    conn.execute('''
+        DELETE FROM ricerca_contenuti
+        WHERE tipo = 'duvri' AND chiave NOT IN (SELECT id FROM duvri)
+    ''')
+    conn.commit()
+
+def estrai_testo(filepath):
+    """Testo di un PDF (o DOCX) caricato, entro RICERCA_MAX_PAGINE e RICERCA_MAX_CARATTERI"""
+    with open(filepath, 'rb') as f:
+        intestazione = f.read(4)
+
+    parti, caratteri = [], 0
+    if intestazione == b'%PDF':
+        reader = PyPDF2.PdfReader(filepath)
+        if reader.is_encrypted:
+            return ''
+        for pagina in reader.pages[:RICERCA_MAX_PAGINE]:
+            testo = pagina.extract_text() or ''
+            parti.append(testo)
+            caratteri += len(testo)
+            if caratteri >= RICERCA_MAX_CARATTERI:
+                break
+    elif intestazione.startswith(b'PK') and zipfile.is_zipfile(filepath):
+        # DUVRI ESTAR in formato Word: il testo è nei nodi <w:t> di word/document.xml
+        with zipfile.ZipFile(filepath) as docx:
+            if 'word/document.xml' in docx.namelist():
+                xml = docx.read('word/document.xml').decode('utf-8', errors='ignore')
+                parti = re.findall(r'<w:t(?:\s[^>]*)?>([^<]*)</w:t>', xml)
+
+    return re.sub(r'\s+', ' ', ' '.join(parti)).strip()[:RICERCA_MAX_CARATTERI]
+
+def testo_indicizzato(conn, sha256):
+    """True se il contenuto è già stato elaborato dal worker di estrazione"""
+    return conn.execute(
+        "SELECT 1 FROM ricerca_contenuti WHERE tipo = 'testo' AND chiave = ?", (sha256,)
+    ).fetchone() is not None
+
+def indicizza_testo(sha256, filepath):
+    """Estrae il testo del file e lo registra nell'indice (una riga vuota se non contiene testo)"""
+    inizio = time.perf_counter()
+    try:
+        testo = estrai_testo(filepath)
+    except Exception as e:
+        # Registrato comunque come elaborato: un file illeggibile non viene ritentato a ogni avvio
+        print(f"⚠️ Estrazione testo fallita per {sha256[:12]}: {e}")
+        testo = ''
+
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO ricerca_contenuti (tipo, chiave, titolo, testo) VALUES ('testo', ?, NULL, ?)
+            ON CONFLICT(tipo, chiave) DO UPDATE SET testo = excluded.testo
+        ''', (sha256, testo))
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"🔎 Testo indicizzato per {sha256[:12]}: {len(testo)} caratteri in {(time.perf_counter() - inizio) * 1000:.0f} ms")
+    return len(testo)
+
+def pianifica_estrazione_testo(sha256, filepath):
+    """Accoda l'estrazione del testo di un file caricato (una sola volta per contenuto)"""
+    global _estrazione_worker
+
+    with _estrazione_lock:
+        if sha256 in _estrazioni_in_attesa:
+            return False
+        _estrazioni_in_attesa.add(sha256)
+
+        if _estrazione_worker is None or not _estrazione_worker.is_alive():
+            _estrazione_worker = threading.Thread(target=_esegui_estrazioni, name='estrazione-testo', daemon=True)
+            _estrazione_worker.start()
+
+    _coda_estrazione.put((sha256, filepath))
+    return True
+
+def _esegui_estrazioni():
+    """Worker: indicizza il testo dei file accodati che non sono già nell'indice"""
+    while True:
+        sha256, filepath = _coda_estrazione.get()
+        try:
+            conn = get_db_connection()
+            gia_indicizzato = testo_indicizzato(conn, sha256)
+            conn.close()
+            # Il blob potrebbe essere stato rilasciato mentre era in coda
+            if not gia_indicizzato and os.path.exists(filepath):
+                indicizza_testo(sha256, filepath)
+        except Exception as e:
+            print(f"❌ Errore indicizzazione testo {sha256[:12]}: {e}")
+        finally:
+            with _estrazione_lock:
+                _estrazioni_in_attesa.discard(sha256)
+            _coda_estrazione.task_done()
+
+def pianifica_testi_mancanti():
+    """Accoda l'estrazione dei file caricati prima dell'indice o rimasti in coda alla chiusura"""
+    conn = get_db_connection()
+    indicizzati = {row['chiave'] for row in conn.execute(
+        "SELECT chiave FROM ricerca_contenuti WHERE tipo = 'testo'"
+    )}
+    caricati = conn.execute('''
+        SELECT sha256, path FROM allegati WHERE mime_type = 'application/pdf' AND preflight = 'ok'
+        UNION ALL
+        SELECT sha256, path FROM firme_digitali
+        UNION ALL
+        SELECT duvri_estar_sha256, NULL FROM duvri WHERE duvri_estar_sha256 IS NOT NULL
+    ''').fetchall()
+    conn.close()
+
+    mancanti = {}
+    for row in caricati:
+        if row['sha256'] and row['sha256'] not in indicizzati:
+            mancanti.setdefault(row['sha256'], row['path'] or percorso_blob_upload(row['sha256']))
+
+    for sha256, filepath in mancanti.items():
+        pianifica_estrazione_testo(sha256, filepath)
+    if mancanti:
+        print(f"🔎 Accodata l'estrazione del testo di {len(mancanti)} file caricati")
+    return len(mancanti)
+
+def prepara_query_fts(testo):
+    """
+    Converte il testo digitato in una query FTS5
+
+    Le frasi tra virgolette restano frasi esatte, ogni altra parola è cercata
+    come prefisso ("sicur" trova "sicurezza"). Tutti i termini devono comparire.
+    """
+    termini = []
+    for frase, parola in re.findall(r'"([^"]*)"|(\S+)', testo or ''):
+        if frase and re.search(r'\w', frase):
+            termini.append('"' + frase.replace('"', '""') + '"')
+        elif parola and re.search(r'\w', parola):
+            termini.append('"' + parola.replace('"', '""') + '"*')
+    return ' '.join(termini) or None
+
+def _evidenzia(testo):
+    """HTML sicuro con i termini trovati racchiusi in <mark>"""
+    return Markup(str(Markup.escape(testo or ''))
+                  .replace(_INIZIO_EVIDENZIA, '<mark>')
+                  .replace(_FINE_EVIDENZIA, '</mark>'))
+
+def _cerca_nello_schema(conn, schema, query, limite):
+    """Risultati per DUVRI dall'indice dello schema ('main' per i DUVRI attivi, 'archivio' per gli archiviati)"""
+    righe = conn.execute(f'''
+        SELECT c.tipo, c.chiave, rank AS punteggio,
+               highlight(ricerca, 0, ?, ?) AS titolo,
+               snippet(ricerca, 1, ?, ?, '…', 16) AS estratto
+        FROM {schema}.ricerca JOIN {schema}.ricerca_contenuti c ON c.id = ricerca.rowid
+        WHERE ricerca MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    ''', (_INIZIO_EVIDENZIA, _FINE_EVIDENZIA, _INIZIO_EVIDENZIA, _FINE_EVIDENZIA,
+          query, limite * 4)).fetchall()
+
+    # I file trovati appartengono a uno o più DUVRI (allegato, firma o DUVRI ESTAR)
+    sha_trovati = [r['chiave'] for r in righe if r['tipo'] == 'testo']
+    fonti = {}
+    if sha_trovati:
+        segnaposti = ','.join('?' * len(sha_trovati))
+        for row in conn.execute(f'''
+            SELECT sha256, duvri_id, 'Allegato: ' || nome_originale AS fonte FROM {schema}.allegati WHERE sha256 IN ({segnaposti})
+            UNION ALL
+            SELECT sha256, duvri_id, 'PDF firmato ' || ruolo || ': ' || nome_file FROM {schema}.firme_digitali WHERE sha256 IN ({segnaposti})
+            UNION ALL
+            SELECT duvri_estar_sha256, id, 'DUVRI ESTAR: ' || duvri_estar_filename FROM {schema}.duvri WHERE duvri_estar_sha256 IN ({segnaposti})
+        ''', sha_trovati * 3):
+            fonti.setdefault(row['sha256'], []).append((row['duvri_id'], row['fonte']))
+
+    risultati = {}
+    for riga in righe:
+        if riga['tipo'] == 'duvri':
+            corrispondenze = [(riga['chiave'], 'Dati DUVRI')]
+        else:
+            corrispondenze = fonti.get(riga['chiave'], [])
+        for duvri_id, fonte in corrispondenze:
+            risultato = risultati.setdefault(duvri_id, {
+                'id': duvri_id, 'punteggio': riga['punteggio'], 'corrispondenze': [],
+                'archiviato': schema == 'archivio'
+            })
+            risultato['punteggio'] = min(risultato['punteggio'], riga['punteggio'])
+            if riga['tipo'] == 'duvri':
+                risultato['titolo'] = _evidenzia(riga['titolo'])
+            risultato['corrispondenze'].append({'fonte': fonte, 'estratto': _evidenzia(riga['estratto'])})
+
+    if risultati:
+        segnaposti = ','.join('?' * len(risultati))
+        for row in conn.execute(f'''
+            SELECT id, nome_progetto, stato FROM {schema}.duvri
+            WHERE id IN ({segnaposti}) AND eliminato_il IS NULL
+        ''', list(risultati)):
+            risultati[row['id']].update(nome_progetto=row['nome_progetto'], stato=row['stato'])
+    return risultati
+
+def cerca_duvri(testo, limite=RICERCA_MAX_RISULTATI):
+    """
+    Cerca nei dati dei DUVRI e nel testo dei file caricati, attivi e archiviati
+
+    Returns:
+        list: un dict per DUVRI (id, nome_progetto, stato, punteggio, corrispondenze,
+        archiviato), ordinati per rilevanza; i DUVRI che corrispondono su più
+        fonti tengono il punteggio migliore
+    """
+    query = prepara_query_fts(testo)
+    if not query or not FTS5_AVAILABLE:
+        return []
+
+    conn = get_db_connection()
+    try:
+        risultati = _cerca_nello_schema(conn, 'main', query, limite)
+        for duvri_id, risultato in _cerca_nello_schema(conn, 'archivio', query, limite).items():
+            risultati.setdefault(duvri_id, risultato)
+    finally:
+        conn.close()
+
+    # Solo i DUVRI esistenti e non eliminati (un file può essere ancora referenziato da righe orfane)
+    ordinati = sorted((r for r in risultati.values() if 'stato' in r), key=lambda r: r['punteggio'])
+    return ordinati[:limite]
+
+@app.route('/ricerca')
+def ricerca():
+    """Ricerca full-text nei DUVRI e nei documenti caricati (?formato=json per le chiamate AJAX)"""
+    testo = request.args.get('q', '').strip()
+    inizio = time.perf_counter()
+    risultati = cerca_duvri(testo) if testo else []
+    durata_ms = (time.perf_counter() - inizio) * 1000
+
+    if request.args.get('formato') == 'json':
+        return {
+            'query': testo,
+            'durata_ms': round(durata_ms, 2),
+            'risultati': [
+                {
+                    'id': r['id'],
+                    'nome_progetto': r['nome_progetto'],
+                    'stato': r['stato'],
+                    'archiviato': r['archiviato'],
+                    'punteggio': r['punteggio'],
+                    'titolo': str(r.get('titolo') or Markup.escape(r['nome_progetto'] or '')),
+                    'corrispondenze': [{'fonte': c['fonte'], 'estratto': str(c['estratto'])}
+                                       for c in r['corrispondenze']],
+                }
+                for r in risultati
+            ],
+        }
+
+    return render_template('ricerca.html',
+                           query=testo,
+                           risultati=risultati,
+                           durata_ms=durata_ms,
+                           ricerca_disponibile=FTS5_AVAILABLE)
+
+# =============================================
+# GENERAZIONE MASSIVA PDF (CLI)
+# =============================================
+# Per le riemissioni annuali e gli audit `flask --app app duvri render-all`
+# rigenera i PDF dei DUVRI in un pool di processi, senza passare dalla
+# sessione del browser. I DUVRI con un artefatto già aggiornato vengono presi
+# dal registro; al termine un manifest JSON riporta l'esito di ogni documento.
+duvri_cli = AppGroup('duvri', help='Gestione dei DUVRI da riga di comando')
+app.cli.add_command(duvri_cli)
+
+def prepara_capitoli_statici():
+    """Converte i capitoli statici della versione corrente dei template, se non già in cache"""
+    with app.app_context():
+        html_content = render_template(
+            "pdf_template.html",
+            capitoli_separati=True,
+            data={"committente": {}, "appaltatore": {}, "signatures": {}},
+            datetime=datetime,
+            confronto_costi=None,
+            extra_costo=None
+        )
+        apertura, parti = dividi_in_capitoli(html_content)
+        if not apertura:
+            return []
+        return [pdf_capitolo_statico(nome, apertura) for nome in parti[1::2]]
+
+def _genera_pdf_batch(duvri_id, tipo):
+    """Worker del pool: genera (o ritrova nel registro) il PDF di un DUVRI"""
+    voce = {'duvri_id': duvri_id, 'tipo': tipo}
+    traccia = TracciaPDF('batch', duvri_id)
+    try:
+        with app.app_context():
+            data = get_duvri_data(duvri_id)
+            firme = data.get('signatures', {})
+            if tipo == 'completo' and not (firme.get('committente') and firme.get('appaltatore')):
+                traccia.chiudi('firme_mancanti')
+                return {**voce, 'esito': 'saltato', 'motivo': 'firme mancanti'}
+            artefatto = genera_artefatto_duvri(duvri_id, data, tipo, traccia)
+
+        if not artefatto:
+            traccia.chiudi('nessun_motore')
+            return {**voce, 'esito': 'errore', 'motivo': 'nessun motore PDF disponibile'}
+        riepilogo = traccia.chiudi()
+        return {
+            **voce,
+            'esito': 'attuale' if traccia.info.get('da_registro') else 'generato',
+            'tipo': artefatto['tipo'],
+            'artefatto_id': artefatto['id'],
+            'sha256': artefatto['sha256'],
+            'dimensione': artefatto['dimensione'],
+            'path': os.path.relpath(artefatto['path'], BASE_DIR),
+            'durata_ms': riepilogo['totale_ms']
+        }
+    except Exception as e:
+        traccia.chiudi('errore')
+        return {**voce, 'esito': 'errore', 'motivo': str(e)}
+
+@duvri_cli.command('render-all')
+@click.option('--since', 'dal', type=click.DateTime(formats=['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S']),
+              help='Solo i DUVRI modificati da questa data')
+@click.option('--workers', type=click.IntRange(min=1), default=os.cpu_count() or 1, show_default=True,
+              help='Processi in parallelo')
+@click.option('--tipo', type=click.Choice(['completo', 'per_firma']), default='completo', show_default=True,
+              help='PDF da generare (completo richiede entrambe le firme)')
+@click.option('--manifest', 'manifest_path', type=click.Path(dir_okay=False),
+              help='File JSON del manifest (default: output/manifest_render_<data>.json)')
+def render_all(dal, workers, tipo, manifest_path):
+    """Rigenera in parallelo i PDF di tutti i DUVRI"""
+    conn = get_db_connection()
+    if dal:
+        righe = conn.execute('SELECT id FROM duvri WHERE updated_at >= ? AND eliminato_il IS NULL ORDER BY updated_at',
+                             (dal.strftime('%Y-%m-%d %H:%M:%S'),)).fetchall()
+    else:
+        righe = conn.execute('SELECT id FROM duvri WHERE eliminato_il IS NULL ORDER BY updated_at').fetchall()
+    conn.close()
+    duvri_ids = [riga['id'] for riga in righe]
+
+    click.echo(f"🖨️ Generazione PDF '{tipo}' per {len(duvri_ids)} DUVRI con {workers} processi")
+    # I capitoli statici si convertono una volta qui, non in ogni processo
+    prepara_capitoli_statici()
+
+    avviato_il = datetime.now()
+    inizio = time.perf_counter()
+    voci = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuri = {pool.submit(_genera_pdf_batch, duvri_id, tipo): duvri_id for duvri_id in duvri_ids}
+        for futuro in as_completed(futuri):
+            try:
+                voce = futuro.result()
+            except Exception as e:
+                voce = {'duvri_id': futuri[futuro], 'tipo': tipo, 'esito': 'errore', 'motivo': str(e)}
+            voci.append(voce)
+            click.echo(f"  [{len(voci)}/{len(duvri_ids)}] {voce['duvri_id']}: {voce['esito']}"
+                       + (f" ({voce['motivo']})" if voce.get('motivo') else ''))
+    durata = time.perf_counter() - inizio
+
+    conteggi = {esito: sum(1 for voce in voci if voce['esito'] == esito)
+                for esito in ('generato', 'attuale', 'saltato', 'errore')}
+    manifest = {
+        'avviato_il': avviato_il.isoformat(timespec='seconds'),
+        'durata_s': round(durata, 2),
+        'tipo': tipo,
+        'dal': dal.isoformat() if dal else None,
+        'workers': workers,
+        'totale': len(voci),
+        'conteggi': conteggi,
+        'documenti_al_minuto': round(len(voci) / durata * 60, 1) if durata > 0 else None,
+        'voci': sorted(voci, key=lambda voce: voce['duvri_id'])
+    }
+    if not manifest_path:
+        manifest_path = os.path.join(BASE_DIR, 'output', f"manifest_render_{avviato_il.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    click.echo(f"✅ Generati {conteggi['generato']}, ♻️ già aggiornati {conteggi['attuale']}, "
+               f"⏭️ saltati {conteggi['saltato']}, ❌ errori {conteggi['errore']}")
+    click.echo(f"📊 {len(voci)} DUVRI in {durata:.1f} s ({manifest['documenti_al_minuto']} documenti/min)")
+    click.echo(f"📄 Manifest: {manifest_path}")
+    for voce in voci:
+        if voce['esito'] == 'errore':
+            click.echo(f"  ❌ {voce['duvri_id']}: {voce['motivo']}", err=True)
+    if conteggi['errore']:
+        raise SystemExit(1)
+
+def _file_caricati_fuori_store():
+    """
+    File caricati prima dello store per contenuto
+
+    Returns:
+        list: (tipo, riferimento, percorso) con riferimento = id allegato,
+        id DUVRI per l'ESTAR o id firma per i PDF firmati
+    """
+    voci = []
+    conn = get_db_connection()
+    for riga in conn.execute('SELECT id, path FROM allegati ORDER BY id').fetchall():
+        if riga['path'] and not is_blob_upload(riga['path']) and os.path.isfile(riga['path']):
+            voci.append(('allegato', riga['id'], riga['path']))
+    for riga in conn.execute('''
+        SELECT id, duvri_estar_filename FROM duvri
+        WHERE duvri_estar_filename IS NOT NULL AND duvri_estar_sha256 IS NULL ORDER BY id
+    ''').fetchall():
+        filepath = percorso_duvri_estar(riga['duvri_estar_filename'], None)
+        if os.path.isfile(filepath):
+            voci.append(('estar', riga['id'], filepath))
+    for riga in conn.execute('SELECT id, path FROM firme_digitali ORDER BY id').fetchall():
+        if riga['path'] and not is_blob_upload(riga['path']) and os.path.isfile(riga['path']):
+            voci.append(('firmato', riga['id'], riga['path']))
+    conn.close()
+    return voci
+
+@duvri_cli.command('deduplica-upload')
+@click.option('--applica', is_flag=True,
+              help='Sposta i file nello store per contenuto (senza, calcola solo il report)')
+def deduplica_upload(applica):
+    """
+    Report dello spazio recuperabile archiviando per contenuto i file caricati
+
+    Con --applica allegati, DUVRI ESTAR e PDF firmati caricati prima dello
+    store vengono spostati in uploads/blob e i riferimenti aggiornati.
+    """
+    init_db()
+    voci = _file_caricati_fuori_store()
+
+    conn = get_db_connection()
+    gia_archiviati = {riga['sha256'] for riga in conn.execute('SELECT sha256 FROM blob_upload').fetchall()}
+    conn.close()
+
+    per_tipo = {}
+    nuovi_blob = {}
+    totale = 0
+    hashati = []
+    for tipo, riferimento, filepath in voci:
+        sha256 = calcola_sha256(filepath)
+        dimensione = os.path.getsize(filepath)
+        hashati.append((tipo, riferimento, filepath, sha256))
+        conteggio = per_tipo.setdefault(tipo, [0, 0])
+        conteggio[0] += 1
+        conteggio[1] += dimensione
+        totale += dimensione
+        if sha256 not in gia_archiviati:
+            nuovi_blob[sha256] = dimensione
+
+    occupato_dopo = sum(nuovi_blob.values())
+    recuperati = totale - occupato_dopo
+    click.echo(f"🔎 File caricati fuori dallo store: {len(voci)}")
+    for tipo, (numero, dimensione) in sorted(per_tipo.items()):
+        click.echo(f"  {tipo:<9} {numero:>5} file {dimensione:>12} bytes")
+    click.echo(f"📦 Contenuti distinti da archiviare: {len(nuovi_blob)} "
+               f"({len(voci) - len(nuovi_blob)} file già presenti o duplicati)")
+    click.echo(f"💾 Occupazione attuale {totale} bytes, dopo l'archiviazione {occupato_dopo} bytes")
+    click.echo(f"🧹 Spazio recuperabile: {recuperati} bytes"
+               + (f" ({recuperati / totale:.1%})" if totale else ''))
+
+    if not applica:
+        click.echo("ℹ️ Nessun file spostato: rilanciare con --applica per archiviare")
+        return
+
+    for tipo, riferimento, filepath, sha256 in hashati:
+        blob = archivia_upload(filepath, sha256)
+        conn = get_db_connection()
+        if tipo == 'allegato':
+            conn.execute('UPDATE allegati SET path = ?, sha256 = ? WHERE id = ?', (blob['path'], sha256, riferimento))
+        elif tipo == 'estar':
+            conn.execute('UPDATE duvri SET duvri_estar_sha256 = ? WHERE id = ?', (sha256, riferimento))
+        else:
+            conn.execute('UPDATE firme_digitali SET path = ?, sha256 = ? WHERE id = ?', (blob['path'], sha256, riferimento))
+        conn.commit()
+        conn.close()
+
+    click.echo(f"✅ Archiviati {len(hashati)} file in {len(nuovi_blob)} nuovi blob: liberati {recuperati} bytes")
+
+# =============================================
+# STORICO REVISIONI DUVRI
+# =============================================
+# Ogni salvataggio che cambia le sezioni committente o appaltatore aggiunge
+# una revisione in revisioni_duvri: la prima e una ogni REVISIONI_CHECKPOINT
+# sono istantanee complete, le altre contengono solo le differenze rispetto
+# alla precedente (operazioni ['=', percorso, valore] e ['-', percorso]).
+# Ricostruire una revisione costa al più REVISIONI_CHECKPOINT differenze.
+# Le firme registrano la revisione firmata, così si può confrontare il
+# documento firmato con quello attuale. Il contenuto è JSON compresso zlib.
+SEZIONI_REVISIONE = ('committente', 'appaltatore')
+
+# Ultima revisione ricostruita per DUVRI: (numero, stato), valida finché nessun altro processo ne aggiunge
+_ultime_revisioni = {}
+_revisioni_lock = threading.Lock()
+
+def differenze_json(prima, dopo, percorso=()):
+    """Operazioni che trasformano prima in dopo (le liste sono sostituite per intero)"""
+    if isinstance(prima, dict) and isinstance(dopo, dict):
+        operazioni = [['-', [*percorso, chiave]] for chiave in prima if chiave not in dopo]
+        for chiave, valore in dopo.items():
+            if chiave in prima:
+                operazioni.extend(differenze_json(prima[chiave], valore, (*percorso, chiave)))
+            else:
+                operazioni.append(['=', [*percorso, chiave], valore])
+        return operazioni
+    if prima != dopo or type(prima) is not type(dopo):
+        return [['=', list(percorso), dopo]]
+    return []
+
+def applica_differenze(stato, operazioni):
+    """Applica a una copia di stato le operazioni prodotte da differenze_json"""
+    stato = copy.deepcopy(stato)
+    for operazione in operazioni:
+        percorso = operazione[1]
+        if not percorso:
+            stato = copy.deepcopy(operazione[2])
+            continue
+        nodo = stato
+        for chiave in percorso[:-1]:
+            nodo = nodo[chiave]
+        if operazione[0] == '-':
+            nodo.pop(percorso[-1], None)
+        else:
+            nodo[percorso[-1]] = copy.deepcopy(operazione[2])
+    return stato
+
+def _comprimi(valore):
+    return zlib.compress(json.dumps(valore, separators=(',', ':')).encode('utf-8'))
+
+def _decomprimi(dati):
+    return json.loads(zlib.decompress(dati))
+
+def _ricostruisci(conn, duvri_id, numero):
+    """Stato della revisione indicato: ultima istantanea fino a numero più le differenze successive"""
+    righe = conn.execute('''
+        SELECT numero, istantanea, dati FROM revisioni_duvri
+        WHERE duvri_id = ? AND numero <= ? AND numero >= (
+            SELECT max(numero) FROM revisioni_duvri WHERE duvri_id = ? AND numero <= ? AND istantanea = 1
+        )
+        ORDER BY numero
+    ''', (duvri_id, numero, duvri_id, numero)).fetchall()
+    if not righe or righe[-1]['numero'] != numero:
+        return None
+
+    stato = _decomprimi(righe[0]['dati'])
+    for riga in righe[1:]:
+        stato = applica_differenze(stato, _decomprimi(riga['dati']))
+    return stato
+
+def ricostruisci_revisione(duvri_id, numero):
+    """Sezioni committente e appaltatore del DUVRI alla revisione indicata (None se non esiste)"""
+    conn = get_db_connection()
+    try:
+        return _ricostruisci(conn, duvri_id, numero)
+    finally:
+        conn.close()
+
+def registra_revisione(duvri_id, origine=None):
+    """
+    Registra una revisione se le sezioni del DUVRI sono cambiate dall'ultima
+
+    origine indica chi ha prodotto la modifica (di default la route della richiesta).
+
+    Returns:
+        int: numero della nuova revisione, None se non è cambiato nulla
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        duvri = conn.execute(
+            f"SELECT {', '.join(f'{s}_data' for s in SEZIONI_REVISIONE)} FROM duvri_completi WHERE id = ?",
+            (duvri_id,)
+        ).fetchone()
+        if not duvri:
+            conn.rollback()
+            return None
+        stato = {s: json.loads(duvri[f'{s}_data']) if duvri[f'{s}_data'] else {} for s in SEZIONI_REVISIONE}
+
+        ultima = conn.execute('SELECT max(numero) FROM revisioni_duvri WHERE duvri_id = ?',
+                              (duvri_id,)).fetchone()[0] or 0
+        precedente = None
+        if ultima:
+            with _revisioni_lock:
+                in_cache = _ultime_revisioni.get(duvri_id)
+            precedente = in_cache[1] if in_cache and in_cache[0] == ultima else _ricostruisci(conn, duvri_id, ultima)
+
+        numero = ultima + 1
+        istantanea = precedente is None or (numero - 1) % app.config['REVISIONI_CHECKPOINT'] == 0
+        if precedente is not None:
+            operazioni = differenze_json(precedente, stato)
+            if not operazioni:
+                conn.rollback()
+                return None
+
+        dati = _comprimi(stato if istantanea else operazioni)
+        conn.execute('''
+            INSERT INTO revisioni_duvri (duvri_id, numero, istantanea, dati, dimensione, dimensione_completa, origine, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (duvri_id, numero, 1 if istantanea else 0, dati, len(dati),
+              len(json.dumps(stato, separators=(',', ':')).encode('utf-8')),
+              origine or (request.endpoint if has_request_context() else None), datetime.now()))
+        conn.commit()
+    finally:
+        conn.close()
+
+    with _revisioni_lock:
+        _ultime_revisioni[duvri_id] = (numero, stato)
+    return numero
+
+def ultima_revisione(duvri_id):
+    """Numero dell'ultima revisione registrata del DUVRI (0 se nessuna)"""
+    conn = get_db_connection()
+    numero = conn.execute('SELECT max(numero) FROM revisioni_duvri WHERE duvri_id = ?',
+                          (duvri_id,)).fetchone()[0]
+    conn.close()
+    return numero or 0
+
+def registra_revisioni_mancanti():
+    """Prima revisione (istantanea) per i DUVRI creati prima dello storico"""
+    conn = get_db_connection()
+    mancanti = [row['id'] for row in conn.execute(
+        'SELECT id FROM duvri WHERE id NOT IN (SELECT DISTINCT duvri_id FROM revisioni_duvri)'
+    )]
+    conn.close()
+    for duvri_id in mancanti:
+        registra_revisione(duvri_id, 'importazione')
+    if mancanti:
+        print(f"🕘 Registrata la revisione iniziale di {len(mancanti)} DUVRI")
+    return len(mancanti)
+
+def _descrivi_differenze(prima, dopo):
+    """Differenze leggibili tra due stati: percorso puntato, valore precedente e nuovo"""
+    descrizione = []
+    for operazione in differenze_json(prima, dopo):
+        percorso = operazione[1]
+        valore_prima = prima
+        for chiave in percorso:
+            valore_prima = valore_prima.get(chiave) if isinstance(valore_prima, dict) else None
+        descrizione.append({
+            'percorso': '.'.join(str(chiave) for chiave in percorso),
+            'operazione': 'rimosso' if operazione[0] == '-' else ('modificato' if valore_prima is not None else 'aggiunto'),
+            'prima': valore_prima,
+            'dopo': operazione[2] if operazione[0] == '=' else None,
+        })
+    return descrizione
+
+@app.route('/revisioni/<duvri_id>')
+def revisioni_duvri(duvri_id):
+    """Elenco delle revisioni del DUVRI con le firme che vi fanno riferimento"""
+    conn = get_db_connection()
+    revisioni = [dict(row) for row in conn.execute('''
+        SELECT numero, istantanea, dimensione, dimensione_completa, origine, created_at
+        FROM revisioni_duvri WHERE duvri_id = ? ORDER BY numero
+    ''', (duvri_id,))]
+    firme = [dict(row) for row in conn.execute('''
+        SELECT ruolo, firmatario, data_firma, revisione FROM firme_digitali
+        WHERE duvri_id = ? ORDER BY data_firma
+    ''', (duvri_id,))]
+    conn.close()
+    if not revisioni:
+        return {'errore': 'DUVRI non trovato o senza revisioni'}, 404
+    for revisione in revisioni:
+        revisione['istantanea'] = bool(revisione['istantanea'])
+        revisione['created_at'] = str(revisione['created_at'])
+    return {'duvri_id': duvri_id, 'revisioni': revisioni, 'firme': firme}
+
+@app.route('/revisioni/<duvri_id>/<int:numero>')
+def revisione_duvri(duvri_id, numero):
+    """Sezioni del DUVRI ricostruite alla revisione indicata"""
+    stato = ricostruisci_revisione(duvri_id, numero)
+    if stato is None:
+        return {'errore': 'Revisione non trovata'}, 404
+    return {'duvri_id': duvri_id, 'numero': numero, **stato}
+
+@app.route('/revisioni/<duvri_id>/differenze')
+def differenze_revisioni(duvri_id):
+    """
+    Differenze tra due revisioni (?da=N&a=M)
+
+    da=firma_appaltatore o da=firma_committente parte dalla revisione firmata;
+    senza a il confronto è con l'ultima revisione.
+    """
+    da = request.args.get('da', '')
+    if da.startswith('firma_'):
+        conn = get_db_connection()
+        firma = conn.execute('''
+            SELECT revisione FROM firme_digitali WHERE duvri_id = ? AND ruolo = ?
+            ORDER BY data_firma DESC LIMIT 1
+        ''', (duvri_id, da[len('firma_'):])).fetchone()
+        conn.close()
+        da = firma['revisione'] if firma and firma['revisione'] else None
+    a = request.args.get('a', type=int) or ultima_revisione(duvri_id)
+
+    try:
+        da = int(da)
+    except (TypeError, ValueError):
+        return {'errore': 'Revisione di partenza non valida o firma senza revisione'}, 400
+
+    prima, dopo = ricostruisci_revisione(duvri_id, da), ricostruisci_revisione(duvri_id, a)
+    if prima is None or dopo is None:
+        return {'errore': 'Revisione non trovata'}, 404
+    return {'duvri_id': duvri_id, 'da': da, 'a': a, 'differenze': _descrivi_differenze(prima, dopo)}
+
+@duvri_cli.command('statistiche-revisioni')
+def statistiche_revisioni():
+    """Spazio occupato dallo storico revisioni rispetto a copie complete a ogni salvataggio"""
+    init_db()
+    conn = get_db_connection()
+    totali = conn.execute('''
+        SELECT count(*) AS revisioni, count(DISTINCT duvri_id) AS duvri,
+               coalesce(sum(istantanea), 0) AS istantanee,
+               coalesce(sum(dimensione), 0) AS occupato,
+               coalesce(sum(CASE WHEN istantanea = 0 THEN dimensione END), 0) AS differenze,
+               coalesce(sum(dimensione_completa), 0) AS copie_complete
+        FROM revisioni_duvri
+    ''').fetchone()
+    catena_max = conn.execute('''
+        SELECT coalesce(max(lunghezza), 0) FROM (
+            SELECT count(*) AS lunghezza FROM revisioni_duvri r
+            WHERE istantanea = 0
+            GROUP BY duvri_id, (SELECT max(numero) FROM revisioni_duvri i
+                                WHERE i.duvri_id = r.duvri_id AND i.istantanea = 1 AND i.numero < r.numero)
+        )
+    ''').fetchone()[0]
+    conn.close()
+
+    revisioni = totali['revisioni']
+    delta = revisioni - totali['istantanee']
+    click.echo(f"🕘 Revisioni: {revisioni} su {totali['duvri']} DUVRI "
+               f"({totali['istantanee']} istantanee, {delta} differenze, checkpoint ogni {app.config['REVISIONI_CHECKPOINT']})")
+    if delta:
+        click.echo(f"📏 Differenza media: {totali['differenze'] / delta:.0f} bytes; catena più lunga: {catena_max}")
+    click.echo(f"💾 Occupato dallo storico: {totali['occupato']} bytes; "
+               f"con copie complete (non compresse): {totali['copie_complete']} bytes")
+    if totali['copie_complete']:
+        click.echo(f"📊 Rapporto: {totali['occupato'] / totali['copie_complete']:.1%}")
+
+# =============================================
+# ARCHIVIO DUVRI CHIUSI E CANCELLAZIONE DIFFERITA
+# =============================================
+# I DUVRI chiusi (firmati da entrambe le parti, senza extra-costi ancora da
+# integrare) e non modificati da ARCHIVIO_GIORNI passano nel database di
+# archivio, collegato a ogni connessione come schema `archivio`, insieme a
+# allegati, firme, artefatti, extra-costi, revisioni e righe dell'indice di
+# ricerca. I loro file vengono copiati in ARCHIVIO_BLOB_FOLDER/<sha[:2]>/<sha>
+# e i riferimenti nello store caldo rilasciati: tabelle principali, dashboard
+# e duvri_list contengono solo i DUVRI in lavorazione, l'archivio resta
+# consultabile in sola lettura da /archivio e dalla ricerca.
+# L'eliminazione imposta solo eliminato_il (il DUVRI sparisce dalla vista
+# duvri_completi); dopo PURGA_DOPO_ORE la purga cancella in una transazione
+# tutte le righe collegate e poi i file non più referenziati.
+TABELLE_ARCHIVIO = ('duvri', 'extra_costi_sicurezza', 'allegati', 'firme_digitali', 'artefatti', 'revisioni_duvri')
+ARCHIVIO_PER_PAGINA = 50
+
+_archivio_lock = threading.Lock()
+_manutenzione_worker = None
+
+def percorso_blob_archivio(sha256):
+    """Copia nell'archivio del file con il contenuto indicato"""
+    return os.path.join(app.config['ARCHIVIO_BLOB_FOLDER'], sha256[:2], sha256)
+
+def crea_archivio(conn):
+    """Crea le tabelle dell'archivio dalla definizione di quelle principali e aggiunge le colonne mancanti"""
+    for tabella in TABELLE_ARCHIVIO:
+        sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                           (tabella,)).fetchone()['sql']
+        conn.execute(re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?"?\w+"?',
+                            f'CREATE TABLE IF NOT EXISTS archivio.{tabella}', sql, count=1))
+        esistenti = {row['name'] for row in conn.execute(f'PRAGMA archivio.table_info({tabella})')}
+        for colonna in conn.execute(f'PRAGMA main.table_info({tabella})').fetchall():
+            if colonna['name'] not in esistenti:
+                default = f" DEFAULT {colonna['dflt_value']}" if colonna['dflt_value'] is not None else ''
+                conn.execute(f"ALTER TABLE archivio.{tabella} ADD COLUMN {colonna['name']} {colonna['type']}{default}")
+    if not any(row['name'] == 'archiviato_il' for row in conn.execute('PRAGMA archivio.table_info(duvri)')):
+        conn.execute('ALTER TABLE archivio.duvri ADD COLUMN archiviato_il TIMESTAMP')
+    for tabella in TABELLE_ARCHIVIO[1:]:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS archivio.idx_{tabella}_duvri ON {tabella}(duvri_id)')
+    crea_tabelle_ricerca(conn, 'archivio')
+    conn.commit()
+
+def _copia_in_archivio(sorgente_path, sha256):
+    """Copia un file nell'archivio se il contenuto non è già presente; True se copiato"""
+    destinazione = percorso_blob_archivio(sha256)
+    if os.path.exists(destinazione):
+        return False
+    os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+    tmp_path = f"{destinazione}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(sorgente_path, tmp_path)
+    os.replace(tmp_path, destinazione)
+    return True
+
+def _inserisci_in_archivio(conn, tabella, righe):
+    if righe:
+        colonne = list(righe[0])
+        conn.executemany(
+            f"INSERT INTO archivio.{tabella} ({', '.join(colonne)}) VALUES ({', '.join(':' + c for c in colonne)})",
+            righe
+        )
+
+def _rimuovi_cartelle_duvri(duvri_id):
+    """Cartelle dei file caricati prima dello store (con i .txt delle firme), che init_db reimporterebbe"""
+    for cartella in (UPLOAD_FOLDER, ALLEGATI_FOLDER):
+        shutil.rmtree(os.path.join(cartella, f"duvri_{duvri_id}"), ignore_errors=True)
+
+def _dimentica_duvri(duvri_id):
+    """Toglie il DUVRI dalla memoria e dalle cache del processo"""
+    duvri_list.pop(duvri_id, None)
+    _cache_confronto_costi.pop(duvri_id, None)
+    _ultime_revisioni.pop(duvri_id, None)
+
+def archivia_duvri(duvri_id):
+    """
+    Sposta un DUVRI chiuso nel database di archivio con righe collegate e file
+
+    I file sono copiati nell'archivio prima della transazione e i riferimenti
+    caldi rilasciati solo dopo il commit: se qualcosa fallisce il DUVRI resta
+    attivo e le copie già fatte vengono riusate al tentativo successivo.
+
+    Returns:
+        int: file copiati nell'archivio, None se il DUVRI non esiste o è cambiato nel frattempo
+    """
+    conn = get_db_connection()
+    duvri = conn.execute('SELECT * FROM duvri_completi WHERE id = ?', (duvri_id,)).fetchone()
+    righe = {
+        tabella: [dict(row) for row in conn.execute(f'SELECT * FROM {tabella} WHERE duvri_id = ?', (duvri_id,))]
+        for tabella in ('allegati', 'firme_digitali', 'artefatti')
+    }
+    conn.close()
+    if not duvri:
+        return None
+    duvri = dict(duvri)
+
+    # 1. File nell'archivio: le righe archiviate puntano alla copia per contenuto
+    copiati = 0
+    da_rilasciare = []
+    for tabella, elenco in righe.items():
+        for riga in elenco:
+            da_rilasciare.append((tabella, riga['path'], riga['sha256']))
+            if riga['path'] and os.path.exists(riga['path']):
+                riga['sha256'] = riga['sha256'] or calcola_sha256(riga['path'])
+                copiati += _copia_in_archivio(riga['path'], riga['sha256'])
+            riga['path'] = percorso_blob_archivio(riga['sha256']) if riga['sha256'] else None
+
+    estar_path = None
+    if duvri['duvri_estar_filename']:
+        estar_path = percorso_duvri_estar(duvri['duvri_estar_filename'], duvri['duvri_estar_sha256'])
+        if os.path.exists(estar_path):
+            duvri['duvri_estar_sha256'] = duvri['duvri_estar_sha256'] or calcola_sha256(estar_path)
+            copiati += _copia_in_archivio(estar_path, duvri['duvri_estar_sha256'])
+        da_rilasciare.append(('duvri', estar_path, duvri['duvri_estar_sha256']))
+
+    sha_testi = {riga['sha256'] for tabella in ('allegati', 'firme_digitali') for riga in righe[tabella]}
+    sha_testi.add(duvri['duvri_estar_sha256'])
+    sha_testi.discard(None)
+
+    # 2. Righe nell'archivio e rimozione dalle tabelle principali in una transazione
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        # Una modifica arrivata durante la copia dei file rimanda l'archiviazione
+        if not conn.execute('SELECT 1 FROM duvri WHERE id = ? AND updated_at IS ? AND eliminato_il IS NULL',
+                            (duvri_id, duvri['updated_at'])).fetchone():
+            conn.rollback()
+            return None
+
+        duvri.update({f'{sezione}_da': None for sezione in SEZIONI_CONDIVISIBILI})
+        duvri['archiviato_il'] = datetime.now()
+        _inserisci_in_archivio(conn, 'duvri', [duvri])
+        for tabella, elenco in righe.items():
+            _inserisci_in_archivio(conn, tabella, elenco)
+        for tabella in ('extra_costi_sicurezza', 'revisioni_duvri'):
+            colonne = ', '.join(row['name'] for row in conn.execute(f'PRAGMA main.table_info({tabella})'))
+            conn.execute(f'INSERT INTO archivio.{tabella} ({colonne}) SELECT {colonne} FROM main.{tabella} WHERE duvri_id = ?',
+                         (duvri_id,))
+
+        # Testo indicizzato del DUVRI e dei suoi file
+        conn.execute(f'''
+            INSERT INTO archivio.ricerca_contenuti (tipo, chiave, titolo, testo)
+            SELECT tipo, chiave, titolo, testo FROM main.ricerca_contenuti
+            WHERE (tipo = 'duvri' AND chiave = ?) OR (tipo = 'testo' AND chiave IN ({','.join('?' * len(sha_testi))}))
+            ON CONFLICT(tipo, chiave) DO UPDATE SET titolo = excluded.titolo, testo = excluded.testo
+        ''', [duvri_id, *sha_testi])
+
+        # I trigger materializzano le sezioni nelle copie e tolgono il DUVRI dall'indice principale
+        for tabella in TABELLE_ARCHIVIO[1:]:
+            conn.execute(f'DELETE FROM main.{tabella} WHERE duvri_id = ?', (duvri_id,))
+        conn.execute('DELETE FROM main.duvri WHERE id = ?', (duvri_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    # 3. Riferimenti allo store caldo: i blob condivisi con DUVRI attivi restano
+    conn = get_db_connection()
+    for tabella, path, sha256 in da_rilasciare:
+        if tabella == 'artefatti':
+            _rimuovi_blob_se_orfano(conn, sha256, path)
+        else:
+            rimuovi_file_caricato(path, sha256)
+    conn.close()
+    for firma in righe['firme_digitali']:
+        if firma['origine'] and os.path.exists(os.path.join(BASE_DIR, firma['origine'])):
+            os.remove(os.path.join(BASE_DIR, firma['origine']))
+    _rimuovi_cartelle_duvri(duvri_id)
+    _dimentica_duvri(duvri_id)
+
+    print(f"🗄️ DUVRI {duvri_id} archiviato ({copiati} file copiati nell'archivio)")
+    return copiati
+
+def duvri_da_archiviare(giorni=None):
+    """DUVRI chiusi e non modificati da almeno `giorni` giorni (default ARCHIVIO_GIORNI)"""
+    giorni = app.config['ARCHIVIO_GIORNI'] if giorni is None else giorni
+    conn = get_db_connection()
+    righe = conn.execute('''
+        SELECT id, nome_progetto, updated_at FROM duvri d
+        WHERE stato = 'completato_firme_digitali' AND eliminato_il IS NULL
+          AND datetime(coalesce(updated_at, created_at)) < datetime(?)
+          AND NOT EXISTS (SELECT 1 FROM extra_costi_sicurezza e
+                          WHERE e.duvri_id = d.id AND coalesce(e.stato, '') != 'integrato')
+        ORDER BY updated_at
+    ''', (datetime.now() - timedelta(days=giorni),)).fetchall()
+    conn.close()
+    return [dict(riga) for riga in righe]
+
+def archivia_duvri_chiusi(giorni=None):
+    """Archivia i DUVRI chiusi oltre la soglia; restituisce gli id archiviati"""
+    archiviati = []
+    with _archivio_lock:
+        for duvri in duvri_da_archiviare(giorni):
+            try:
+                if archivia_duvri(duvri['id']) is not None:
+                    archiviati.append(duvri['id'])
+            except Exception as e:
+                print(f"❌ Errore archiviazione DUVRI {duvri['id']}: {e}")
+    return archiviati
+
+def purga_duvri(duvri_id):
+    """
+    Cancella definitivamente un DUVRI eliminato: tutte le righe collegate in
+    una transazione, poi i file non più referenziati
+
+    Returns:
+        bool: False se il DUVRI non esiste o non è stato eliminato
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        duvri = conn.execute(
+            'SELECT duvri_estar_filename, duvri_estar_sha256 FROM duvri WHERE id = ? AND eliminato_il IS NOT NULL',
+            (duvri_id,)
+        ).fetchone()
+        if not duvri:
+            conn.rollback()
+            return False
+        allegati = conn.execute('SELECT path, sha256 FROM allegati WHERE duvri_id = ?', (duvri_id,)).fetchall()
+        firme = conn.execute('SELECT path, sha256, origine FROM firme_digitali WHERE duvri_id = ?', (duvri_id,)).fetchall()
+        artefatti = conn.execute('SELECT path, sha256 FROM artefatti WHERE duvri_id = ?', (duvri_id,)).fetchall()
+        sessioni = [dict(row) for row in conn.execute('SELECT * FROM upload_sessioni WHERE duvri_id = ?', (duvri_id,))]
+        for tabella in ('allegati', 'firme_digitali', 'artefatti', 'extra_costi_sicurezza', 'revisioni_duvri',
+                        'upload_sessioni'):
+            conn.execute(f'DELETE FROM {tabella} WHERE duvri_id = ?', (duvri_id,))
+        # I trigger materializzano le sezioni nelle copie e tolgono il DUVRI dall'indice di ricerca
+        conn.execute('DELETE FROM duvri WHERE id = ?', (duvri_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    for riga in [*allegati, *firme]:
+        rimuovi_file_caricato(riga['path'], riga['sha256'])
+    for firma in firme:
+        if firma['origine'] and os.path.exists(os.path.join(BASE_DIR, firma['origine'])):
+            os.remove(os.path.join(BASE_DIR, firma['origine']))
+    if duvri['duvri_estar_filename']:
+        rimuovi_file_caricato(percorso_duvri_estar(duvri['duvri_estar_filename'], duvri['duvri_estar_sha256']),
+                              duvri['duvri_estar_sha256'])
+    conn = get_db_connection()
+    for artefatto in artefatti:
+        _rimuovi_blob_se_orfano(conn, artefatto['sha256'], artefatto['path'])
+    conn.close()
+    for sessione in sessioni:
+        rimuovi_sessione_upload(sessione)
+    _rimuovi_cartelle_duvri(duvri_id)
+    _dimentica_duvri(duvri_id)
+
+    print(f"🧹 DUVRI {duvri_id} purgato: {len(allegati)} allegati, {len(firme)} firme, {len(artefatti)} artefatti")
+    return True
+
+def purga_duvri_eliminati(ore=None):
+    """Purga i DUVRI eliminati da almeno `ore` ore (default PURGA_DOPO_ORE); restituisce gli id purgati"""
+    ore = app.config['PURGA_DOPO_ORE'] if ore is None else ore
+    conn = get_db_connection()
+    righe = conn.execute(
+        'SELECT id FROM duvri WHERE eliminato_il IS NOT NULL AND datetime(eliminato_il) <= datetime(?)',
+        (datetime.now() - timedelta(hours=ore),)
+    ).fetchall()
+    conn.close()
+
+    purgati = []
+    for riga in righe:
+        try:
+            if purga_duvri(riga['id']):
+                purgati.append(riga['id'])
+        except Exception as e:
+            print(f"❌ Errore purga DUVRI {riga['id']}: {e}")
+    return purgati
+
+def esegui_manutenzione():
+    """Un passaggio di manutenzione: purga degli eliminati e archiviazione dei chiusi"""
+    purgati = purga_duvri_eliminati()
+    archiviati = archivia_duvri_chiusi() if app.config['ARCHIVIO_GIORNI'] > 0 else []
+    if purgati or archiviati:
+        print(f"🧰 Manutenzione: {len(purgati)} DUVRI purgati, {len(archiviati)} archiviati")
+    return purgati, archiviati
+
+def _manutenzione_periodica():
+    """Worker: manutenzione ogni MANUTENZIONE_INTERVALLO_MINUTI minuti"""
+    while True:
+        try:
+            esegui_manutenzione()
+        except Exception as e:
+            print(f"❌ Errore manutenzione: {e}")
+        time.sleep(app.config['MANUTENZIONE_INTERVALLO_MINUTI'] * 60)
+
+def avvia_manutenzione():
+    """Avvia il worker di manutenzione, se abilitato e non già attivo nel processo"""
+    global _manutenzione_worker
+    if not app.config.get('MANUTENZIONE_AUTOMATICA'):
+        return False
+    if _manutenzione_worker is None or not _manutenzione_worker.is_alive():
+        _manutenzione_worker = threading.Thread(target=_manutenzione_periodica, name='manutenzione', daemon=True)
+        _manutenzione_worker.start()
+    return True
+
+def get_duvri_archiviato(duvri_id):
+    """DUVRI archiviato con file, extra-costi e numero di revisioni, None se non presente"""
+    conn = get_db_connection()
+    duvri = conn.execute('SELECT * FROM archivio.duvri WHERE id = ?', (duvri_id,)).fetchone()
+    if not duvri:
+        conn.close()
+        return None
+    duvri = dict(duvri)
+    for sezione in SEZIONI_CONDIVISIBILI:
+        duvri[f'dati_{sezione}'] = json.loads(duvri[f'{sezione}_data']) if duvri[f'{sezione}_data'] else {}
+    duvri['allegati'] = [dict(row) for row in conn.execute(
+        'SELECT * FROM archivio.allegati WHERE duvri_id = ? ORDER BY nome_originale', (duvri_id,))]
+    duvri['firme'] = [dict(row) for row in conn.execute(
+        'SELECT * FROM archivio.firme_digitali WHERE duvri_id = ? ORDER BY data_firma, created_at', (duvri_id,))]
+    duvri['artefatti'] = [dict(row) for row in conn.execute(
+        'SELECT * FROM archivio.artefatti WHERE duvri_id = ? ORDER BY created_at', (duvri_id,))]
+    duvri['extra_costi'] = [dict(row) for row in conn.execute(
+        'SELECT * FROM archivio.extra_costi_sicurezza WHERE duvri_id = ? ORDER BY created_at', (duvri_id,))]
+    duvri['revisioni'] = conn.execute(
+        'SELECT count(*) FROM archivio.revisioni_duvri WHERE duvri_id = ?', (duvri_id,)).fetchone()[0]
+    conn.close()
+    return duvri
+
+@app.route('/archivio')
+def archivio():
+    """Elenco paginato dei DUVRI archiviati (sola lettura)"""
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    conn = get_db_connection()
+    totale = conn.execute('SELECT count(*) FROM archivio.duvri').fetchone()[0]
+    righe = conn.execute('''
+        SELECT id, nome_progetto, stato, created_at, updated_at, archiviato_il FROM archivio.duvri
+        ORDER BY archiviato_il DESC, id LIMIT ? OFFSET ?
+    ''', (ARCHIVIO_PER_PAGINA, (pagina - 1) * ARCHIVIO_PER_PAGINA)).fetchall()
+    conn.close()
+    return render_template('archivio.html',
+                           duvri_archiviati=righe,
+                           pagina=pagina,
+                           pagine=max((totale + ARCHIVIO_PER_PAGINA - 1) // ARCHIVIO_PER_PAGINA, 1),
+                           totale=totale)
+
+@app.route('/archivio/<duvri_id>')
+def archivio_duvri(duvri_id):
+    """Dati e documenti di un DUVRI archiviato (sola lettura)"""
+    duvri = get_duvri_archiviato(duvri_id)
+    if not duvri:
+        flash('DUVRI non presente in archivio.', 'danger')
+        return redirect(url_for('archivio'))
+    return render_template('archivio_duvri.html', duvri=duvri)
+
+@app.route('/archivio/<duvri_id>/file/<tipo>/<file_id>')
+def scarica_file_archiviato(duvri_id, tipo, file_id):
+    """Scarica dall'archivio un allegato, una firma, un PDF generato o il DUVRI ESTAR"""
+    duvri = get_duvri_archiviato(duvri_id)
+    if not duvri:
+        flash('DUVRI non presente in archivio.', 'danger')
+        return redirect(url_for('archivio'))
+
+    if tipo == 'estar' and duvri['duvri_estar_sha256']:
+        return invia_file(percorso_blob_archivio(duvri['duvri_estar_sha256']), 'caricato',
+                          download_name=duvri['duvri_estar_filename'], etag=duvri['duvri_estar_sha256'])
+
+    elenchi = {'allegato': 'allegati', 'firma': 'firme', 'artefatto': 'artefatti'}
+    voce = next((v for v in duvri.get(elenchi.get(tipo), []) if v['id'] == file_id), None)
+    if not voce or not voce['path'] or not os.path.exists(voce['path']):
+        flash('File non presente in archivio.', 'danger')
+        return redirect(url_for('archivio_duvri', duvri_id=duvri_id))
+
+    if tipo == 'allegato':
+        return invia_file(voce['path'], 'allegato', download_name=voce['nome_originale'],
+                          mimetype=voce['mime_type'], etag=voce['sha256'])
+    if tipo == 'firma':
+        return invia_file(voce['path'], 'firmato', download_name=voce['nome_file'],
+                          mimetype='application/pdf', etag=voce['sha256'])
+    return invia_file(voce['path'], 'artefatto', download_name=f"DUVRI_{duvri_id}_{voce['tipo']}.pdf",
+                      mimetype='application/pdf', etag=voce['sha256'])
+
+@duvri_cli.command('archivia')
+@click.option('--giorni', type=int, help='Giorni dall\'ultima modifica (default ARCHIVIO_GIORNI)')
+@click.option('--simula', is_flag=True, help='Elenca i DUVRI senza archiviarli')
+def archivia_cli(giorni, simula):
+    """Sposta nell'archivio i DUVRI firmati e chiusi"""
+    init_db()
+    candidati = duvri_da_archiviare(giorni)
+    for duvri in candidati:
+        click.echo(f"{duvri['id']}  {duvri['updated_at']}  {duvri['nome_progetto']}")
+    if simula:
+        click.echo(f"ℹ️ {len(candidati)} DUVRI da archiviare")
+        return
+    archiviati = archivia_duvri_chiusi(giorni)
+    click.echo(f"✅ {len(archiviati)} DUVRI archiviati su {len(candidati)}")
+
+@duvri_cli.command('purga')
+@click.option('--subito', is_flag=True, help='Purga anche i DUVRI eliminati da meno di PURGA_DOPO_ORE')
+def purga_cli(subito):
+    """Cancella definitivamente i DUVRI eliminati con righe collegate e file"""
+    init_db()
+    purgati = purga_duvri_eliminati(0 if subito else None)
+    click.echo(f"✅ {len(purgati)} DUVRI purgati")
+
+# =============================================
+# BACKUP ONLINE DATABASE E FILE CARICATI
+# =============================================
+# Il database viene copiato con l'API di backup online di SQLite a piccoli
+# passi di pagine: il lock di lettura è tenuto solo per la durata di un
+# passo, quindi le richieste web continuano a scrivere durante il backup.
+# Il database di archivio viene copiato allo stesso modo accanto allo
+# snapshot. Ogni snapshot viene verificato con PRAGMA integrity_check prima
+# di essere conservato, e accanto al file .db un manifest JSON elenca i file
+# caricati e archiviati (percorso → sha256) presenti in quel momento. I file
+# sono copiati in backup/blob/<sha[:2]>/<sha> una sola volta per contenuto: un backup copia
+# solo i file caricati dopo il precedente. La rotazione tiene gli ultimi
+# BACKUP_ORARI snapshot orari e BACKUP_GIORNALIERI giornalieri; i blob non
+# più citati da alcun manifest vengono eliminati.
+ROTAZIONE_BACKUP = {'orario': 'BACKUP_ORARI', 'giornaliero': 'BACKUP_GIORNALIERI'}
+
+_backup_lock = threading.Lock()
+_backup_worker = None
+
+def cartella_backup_db():
+    return os.path.join(app.config['BACKUP_FOLDER'], 'db')
+
+def percorso_backup_blob(sha256):
+    """Copia di backup del file caricato con il contenuto indicato"""
+    return os.path.join(app.config['BACKUP_FOLDER'], 'blob', sha256[:2], sha256)
+
+class _BackupRicominciato(Exception):
+    """Il backup a passi è ricominciato troppe volte per le scritture concorrenti"""
+
+def copia_database_online(destinazione_path, schema='main'):
+    """
+    Copia il database (o l'archivio, schema='archivio') in destinazione_path
+    a passi di BACKUP_PAGINE_PER_PASSO pagine
+
+    Se un'altra connessione scrive durante la copia SQLite la fa ripartire:
+    con scritture continue e un database grande i passi potrebbero non finire
+    mai, quindi dopo BACKUP_RIAVVII_MAX ripartenze la copia viene completata
+    in un solo passo (gli scrittori attendono per la durata della copia).
+    """
+    ripartenze = 0
+    ultimo_rimanenti = None
+
+    def progresso(stato, rimanenti, totali):
+        nonlocal ripartenze, ultimo_rimanenti
+        if ultimo_rimanenti is not None and rimanenti > ultimo_rimanenti:
+            ripartenze += 1
+            if ripartenze > app.config['BACKUP_RIAVVII_MAX']:
+                raise _BackupRicominciato()
+        ultimo_rimanenti = rimanenti
+        # Tra un passo e l'altro il lock sulla sorgente è rilasciato: una breve pausa lascia spazio agli scrittori
+        time.sleep(0.001)
+
+    for pagine in (app.config['BACKUP_PAGINE_PER_PASSO'], -1):
+        sorgente = get_db_connection()
+        destinazione = sqlite3.connect(destinazione_path)
+        try:
+            sorgente.backup(destinazione, pages=pagine, progress=progresso, name=schema)
+            return ripartenze
+        except _BackupRicominciato:
+            print(f"⚠️ Backup ripartito {ripartenze} volte per scritture concorrenti: copia in un solo passo")
+        finally:
+            destinazione.close()
+            sorgente.close()
+
+def verifica_snapshot(snapshot_path):
+    """Esito di PRAGMA integrity_check sullo snapshot ('ok' se integro)"""
+    conn = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    try:
+        return '; '.join(row[0] for row in conn.execute('PRAGMA integrity_check').fetchall())
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    finally:
+        conn.close()
+
+def _file_caricati_snapshot(snapshot_path, archivio_path=None):
+    """Percorsi relativi e sha256 dei file caricati registrati nello snapshot (e dei file archiviati)"""
+    conn = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        file_caricati = {}
+        for row in conn.execute('SELECT sha256 FROM blob_upload'):
+            file_caricati[percorso_blob_upload(row['sha256'])] = row['sha256']
+        # File caricati prima dello store per contenuto
+        for row in conn.execute('SELECT path, sha256 FROM allegati UNION ALL SELECT path, sha256 FROM firme_digitali'):
+            if row['path'] and row['sha256'] and not is_blob_upload(row['path']):
+                file_caricati[row['path']] = row['sha256']
+        for row in conn.execute('''
+            SELECT duvri_estar_filename FROM duvri
+            WHERE duvri_estar_filename IS NOT NULL AND duvri_estar_sha256 IS NULL
+        '''):
+            estar_path = percorso_duvri_estar(row['duvri_estar_filename'], None)
+            if os.path.exists(estar_path):
+                file_caricati[estar_path] = calcola_sha256(estar_path)
+    finally:
+        conn.close()
+
+    if archivio_path:
+        conn = sqlite3.connect(f"file:{archivio_path}?mode=ro", uri=True)
+        try:
+            for (sha256,) in conn.execute('''
+                SELECT sha256 FROM allegati UNION SELECT sha256 FROM firme_digitali
+                UNION SELECT sha256 FROM artefatti UNION SELECT duvri_estar_sha256 FROM duvri
+            '''):
+                if sha256:
+                    file_caricati[percorso_blob_archivio(sha256)] = sha256
+        finally:
+            conn.close()
+    return {os.path.relpath(path, BASE_DIR): sha256 for path, sha256 in file_caricati.items()}
+
+def backup_file_caricati(file_caricati):
+    """
+    Copia nel backup i contenuti non ancora presenti
+
+    Returns:
+        tuple: (file copiati, bytes copiati, file già presenti, file mancanti su disco)
+    """
+    copiati, byte_copiati, presenti, mancanti = 0, 0, 0, 0
+    for relpath, sha256 in file_caricati.items():
+        destinazione = percorso_backup_blob(sha256)
+        if os.path.exists(destinazione):
+            presenti += 1
+            continue
+        sorgente = os.path.join(BASE_DIR, relpath)
+        if not os.path.exists(sorgente):
+            # Rilasciato dopo lo snapshot: nel backup resta solo se copiato in precedenza
+            mancanti += 1
+            continue
+        os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+        tmp_path = f"{destinazione}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(sorgente, tmp_path)
+        os.replace(tmp_path, destinazione)
+        copiati += 1
+        byte_copiati += os.path.getsize(destinazione)
+    return copiati, byte_copiati, presenti, mancanti
+
+def elenco_backup(tipo=None):
+    """Manifest degli snapshot conservati, dal più recente"""
+    cartella = cartella_backup_db()
+    if not os.path.isdir(cartella):
+        return []
+    manifest = []
+    for filename in os.listdir(cartella):
+        if filename.endswith('.json'):
+            with open(os.path.join(cartella, filename), encoding='utf-8') as f:
+                voce = json.load(f)
+            if tipo is None or voce['tipo'] == tipo:
+                manifest.append(voce)
+    return sorted(manifest, key=lambda voce: voce['creato'], reverse=True)
+
+def ruota_backup(tipo):
+    """Elimina gli snapshot oltre la retention del tipo e i blob non più citati"""
+    if tipo not in ROTAZIONE_BACKUP:
+        return 0
+    cartella = cartella_backup_db()
+    eliminati = 0
+    for voce in elenco_backup(tipo)[app.config[ROTAZIONE_BACKUP[tipo]]:]:
+        nome = voce['database'][:-len('.db')]
+        for estensione in ('.db', '_archivio.db', '.json'):
+            percorso = os.path.join(cartella, nome + estensione)
+            if os.path.exists(percorso):
+                os.remove(percorso)
+        eliminati += 1
+
+    if eliminati:
+        citati = {sha256 for voce in elenco_backup() for sha256 in voce['file'].values()}
+        cartella_blob = os.path.join(app.config['BACKUP_FOLDER'], 'blob')
+        for radice, _, filenames in os.walk(cartella_blob):
+            for filename in filenames:
+                if filename not in citati:
+                    os.remove(os.path.join(radice, filename))
+        print(f"🧹 Rotazione backup {tipo}: eliminati {eliminati} snapshot")
+    return eliminati
+
+def esegui_backup(tipo='orario'):
+    """
+    Snapshot online del database, verifica di integrità e backup incrementale dei file caricati
+
+    Returns:
+        dict: manifest dello snapshot
+    """
+    with _backup_lock:
+        inizio = time.perf_counter()
+        creato = datetime.now()
+        nome = f"duvri_{tipo}_{creato.strftime('%Y%m%d-%H%M%S')}"
+        cartella = cartella_backup_db()
+        os.makedirs(cartella, exist_ok=True)
+        if os.path.exists(os.path.join(cartella, f"{nome}.json")):
+            nome = f"{nome}-{uuid.uuid4().hex[:4]}"
+        snapshot_path = os.path.join(cartella, f"{nome}.db")
+        archivio_path = os.path.join(cartella, f"{nome}_archivio.db")
+        tmp_path = f"{snapshot_path}.tmp"
+        archivio_tmp_path = f"{archivio_path}.tmp"
+
+        copia_database_online(tmp_path)
+        copia_database_online(archivio_tmp_path, 'archivio')
+        esito = verifica_snapshot(tmp_path)
+        if esito == 'ok':
+            esito = verifica_snapshot(archivio_tmp_path)
+        if esito != 'ok':
+            os.remove(tmp_path)
+            os.remove(archivio_tmp_path)
+            raise RuntimeError(f"Snapshot {nome} non integro: {esito}")
+
+        file_caricati = _file_caricati_snapshot(tmp_path, archivio_tmp_path)
+        copiati, byte_copiati, presenti, mancanti = backup_file_caricati(file_caricati)
+        os.replace(tmp_path, snapshot_path)
+        os.replace(archivio_tmp_path, archivio_path)
+
+        manifest = {
+            'tipo': tipo,
+            'creato': creato.isoformat(timespec='seconds'),
+            'database': f"{nome}.db",
+            'archivio': f"{nome}_archivio.db",
+            'dimensione': os.path.getsize(snapshot_path) + os.path.getsize(archivio_path),
+            'integrity_check': esito,
+            'durata_ms': round((time.perf_counter() - inizio) * 1000, 1),
+            'file': file_caricati,
+        }
+        with open(os.path.join(cartella, f"{nome}.json"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        ruota_backup(tipo)
+
+    print(f"💾 Backup {tipo} {nome}: {manifest['dimensione']} bytes in {manifest['durata_ms']:.0f} ms, "
+          f"file caricati {copiati} copiati ({byte_copiati} bytes), {presenti} già presenti"
+          + (f", {mancanti} non più su disco" if mancanti else ''))
+    return manifest
+
+def _backup_periodico():
+    """Worker: backup orario allo scoccare dell'ora e giornaliero al primo backup del giorno"""
+    while True:
+        adesso = datetime.now()
+        prossima_ora = (adesso + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        time.sleep((prossima_ora - adesso).total_seconds())
+        try:
+            esegui_backup('orario')
+            oggi = datetime.now().date().isoformat()
+            if not any(voce['creato'].startswith(oggi) for voce in elenco_backup('giornaliero')):
+                esegui_backup('giornaliero')
+        except Exception as e:
+            print(f"❌ Errore backup automatico: {e}")
+
+def avvia_backup_automatico():
+    """Avvia il worker dei backup periodici (un solo processo: con più worker usare `flask duvri backup`)"""
+    global _backup_worker
+    if not app.config.get('BACKUP_AUTOMATICO'):
+        return False
+    if _backup_worker is None or not _backup_worker.is_alive():
+        _backup_worker = threading.Thread(target=_backup_periodico, name='backup-periodico', daemon=True)
+        _backup_worker.start()
+        print(f"💾 Backup automatico attivo in {app.config['BACKUP_FOLDER']}")
+    return True
+
+@duvri_cli.command('backup')
+@click.option('--tipo', type=click.Choice(list(ROTAZIONE_BACKUP)), default='orario', show_default=True,
+              help='Serie di rotazione dello snapshot')
+def backup_cli(tipo):
+    """Backup online del database e dei file caricati (da pianificare con cron)"""
+    init_db()
+    manifest = esegui_backup(tipo)
+    click.echo(f"✅ Snapshot {manifest['database']} verificato ({manifest['integrity_check']})")
+
+@duvri_cli.command('elenco-backup')
+def elenco_backup_cli():
+    """Elenca gli snapshot conservati"""
+    voci = elenco_backup()
+    if not voci:
+        click.echo("ℹ️ Nessun backup presente")
+    for voce in voci:
+        click.echo(f"{voce['creato']}  {voce['tipo']:<14} {voce['database']:<44} "
+                   f"{voce['dimensione']:>10} bytes  {len(voce['file'])} file")
+
+@duvri_cli.command('ripristina-backup')
+@click.argument('snapshot')
+@click.option('--si', 'confermato', is_flag=True, help='Non chiedere conferma')
+def ripristina_backup(snapshot, confermato):
+    """
+    Ripristina il database e i file caricati da uno snapshot
+
+    SNAPSHOT è il nome del file .db (vedi elenco-backup). Prima del
+    ripristino lo stato attuale viene salvato in uno snapshot 'pre_ripristino';
+    i file caricati mancanti su disco vengono ricopiati dal backup. Le
+    istanze dell'applicazione in esecuzione vanno riavviate.
+    """
+    nome = os.path.basename(snapshot)
+    if not nome.endswith('.db'):
+        nome += '.db'
+    snapshot_path = os.path.join(cartella_backup_db(), nome)
+    manifest_path = snapshot_path[:-len('.db')] + '.json'
+    if not os.path.exists(snapshot_path) or not os.path.exists(manifest_path):
+        raise click.ClickException(f"Snapshot non trovato: {nome}")
+
+    esito = verifica_snapshot(snapshot_path)
+    if esito != 'ok':
+        raise click.ClickException(f"Snapshot non integro: {esito}")
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    mancanti_backup = [relpath for relpath, sha256 in manifest['file'].items()
+                       if not os.path.exists(percorso_backup_blob(sha256))]
+    if mancanti_backup:
+        click.echo(f"⚠️ {len(mancanti_backup)} file dello snapshot non sono nel backup e non verranno ripristinati")
+
+    if not confermato:
+        click.confirm(f"Sostituire il database con lo snapshot del {manifest['creato']}?", abort=True)
+
+    if os.path.exists(os.path.join(BASE_DIR, 'duvri.db')):
+        precedente = esegui_backup('pre_ripristino')
+        click.echo(f"💾 Stato attuale salvato in {precedente['database']}")
+
+    # Gli snapshot precedenti all'archivio non lo includono: l'archivio attuale resta com'è
+    ripristini = [(snapshot_path, os.path.join(BASE_DIR, 'duvri.db'))]
+    if manifest.get('archivio'):
+        ripristini.append((os.path.join(cartella_backup_db(), manifest['archivio']), app.config['ARCHIVIO_DB']))
+    for sorgente_path, destinazione_path in ripristini:
+        sorgente = sqlite3.connect(f"file:{sorgente_path}?mode=ro", uri=True)
+        destinazione = sqlite3.connect(destinazione_path)
+        try:
+            sorgente.backup(destinazione)
+        finally:
+            destinazione.close()
+            sorgente.close()
+
+    ripristinati = 0
+    for relpath, sha256 in manifest['file'].items():
+        destinazione_path = os.path.join(BASE_DIR, relpath)
+        if os.path.exists(destinazione_path) or not os.path.exists(percorso_backup_blob(sha256)):
+            continue
+        os.makedirs(os.path.dirname(destinazione_path), exist_ok=True)
+        shutil.copyfile(percorso_backup_blob(sha256), destinazione_path)
+        ripristinati += 1
+
+    # Lo snapshot potrebbe precedere tabelle o colonne più recenti
+    init_db()
+    click.echo(f"✅ Ripristinato {nome}: {ripristinati} file caricati ricopiati dal backup")
+
+# =============================================
+# ESPORTAZIONE E IMPORTAZIONE MASSIVA
+# =============================================
+# /esporta e `flask duvri esporta` producono un flusso scritto man mano
+# nella risposta HTTP o nel file. Il formato JSONL trasferisce i DUVRI tra
+# installazioni: dopo un'intestazione c'è un record per DUVRI, con allegati,
+# firme, extra-costi e revisioni. Ogni record è preceduto dai suoi file
+# caricati, in blocchi base64 ciascuno su una riga. Il formato CSV serve al
+# data warehouse: una riga tipizzata per DUVRI con il dettaglio dei costi,
+# oppure il registro degli extra-costi. I DUVRI sono letti a pagine per
+# chiave, con una connessione breve per pagina: nessuna transazione di
+# lettura resta aperta mentre il client scarica. La memoria usata non
+# dipende né dal numero di DUVRI né dalla dimensione dei file.
+# L'importazione legge il JSONL riga per riga e assegna nuovi id a DUVRI e
+# righe collegate. Inserisce i DUVRI a lotti di IMPORTAZIONE_LOTTO, una
+# transazione per lotto. I file passano dallo store per contenuto, quindi
+# un contenuto già presente non viene duplicato.
+FORMATO_ESPORTAZIONE = 'duvri-jsonl'
+VERSIONE_ESPORTAZIONE = 1
+ESPORTAZIONE_PAGINA = 100
+ESPORTAZIONE_BLOCCO_FILE = 1024 * 1024
+IMPORTAZIONE_LOTTO = 100
+TABELLE_ESPORTAZIONE = ('allegati', 'firme_digitali', 'extra_costi_sicurezza', 'revisioni_duvri')
+
+# Colonne che hanno senso solo nell'installazione di origine
+COLONNE_LOCALI = {
+    'duvri': ('link_appaltatore', 'committente_da', 'appaltatore_da', 'eliminato_il', 'archiviato_il'),
+    'allegati': ('path',),
+    'firme_digitali': ('path', 'origine'),
+    'extra_costi_sicurezza': tuple(documento['colonna'] for documento in DOCUMENTI_EXTRA_COSTI.values()),
+    'revisioni_duvri': (),
+}
+
+COLONNE_CSV_DUVRI = [
+    'id', 'nome_progetto', 'stato', 'archiviato', 'tipo_duvri', 'fase_appalto', 'created_at', 'updated_at',
+    'committente', 'oggetto', 'ragione_sociale', 'max_addetti', 'durata_giorni',
+    'importo_gara_base', 'costi_inclusi_gara', 'costi_sicurezza_gara', 'allegati',
+    'firma_committente', 'firma_appaltatore',
+    'scenario_costi', 'esito_costi', 'scenario_normativo',
+    *[voce for voce, _ in VOCI_COSTI_SICUREZZA],
+    'totale_operativo', 'costi_gara', 'delta', 'percentuale_gara',
+    'extra_costi_importo', 'extra_costi_stato',
+]
+TABELLE_CSV = ('duvri', 'extra_costi')
+
+def _pagine_duvri(archiviati=False, tabelle=TABELLE_ESPORTAZIONE):
+    """
+    DUVRI attivi (o archiviati) con le righe collegate, per id crescente
+
+    Ogni pagina di ESPORTAZIONE_PAGINA DUVRI usa una connessione propria,
+    chiusa prima di restituire i DUVRI: tra una pagina e l'altra le
+    scritture non aspettano il consumatore del flusso.
+    """
+    schema, sorgente = ('archivio', 'archivio.duvri') if archiviati else ('main', 'duvri_completi')
+    ultimo = ''
+    while True:
+        conn = get_db_connection()
+        try:
+            righe = [dict(row) for row in conn.execute(
+                f'SELECT * FROM {sorgente} WHERE id > ? ORDER BY id LIMIT ?', (ultimo, ESPORTAZIONE_PAGINA))]
+            collegate = {riga['id']: {tabella: [] for tabella in tabelle} for riga in righe}
+            segnaposti = ','.join('?' * len(righe))
+            for tabella in (tabelle if righe else ()):
+                for row in conn.execute(f'SELECT * FROM {schema}.{tabella} WHERE duvri_id IN ({segnaposti}) ORDER BY rowid',
+                                        list(collegate)):
+                    collegate[row['duvri_id']][tabella].append(dict(row))
+        finally:
+            conn.close()
+        if not righe:
+            return
+        for riga in righe:
+            yield riga, collegate[riga['id']]
+        ultimo = righe[-1]['id']
+
+def _senza_colonne_locali(tabella, riga):
+    return {colonna: valore for colonna, valore in riga.items() if colonna not in COLONNE_LOCALI[tabella]}
+
+def _righe_file(sha256, path):
+    """Contenuto del file in righe JSONL da ESPORTAZIONE_BLOCCO_FILE byte (base64)"""
+    dimensione = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        blocco = 0
+        while True:
+            dati = f.read(ESPORTAZIONE_BLOCCO_FILE)
+            fine = f.tell() >= dimensione
+            yield json.dumps({
+                'tipo': 'file', 'sha256': sha256, 'dimensione': dimensione, 'blocco': blocco,
+                'dati': base64.b64encode(dati).decode('ascii'), 'fine': fine
+            }) + '\n'
+            if fine:
+                return
+            blocco += 1
+
+def esporta_jsonl(archivio=False, con_file=True):
+    """
+    Righe JSONL dei DUVRI attivi (e archiviati con archivio=True)
+
+    Ogni file caricato viene inviato una sola volta, prima del primo DUVRI
+    che lo usa; con con_file=False i record citano solo lo sha256.
+    """
+    yield json.dumps({
+        'tipo': 'intestazione', 'formato': FORMATO_ESPORTAZIONE, 'versione': VERSIONE_ESPORTAZIONE,
+        'esportato': datetime.now().isoformat(timespec='seconds'), 'file': con_file
+    }) + '\n'
+
+    inviati = set()
+    for archiviati in ((False, True) if archivio else (False,)):
+        for duvri, collegate in _pagine_duvri(archiviati):
+            file_duvri = [(riga['sha256'], riga['path']) for tabella in ('allegati', 'firme_digitali')
+                          for riga in collegate[tabella]]
+            if duvri['duvri_estar_filename']:
+                if archiviati and duvri['duvri_estar_sha256']:
+                    estar_path = percorso_blob_archivio(duvri['duvri_estar_sha256'])
+                else:
+                    estar_path = percorso_duvri_estar(duvri['duvri_estar_filename'], duvri['duvri_estar_sha256'])
+                if not duvri['duvri_estar_sha256'] and os.path.exists(estar_path):
+                    duvri['duvri_estar_sha256'] = calcola_sha256(estar_path)
+                file_duvri.append((duvri['duvri_estar_sha256'], estar_path))
+
+            if con_file:
+                for sha256, path in file_duvri:
+                    if sha256 and sha256 not in inviati and path and os.path.exists(path):
+                        inviati.add(sha256)
+                        yield from _righe_file(sha256, path)
+
+            for revisione in collegate['revisioni_duvri']:
+                if revisione['dati'] is not None:
+                    revisione['dati'] = base64.b64encode(revisione['dati']).decode('ascii')
+            record = {'tipo': 'duvri', 'archiviato': archiviati, 'duvri': _senza_colonne_locali('duvri', duvri)}
+            for tabella in TABELLE_ESPORTAZIONE:
+                record[tabella] = [_senza_colonne_locali(tabella, riga) for riga in collegate[tabella]]
+            yield json.dumps(record, ensure_ascii=False, default=str) + '\n'
+
+def _riga_csv(valori):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(valori)
+    return buffer.getvalue()
+
+def _proiezione_duvri(duvri, collegate, archiviato):
+    """Riga CSV tipizzata del DUVRI: numeri come numeri, flag come 0/1, date ISO"""
+    committente = json.loads(duvri['committente_data']) if duvri['committente_data'] else {}
+    appaltatore = json.loads(duvri['appaltatore_data']) if duvri['appaltatore_data'] else {}
+    # Senza cache: la cache dei confronti crescerebbe con il numero di DUVRI esportati
+    confronto = _calcola_confronto_costi(duvri['id'], {'committente': committente, 'appaltatore': appaltatore})
+    costi = confronto.get('costi_operativi_dict') or {}
+    firme = {firma['ruolo']: firma['data_firma'] for firma in sorted(collegate['firme_digitali'],
+                                                                      key=lambda f: f['data_firma'] or '')}
+    extra_costi = collegate['extra_costi_sicurezza']
+
+    def numero(colonna, chiave=None):
+        valore = duvri[colonna] if duvri[colonna] is not None else committente.get(chiave or colonna)
+        return safe_float(valore) if valore not in (None, '') else None
+
+    riga = {
+        'id': duvri['id'],
+        'nome_progetto': duvri['nome_progetto'],
+        'stato': duvri['stato'],
+        'archiviato': int(archiviato),
+        'tipo_duvri': duvri['tipo_duvri'],
+        'fase_appalto': duvri['fase_appalto'],
+        'created_at': duvri['created_at'],
+        'updated_at': duvri['updated_at'],
+        'committente': committente.get('nome'),
+        'oggetto': committente.get('oggetto'),
+        'ragione_sociale': appaltatore.get('ragione_sociale'),
+        'max_addetti': safe_float(appaltatore.get('max_addetti')) if appaltatore.get('max_addetti') else None,
+        'durata_giorni': safe_float(appaltatore.get('durata_giorni')) if appaltatore.get('durata_giorni') else None,
+        'importo_gara_base': numero('importo_gara_base'),
+        'costi_inclusi_gara': int(bool(duvri['costi_inclusi_gara'] or committente.get('costi_inclusi_gara'))),
+        'costi_sicurezza_gara': numero('costi_sicurezza_gara'),
+        'allegati': len(collegate['allegati']),
+        'firma_committente': firme.get('committente'),
+        'firma_appaltatore': firme.get('appaltatore'),
+        'scenario_costi': confronto.get('tipo'),
+        'esito_costi': confronto.get('stato'),
+        'scenario_normativo': confronto.get('scenario_normativo'),
+        'totale_operativo': round(confronto.get('totale_operativo') or 0, 2),
+        'costi_gara': confronto.get('costi_gara'),
+        'delta': confronto.get('delta'),
+        'percentuale_gara': round(confronto['percentuale_gara'], 2) if confronto.get('percentuale_gara') is not None else None,
+        'extra_costi_importo': sum(safe_float(extra['importo']) for extra in extra_costi) if extra_costi else None,
+        'extra_costi_stato': extra_costi[-1]['stato'] if extra_costi else None,
+    }
+    for voce, _ in VOCI_COSTI_SICUREZZA:
+        riga[voce] = costi.get(voce)
+    return riga
+
+def esporta_csv(tabella='duvri', archivio=False):
+    """Righe CSV: proiezione dei DUVRI con i costi ('duvri') o registro degli extra-costi ('extra_costi')"""
+    if tabella == 'duvri':
+        yield _riga_csv(COLONNE_CSV_DUVRI)
+        tabelle = ('allegati', 'firme_digitali', 'extra_costi_sicurezza')
+    else:
+        conn = get_db_connection()
+        colonne = [row['name'] for row in conn.execute('PRAGMA main.table_info(extra_costi_sicurezza)')
+                   if row['name'] not in COLONNE_LOCALI['extra_costi_sicurezza'] and row['name'] != 'duvri_id']
+        conn.close()
+        yield _riga_csv(['duvri_id', 'nome_progetto', 'archiviato', *colonne])
+        tabelle = ('extra_costi_sicurezza',)
+
+    for archiviati in ((False, True) if archivio else (False,)):
+        for duvri, collegate in _pagine_duvri(archiviati, tabelle):
+            if tabella == 'duvri':
+                proiezione = _proiezione_duvri(duvri, collegate, archiviati)
+                yield _riga_csv(proiezione[colonna] for colonna in COLONNE_CSV_DUVRI)
+                continue
+            for extra in collegate['extra_costi_sicurezza']:
+                yield _riga_csv([duvri['id'], duvri['nome_progetto'], int(archiviati),
+                                 *(extra[colonna] for colonna in colonne)])
+
+def _aggiungi_riferimento_blob(conn, sha256):
+    """Un riferimento in più a un blob già nello store; False se il contenuto non è presente"""
+    return conn.execute('UPDATE blob_upload SET riferimenti = riferimenti + 1 WHERE sha256 = ?',
+                        (sha256,)).rowcount > 0
+
+def _importa_lotto(lotto, colonne, esito):
+    """Inserisce un lotto di record DUVRI in una transazione, con nuovi id per DUVRI e righe collegate"""
+    nuovi = []
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for record in lotto:
+            nuovo_id = str(uuid.uuid4())[:8]
+            esito['id'][record['duvri']['id']] = nuovo_id
+            duvri = {colonna: valore for colonna, valore in record['duvri'].items() if colonna in colonne['duvri']}
+            duvri.update(id=nuovo_id, link_appaltatore=str(uuid.uuid4()))
+            if duvri.get('duvri_estar_sha256') and not _aggiungi_riferimento_blob(conn, duvri['duvri_estar_sha256']):
+                esito['file_mancanti'] += 1
+            righe = {'duvri': [duvri]}
+
+            for tabella in TABELLE_ESPORTAZIONE:
+                righe[tabella] = []
+                for originale in record.get(tabella, []):
+                    riga = {colonna: valore for colonna, valore in originale.items() if colonna in colonne[tabella]}
+                    riga['duvri_id'] = nuovo_id
+                    if 'id' in colonne[tabella]:
+                        riga['id'] = str(uuid.uuid4())[:8]
+                    if 'path' in colonne[tabella]:
+                        sha256 = riga.get('sha256')
+                        if not sha256 or not _aggiungi_riferimento_blob(conn, sha256):
+                            esito['file_mancanti'] += 1
+                        riga['path'] = percorso_blob_upload(sha256) if sha256 else None
+                    if tabella == 'revisioni_duvri' and riga.get('dati') is not None:
+                        riga['dati'] = base64.b64decode(riga['dati'])
+                    righe[tabella].append(riga)
+
+            for tabella, elenco in righe.items():
+                for riga in elenco:
+                    conn.execute(
+                        f"INSERT INTO {tabella} ({', '.join(riga)}) VALUES ({', '.join(':' + c for c in riga)})",
+                        riga
+                    )
+            nuovi.append((nuovo_id, bool(righe['revisioni_duvri'])))
+        conn.commit()
+    finally:
+        conn.close()
+
+    for nuovo_id, con_revisioni in nuovi:
+        if not con_revisioni:
+            registra_revisione(nuovo_id, 'importazione')
+    esito['duvri'] += len(lotto)
+
+def importa_jsonl(righe):
+    """
+    Importa un flusso JSONL prodotto da esporta_jsonl (iterabile di righe di testo)
+
+    I DUVRI archiviati nell'origine entrano tra quelli attivi: la manutenzione
+    li riporta in archivio se chiusi da oltre ARCHIVIO_GIORNI. Se il flusso
+    si interrompe i lotti già inseriti restano importati.
+
+    Returns:
+        dict: duvri e file importati, file mancanti, id originale → nuovo id
+    """
+    esito = {'duvri': 0, 'file': 0, 'file_mancanti': 0, 'id': {}}
+    conn = get_db_connection()
+    colonne = {tabella: {row['name'] for row in conn.execute(f'PRAGMA main.table_info({tabella})')}
+               for tabella in ('duvri', *TABELLE_ESPORTAZIONE)}
+    conn.close()
+
+    # Ogni file ricevuto tiene un riferimento finché i DUVRI del flusso non hanno aggiunto i propri
+    ricevuti = set()
+    ricezione = None
+    intestazione = None
+    lotto = []
+    try:
+        for numero, riga in enumerate(righe, 1):
+            if not riga.strip():
+                continue
+            record = json.loads(riga)
+            if intestazione is None:
+                intestazione = record
+                if record.get('formato') != FORMATO_ESPORTAZIONE or record.get('versione', 0) > VERSIONE_ESPORTAZIONE:
+                    raise ValueError(f"formato non supportato: {record.get('formato')} v{record.get('versione')}")
+                continue
+
+            if record['tipo'] == 'file':
+                if record['blocco'] == 0:
+                    tmp_path = percorso_temporaneo_upload()
+                    ricezione = {'sha256': record['sha256'], 'path': tmp_path, 'file': open(tmp_path, 'wb'),
+                                 'hash': hashlib.sha256(), 'blocco': 0}
+                elif not ricezione or (ricezione['sha256'], ricezione['blocco']) != (record['sha256'], record['blocco']):
+                    raise ValueError(f"riga {numero}: blocco {record['blocco']} del file {record['sha256'][:12]} fuori sequenza")
+                dati = base64.b64decode(record['dati'])
+                ricezione['file'].write(dati)
+                ricezione['hash'].update(dati)
+                ricezione['blocco'] += 1
+                if record['fine']:
+                    ricezione['file'].close()
+                    if ricezione['hash'].hexdigest() != record['sha256']:
+                        raise ValueError(f"riga {numero}: il contenuto del file {record['sha256'][:12]} non corrisponde")
+                    archivia_upload(ricezione['path'], record['sha256'])
+                    ricevuti.add(record['sha256'])
+                    esito['file'] += 1
+                    ricezione = None
+
+            elif record['tipo'] == 'duvri':
+                lotto.append(record)
+                if len(lotto) >= IMPORTAZIONE_LOTTO:
+                    _importa_lotto(lotto, colonne, esito)
+                    lotto = []
+        if lotto:
+            _importa_lotto(lotto, colonne, esito)
+    finally:
+        if ricezione:
+            ricezione['file'].close()
+            if os.path.exists(ricezione['path']):
+                os.remove(ricezione['path'])
+        for sha256 in ricevuti:
+            rilascia_upload(sha256)
+
+    print(f"📥 Importati {esito['duvri']} DUVRI e {esito['file']} file"
+          + (f" ({esito['file_mancanti']} file non inclusi nell'esportazione)" if esito['file_mancanti'] else ''))
+    return esito
+
+@app.route('/esporta')
+def esporta():
+    """Esportazione in streaming: ?formato=jsonl|csv, &tabella=duvri|extra_costi (CSV), &archivio=1, &file=0 (JSONL)"""
+    formato = request.args.get('formato', 'jsonl')
+    archivio = request.args.get('archivio') == '1'
+    tabella = request.args.get('tabella', 'duvri')
+    if formato == 'csv' and tabella in TABELLE_CSV:
+        flusso, mimetype, nome = esporta_csv(tabella, archivio), 'text/csv', f"duvri_{tabella}"
+    elif formato == 'jsonl':
+        flusso, mimetype, nome = esporta_jsonl(archivio, request.args.get('file', '1') == '1'), 'application/x-ndjson', 'duvri'
+    else:
+        flash('Formato di esportazione non valido.', 'danger')
+        return redirect(url_for('admin_dashboard'))
+
+    response = app.response_class(stream_with_context(flusso), mimetype=mimetype)
+    estensione = 'csv' if formato == 'csv' else 'jsonl'
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename="{nome}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{estensione}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+@app.route('/importa', methods=['POST'])
+def importa():
+    """Importa un file JSONL esportato da un'altra installazione"""
+    if (request.content_length or 0) > app.config['UPLOAD_DIMENSIONE_MAX_MB'] * 1024 * 1024:
+        flash(f"File oltre il limite di {app.config['UPLOAD_DIMENSIONE_MAX_MB']} MB", 'danger')
+        return redirect(url_for('admin_dashboard'))
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('Nessun file selezionato.', 'danger')
+        return redirect(url_for('admin_dashboard'))
+
+    try:
+        esito = importa_jsonl(io.TextIOWrapper(file.stream, encoding='utf-8'))
+    except (ValueError, KeyError) as e:
+        flash(f'❌ File di importazione non valido: {e}', 'danger')
+    else:
+        sync_all_duvri_from_db()
+        messaggio = f"✅ Importati {esito['duvri']} DUVRI ({esito['file']} file)"
+        if esito['file_mancanti']:
+            messaggio += f"; {esito['file_mancanti']} file non erano inclusi nell'esportazione"
+        flash(messaggio, 'success')
+    return redirect(url_for('admin_dashboard'))
+
+@duvri_cli.command('esporta')
+@click.option('--formato', type=click.Choice(['jsonl', 'csv']), default='jsonl', show_default=True)
+@click.option('--tabella', type=click.Choice(TABELLE_CSV), default='duvri', show_default=True,
+              help='Solo CSV: proiezione dei DUVRI o registro degli extra-costi')
+@click.option('--archivio', is_flag=True, help='Includi i DUVRI archiviati')
+@click.option('--senza-file', is_flag=True, help='Solo JSONL: non includere i file caricati')
+@click.option('--output', 'output_path', type=click.Path(dir_okay=False),
+              help='File di destinazione (default: output/esportazione_<data>.<formato>)')
+def esporta_cli(formato, tabella, archivio, senza_file, output_path):
+    """Esporta i DUVRI in JSONL (completo) o CSV (per il data warehouse)"""
+    init_db()
+    if not output_path:
+        suffisso = f"_{tabella}" if formato == 'csv' else ''
+        output_path = os.path.join(BASE_DIR, 'output',
+                                   f"esportazione{suffisso}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    flusso = esporta_csv(tabella, archivio) if formato == 'csv' else esporta_jsonl(archivio, not senza_file)
+    righe = 0
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        for riga in flusso:
+            f.write(riga)
+            righe += 1
+    click.echo(f"✅ Esportazione {formato}: {righe} righe in {output_path} ({os.path.getsize(output_path)} bytes)")
+
+@duvri_cli.command('importa')
+@click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+def importa_cli(file_path):
+    """Importa un file JSONL prodotto da `flask duvri esporta`"""
+    init_db()
+    with open(file_path, encoding='utf-8') as f:
+        try:
+            esito = importa_jsonl(f)
+        except (ValueError, KeyError) as e:
+            raise click.ClickException(f"File di importazione non valido: {e}")
+    for originale, nuovo in esito['id'].items():
+        click.echo(f"{originale} → {nuovo}")
+    click.echo(f"✅ Importati {esito['duvri']} DUVRI e {esito['file']} file")
+
+# =============================================
+# ANTEPRIMA DOCUMENTO
+# =============================================
+# Durante la compilazione il documento si controlla in HTML (stesso template
+# del PDF, con i fogli e le interruzioni di pagina visibili) oppure con un PDF
+# a bassa fedeltà delle prime pagine: nessuna unione con paragrafi e allegati,
+# nessun file scritto. Le versioni complete restano quelle per la firma e
+# l'archivio prodotte da genera_artefatto_duvri.
+ANTEPRIMA_PAGINE_DEFAULT = 3
+ANTEPRIMA_PAGINE_MAX = 10
+
+def _risposta_anteprima(response):
+    """Le anteprime riflettono i dati del momento: mai in cache"""
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/anteprima')
+def anteprima_duvri():
+    """Anteprima HTML del DUVRI corrente, senza motore PDF"""
+    duvri_id = session.get('current_duvri_id', 'unknown')
+    dati_pdf = prepara_dati_per_pdf(duvri_id, get_current_duvri_data())
+    html_content = render_template(
+        "pdf_template.html",
+        anteprima=True,
+        asset_mode='inline',
+        pagine_anteprima=ANTEPRIMA_PAGINE_DEFAULT,
+        **dati_pdf
+    )
+    return _risposta_anteprima(make_response(html_content))
+
+def anteprima_pdf_duvri(dati_pdf, max_pagine, traccia):
+    """
+    PDF delle prime max_pagine pagine, costruito interamente in memoria
+
+    Le parti dinamiche sono convertite solo finché servono pagine; i capitoli
+    statici sono presi dalla cache se già presenti, altrimenti convertiti al volo.
+
+    Returns:
+        BytesIO: PDF di anteprima, None se nessun motore PDF ha funzionato
+    """
+    with traccia.fase('template'):
+        html_content = render_template("pdf_template.html", capitoli_separati=True, **dati_pdf)
+    apertura, parti = dividi_in_capitoli(html_content)
+
+    writer = PyPDF2.PdfWriter()
+    with traccia.fase('motore'):
+        for i, parte in enumerate(parti):
+            if len(writer.pages) >= max_pagine:
+                break
+            if i % 2:
+                sorgente = percorso_capitolo_statico(parte)
+                html_parte = None
+                if not os.path.exists(sorgente):
+                    html_parte = apertura + str(frammento_statico(parte)) + _CHIUSURA_DOCUMENTO
+            else:
+                html_parte = html_parte_dinamica(apertura, parti, i) if apertura else parte
+                if not html_parte:
+                    continue
+            if html_parte:
+                sorgente = io.BytesIO()
+                if not genera_pdf_da_html(html_parte, sorgente):
+                    return None
+                sorgente.seek(0)
+            for pagina in PyPDF2.PdfReader(sorgente).pages[:max_pagine - len(writer.pages)]:
+                writer.add_page(pagina)
+
+    pdf_bytes = io.BytesIO()
+    writer.write(pdf_bytes)
+    pdf_bytes.seek(0)
+    traccia.registra(pagine=len(writer.pages), pdf_finale_bytes=pdf_bytes.getbuffer().nbytes)
+    return pdf_bytes
+
+@app.route('/anteprima/pdf')
+def anteprima_pdf():
+    """PDF a bassa fedeltà con le prime pagine del DUVRI corrente (?pagine=N)"""
+    duvri_id = session.get('current_duvri_id', 'unknown')
+    pagine = max(1, min(request.args.get('pagine', ANTEPRIMA_PAGINE_DEFAULT, type=int), ANTEPRIMA_PAGINE_MAX))
+    traccia = TracciaPDF('anteprima', duvri_id)
 
-        if not os.path.exists(pdf_base_path):
-            print(f"❌ BLOCCO: File PDF non trovato: {pdf_base_path}")
-            flash("❌ Errore: PDF generato ma file non trovato")
-            return redirect(url_for("summary"))
+    with traccia.fase('dati'):
+        data = get_current_duvri_data()
+        dati_pdf = prepara_dati_per_pdf(duvri_id, data)
+    pdf_bytes = anteprima_pdf_duvri(dati_pdf, pagine, traccia)
+    if pdf_bytes is None:
+        traccia.chiudi('nessun_motore')
+        flash("❌ Nessun motore PDF funzionante. Installa xhtml2pdf o WeasyPrint.")
+        return redirect(url_for("summary"))
 
-        print(f"✅ PDF base verificato: {pdf_base_path}")
+    response = send_file(
+        pdf_bytes,
+        mimetype='application/pdf',
+        download_name=nome_download_duvri(data, '_anteprima'),
+        as_attachment=False
+    )
+    traccia.chiudi()
+    return risposta_con_traccia(_risposta_anteprima(response), traccia)
 
-        # STEP 9: Unione con allegati
-        print("\n📎 STEP 9: Unione con allegati PDF")
-        try:
-            pdf_finale_path = unisci_pdf_duvri(duvri_id, pdf_base_path, output_path_completo)
-            print(f"✅ PDF finale: {pdf_finale_path}")
-            print(f"📊 Dimensione finale: {os.path.getsize(pdf_finale_path)} bytes")
 
-            flash(f"✅ PDF generato con allegati - salvato in: output/{os.path.basename(pdf_finale_path)}")
+@app.route("/pdf")
+def generate_pdf():
+    """Genera PDF del DUVRI con tempi per fase"""
+    duvri_id = session.get('current_duvri_id', 'unknown')
+    traccia = TracciaPDF('pdf', duvri_id)
 
-            print("\n🎉 GENERAZIONE PDF COMPLETATA CON SUCCESSO")
-            print("="*80 + "\n")
+    try:
+        with traccia.fase('dati'):
+            data = get_current_duvri_data()
 
-            return send_file(
-                pdf_finale_path,
-                as_attachment=True,
-                download_name=os.path.basename(pdf_finale_path)
-            )
-        except Exception as e:
-            print(f"⚠️ Errore unione PDF allegati: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+        # Controllo firme
+        firme = data.get("signatures", {})
+        if not (firme.get("committente") and firme.get("appaltatore")):
+            traccia.chiudi('firme_mancanti')
+            flash("❌ Entrambe le parti devono firmare prima di generare il PDF")
+            return redirect(url_for("summary"))
 
-            flash(f"✅ PDF base generato (senza allegati) - salvato in: output/{filename_base}")
+        with traccia.fase('costi'):
+            input_pdf = input_pdf_duvri(duvri_id, data)
+        if app.config.get('PDF_RIPRODUCIBILE') and etag_artefatto('completo', input_pdf[1]) in request.if_none_match:
+            traccia.chiudi('non_modificato')
+            return risposta_con_traccia(risposta_non_modificata(etag_artefatto('completo', input_pdf[1])), traccia)
 
-            print("\n⚠️ GENERAZIONE PDF COMPLETATA (solo base, senza allegati)")
-            print("="*80 + "\n")
+        artefatto = genera_artefatto_duvri(duvri_id, data, 'completo', traccia, input_pdf)
+        if not artefatto:
+            traccia.chiudi('nessun_motore')
+            flash("❌ Nessun motore PDF funzionante. Installa xhtml2pdf o WeasyPrint.")
+            return redirect(url_for("summary"))
 
-            return send_file(
-                output_path_base,
-                as_attachment=True,
-                download_name=filename_base
+        if artefatto['tipo'] == 'completo':
+            download_name = nome_download_duvri(data, '_completo')
+            flash("✅ PDF generato con allegati")
+        else:
+            download_name = nome_download_duvri(data)
+            flash("✅ PDF base generato (senza allegati)")
+
+        with traccia.fase('invio'):
+            response = invia_file(
+                artefatto['path'],
+                'artefatto',
+                download_name=download_name,
+                etag=etag_download(artefatto)
             )
+        traccia.chiudi()
+        return risposta_con_traccia(response, traccia)
 
     except Exception as e:
-        print(f"\n❌❌❌ ERRORE CRITICO GENERAZIONE PDF ❌❌❌")
-        print(f"Errore: {str(e)}")
+        print(f"❌ ERRORE CRITICO GENERAZIONE PDF: {str(e)}")
         import traceback
         print(traceback.format_exc())
-        print("="*80 + "\n")
+        traccia.chiudi('errore')
 
         flash(f"❌ Errore nella generazione del PDF: {str(e)}")
         return redirect(url_for("summary"))
 
 
-def unisci_pdf_duvri(duvri_id, pdf_base_path, output_path_completo):
-    """Unisce il PDF base con tutti i PDF allegati - VERSIONE CON DEBUG"""
-    print("\n" + "-"*60)
-    print("📎 FUNZIONE: unisci_pdf_duvri")
-    print("-"*60)
+def unisci_pdf_duvri(duvri_id, pdf_base_path, output_path_completo, riproducibile=None):
+    """
+    Unisce il PDF base con i paragrafi dei rischi e tutti i PDF allegati
 
+    Con riproducibile=(istante, hash_input) date e /ID del risultato sono fissati dagli input.
+    """
     try:
         merger = PyPDF2.PdfMerger()
-        print("✅ PyPDF2.PdfMerger inizializzato")
 
         # 1. Aggiungi il PDF base
-        print(f"\n📄 Aggiunta PDF base: {pdf_base_path}")
-        if os.path.exists(pdf_base_path):
-            merger.append(pdf_base_path)
-            print(f"✅ PDF base aggiunto ({os.path.getsize(pdf_base_path)} bytes)")
-        else:
+        if not os.path.exists(pdf_base_path):
             raise FileNotFoundError(f"PDF base non trovato: {pdf_base_path}")
+        merger.append(pdf_base_path)
 
-        # 2. Cerca PDF allegati
-        print(f"\n🔍 Ricerca allegati per duvri_id: {duvri_id}")
-        cartella_allegati = os.path.join(current_app.config['UPLOAD_FOLDER'], str(duvri_id))
-        print(f"📂 Percorso cartella allegati: {cartella_allegati}")
-        print(f"📊 Cartella esiste: {os.path.exists(cartella_allegati)}")
-
-        if os.path.exists(cartella_allegati):
-            # Lista tutti i file
-            tutti_i_file = os.listdir(cartella_allegati)
-            print(f"📊 File totali nella cartella: {len(tutti_i_file)}")
-            print(f"📂 Lista completa file: {tutti_i_file}")
-
-            # Filtra solo i PDF
-            pdf_allegati = []
-            for filename in tutti_i_file:
-                if filename.lower().endswith('.pdf'):
-                    full_path = os.path.join(cartella_allegati, filename)
-                    pdf_allegati.append(full_path)
-                    print(f"   ✅ PDF trovato: {filename}")
-
-            print(f"\n📊 Totale PDF allegati trovati: {len(pdf_allegati)}")
-
-            if pdf_allegati:
-                # Ordina i PDF
-                pdf_allegati.sort()
-                print("📊 Ordine di unione:")
-                for i, pdf_path in enumerate(pdf_allegati, 1):
-                    print(f"   {i}. {os.path.basename(pdf_path)}")
-
-                # Aggiungi tutti i PDF
-                for pdf_path in pdf_allegati:
-                    try:
-                        merger.append(pdf_path)
-                        print(f"✅ Aggiunto: {os.path.basename(pdf_path)} ({os.path.getsize(pdf_path)} bytes)")
-                    except Exception as e:
-                        print(f"❌ Errore aggiunta {os.path.basename(pdf_path)}: {str(e)}")
-                        continue
-            else:
-                print("⚠️ Nessun PDF trovato nella cartella allegati")
-        else:
-            print("⚠️ Cartella allegati non esiste - PDF senza allegati")
+        # 1b. Aggiungi i paragrafi della parte statica relativi ai rischi selezionati
+        if current_app.config.get('ALLEGA_PARAGRAFI_RISCHI'):
+            for codice, paragrafo_path, pagine in get_pdf_paragrafi(get_rischi_appaltatore(duvri_id)):
+                try:
+                    merger.append(paragrafo_path, pages=pagine)
+                except Exception as e:
+                    print(f"❌ Errore aggiunta paragrafo {codice}: {str(e)}")
+
+        # 2. Aggiungi solo i PDF allegati che hanno superato il preflight all'upload
+        aggiunti = 0
+        for allegato in get_allegati_list(duvri_id):
+            if allegato['mime_type'] != 'application/pdf':
+                continue
+            if allegato['preflight'] != 'ok':
+                print(f"⚠️ Saltato {allegato['nome_originale']}: preflight {allegato['preflight']}")
+                continue
+            try:
+                merger.append(allegato['path'])
+                aggiunti += 1
+            except Exception as e:
+                print(f"❌ Errore aggiunta {allegato['nome_originale']}: {str(e)}")
 
         # 3. Salva il PDF unito
-        print(f"\n💾 Salvataggio PDF finale: {output_path_completo}")
-        merger.write(output_path_completo)
-        merger.close()
-
-        if os.path.exists(output_path_completo):
-            print(f"✅ PDF unito salvato con successo")
-            print(f"📊 Dimensione: {os.path.getsize(output_path_completo)} bytes")
+        if riproducibile:
+            scrivi_pdf_riproducibile(merger, output_path_completo, *riproducibile)
         else:
-            print(f"❌ File non trovato dopo salvataggio!")
-
-        print("-"*60 + "\n")
+            merger.write(output_path_completo)
+        merger.close()
+        print(f"📎 PDF unito con {aggiunti} allegati: {output_path_completo}")
         return output_path_completo
 
     except Exception as e:
-        print(f"\n❌ ERRORE nell'unione PDF: {str(e)}")
+        print(f"❌ ERRORE nell'unione PDF: {str(e)}")
         import traceback
         print(traceback.format_exc())
-        print("-"*60 + "\n")
         # In caso di errore, restituisci il PDF base
         return pdf_base_path
 
 
+# =============================================
+# INDICE PARAGRAFI RISCHI (DUVRI PARTE STATICA)
+# =============================================
+# I paragrafi 3.3.x richiamati da RISCHI_PARAGRAFI sono descritti nella
+# "DUVRI - Parte statica": l'indice pagine viene costruito una sola volta
+# e ricostruito automaticamente quando il documento di riferimento cambia.
+# Paragrafi brevi possono condividere una pagina: nell'unione le pagine dei
+# paragrafi selezionati sono aggiunte una volta sola.
+PDF_RIFERIMENTO_PARAGRAFI = os.path.join(BASE_DIR, "documents", "DUVRI_STATICO_rev_1_0.pdf")
+PARAGRAFI_CACHE_FOLDER = os.path.join(BASE_DIR, "cache", "paragrafi")
+
+_indice_paragrafi = {}
+_indice_paragrafi_lock = threading.Lock()
+
+def _impronta_file(filepath):
+    """Impronta economica di un file (mtime + dimensione) per invalidare le cache"""
+    stat = os.stat(filepath)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def _chiave_paragrafo(codice):
+    """Chiave di ordinamento numerico per codici tipo '3.3.12'"""
+    return tuple(int(parte) for parte in codice.split('.'))
+
+def _intestazioni_da_outline(reader):
+    """Estrae (pagina, codice, a_inizio_pagina) dai segnalibri del PDF, se presenti"""
+    intestazioni = []
+
+    def visita(voci):
+        for voce in voci:
+            if isinstance(voce, list):
+                visita(voce)
+                continue
+            match = re.match(r'^\s*(\d+(?:\.\d+)*)\s', voce.title or '')
+            if match:
+                # Dal segnalibro non sappiamo se il titolo apre la pagina: prudenzialmente no
+                intestazioni.append((reader.get_destination_page_number(voce), match.group(1), False))
+
+    try:
+        visita(reader.outline)
+    except Exception as e:
+        print(f"⚠️ Segnalibri PDF non leggibili: {e}")
+        return []
+    return intestazioni
+
+def _intestazioni_da_testo(reader):
+    """Estrae (pagina, codice, a_inizio_pagina) dai titoli numerati nel testo delle pagine"""
+    intestazioni = []
+    for num_pagina, pagina in enumerate(reader.pages):
+        testo = pagina.extract_text() or ''
+        # Salta l'intestazione ripetuta "... Pagina N di M"
+        match_header = re.search(r'Pagina\s+\d+\s+di\s+\d+', testo)
+        if match_header:
+            testo = testo[match_header.end():]
+
+        righe = [riga for riga in testo.splitlines() if riga.strip()]
+        # Le pagine del sommario (righe con i puntini di guida) non contengono titoli veri
+        if sum(1 for riga in righe if '.....' in riga) >= 3:
+            continue
+
+        for posizione, riga in enumerate(righe):
+            match = re.match(r'^\s*(\d+(?:\.\d+)*)\s+[A-ZÀ-Ý]', riga)
+            if match:
+                intestazioni.append((num_pagina, match.group(1), posizione == 0))
+    return intestazioni
+
+def costruisci_indice_paragrafi(pdf_path):
+    """
+    Costruisce l'indice paragrafo -> intervallo pagine del PDF di riferimento
+
+    Returns:
+        dict: {codice: [prima_pagina, ultima_pagina]} (pagine 0-based, estremi inclusi)
+    """
+    reader = PyPDF2.PdfReader(pdf_path)
+    intestazioni = _intestazioni_da_outline(reader) or _intestazioni_da_testo(reader)
+
+    indice = {}
+    for i, (pagina, codice, _) in enumerate(intestazioni):
+        if codice not in RISCHI_PARAGRAFI or codice in indice:
+            continue
+
+        ultima = len(reader.pages) - 1
+        for pagina_succ, codice_succ, a_inizio in intestazioni[i + 1:]:
+            if codice_succ.startswith(codice + '.'):
+                continue  # sotto-paragrafo: fa parte di questo
+            ultima = pagina_succ - 1 if a_inizio else pagina_succ
+            break
+
+        indice[codice] = [pagina, max(pagina, ultima)]
+
+    return indice
+
+def get_indice_paragrafi():
+    """
+    Restituisce l'indice dei paragrafi con i PDF pre-ritagliati in cache
+
+    L'indice è tenuto in memoria e su disco; viene ricostruito (insieme ai
+    ritagli) solo quando cambia l'impronta del PDF di riferimento.
+    """
+    global _indice_paragrafi
+
+    if not os.path.exists(PDF_RIFERIMENTO_PARAGRAFI):
+        return {}
+
+    impronta = _impronta_file(PDF_RIFERIMENTO_PARAGRAFI)
+    if _indice_paragrafi.get('impronta') == impronta:
+        return _indice_paragrafi
+
+    with _indice_paragrafi_lock:
+        # Un altro thread può aver completato la costruzione nel frattempo
+        if _indice_paragrafi.get('impronta') == impronta:
+            return _indice_paragrafi
+
+        indice_path = os.path.join(PARAGRAFI_CACHE_FOLDER, 'indice.json')
+        if os.path.exists(indice_path):
+            try:
+                with open(indice_path, 'r', encoding='utf-8') as f:
+                    indice_disco = json.load(f)
+                if indice_disco.get('impronta') == impronta and os.path.isdir(indice_disco.get('cartella', '')):
+                    _indice_paragrafi = indice_disco
+                    return _indice_paragrafi
+            except Exception as e:
+                print(f"⚠️ Indice paragrafi su disco non valido: {e}")
+
+        print(f"📑 Costruzione indice paragrafi da {os.path.basename(PDF_RIFERIMENTO_PARAGRAFI)}...")
+        paragrafi = costruisci_indice_paragrafi(PDF_RIFERIMENTO_PARAGRAFI)
+
+        # Ritaglia una volta sola ogni paragrafo in un PDF dedicato
+        cartella = os.path.join(PARAGRAFI_CACHE_FOLDER, impronta)
+        os.makedirs(cartella, exist_ok=True)
+        reader = PyPDF2.PdfReader(PDF_RIFERIMENTO_PARAGRAFI)
+        for codice, (prima, ultima) in paragrafi.items():
+            writer = PyPDF2.PdfWriter()
+            for num_pagina in range(prima, ultima + 1):
+                writer.add_page(reader.pages[num_pagina])
+            ritaglio_path = os.path.join(cartella, f"{codice}.pdf")
+            tmp_path = f"{ritaglio_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                writer.write(f)
+            os.replace(tmp_path, ritaglio_path)
+
+        nuovo_indice = {
+            'impronta': impronta,
+            'sorgente': os.path.basename(PDF_RIFERIMENTO_PARAGRAFI),
+            'cartella': cartella,
+            'paragrafi': paragrafi
+        }
+        tmp_path = f"{indice_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(nuovo_indice, f, indent=2)
+        os.replace(tmp_path, indice_path)
+
+        # Rimuove i ritagli delle versioni precedenti del documento
+        for voce in os.listdir(PARAGRAFI_CACHE_FOLDER):
+            voce_path = os.path.join(PARAGRAFI_CACHE_FOLDER, voce)
+            if os.path.isdir(voce_path) and voce != impronta:
+                shutil.rmtree(voce_path, ignore_errors=True)
+
+        print(f"✅ Indice paragrafi: {len(paragrafi)} paragrafi indicizzati")
+        _indice_paragrafi = nuovo_indice
+        return _indice_paragrafi
+
+def paragrafi_da_rischi(rischi):
+    """Converte i rischi selezionati dall'appaltatore nei codici paragrafo 3.3.x"""
+    codici_per_descrizione = {descrizione: codice for codice, descrizione in RISCHI_PARAGRAFI.items()}
+    codici = set()
+    for rischio in rischi or []:
+        if rischio in codici_per_descrizione:
+            codici.add(codici_per_descrizione[rischio])
+        else:
+            match = re.match(r'^\s*(3\.3\.\d+)\b', rischio)
+            if match and match.group(1) in RISCHI_PARAGRAFI:
+                codici.add(match.group(1))
+    return sorted(codici, key=_chiave_paragrafo)
+
+def get_rischi_appaltatore(duvri_id):
+    """Legge dal database i rischi selezionati dall'appaltatore"""
+    try:
+        conn = get_db_connection()
+        row = conn.execute('SELECT appaltatore_data FROM duvri_completi WHERE id = ?', (duvri_id,)).fetchone()
+        conn.close()
+        if row and row['appaltatore_data']:
+            return json.loads(row['appaltatore_data']).get('rischi', [])
+    except Exception as e:
+        print(f"⚠️ Errore lettura rischi appaltatore: {e}")
+    return []
+
+def get_pdf_paragrafi(rischi):
+    """
+    Restituisce le pagine della parte statica applicabili ai rischi selezionati
+
+    I paragrafi che condividono pagine sono fusi in un unico intervallo del
+    PDF di riferimento, così ogni pagina compare una volta sola; gli altri
+    usano il PDF pre-ritagliato in cache.
+
+    Returns:
+        list: [(codici, percorso_pdf, pagine)] in ordine di pagina, con
+              pagine=None per un ritaglio intero o (inizio, fine) 0-based, fine esclusa
+    """
+    try:
+        indice = get_indice_paragrafi()
+    except Exception as e:
+        print(f"❌ Errore indice paragrafi: {e}")
+        return []
+
+    intervalli = sorted(
+        (indice['paragrafi'][codice][0], indice['paragrafi'][codice][1], codice)
+        for codice in paragrafi_da_rischi(rischi)
+        if codice in indice.get('paragrafi', {})
+    )
+
+    # Raggruppa i paragrafi le cui pagine si sovrappongono
+    gruppi = []
+    for prima, ultima, codice in intervalli:
+        if gruppi and prima <= gruppi[-1][1]:
+            gruppi[-1][1] = max(gruppi[-1][1], ultima)
+            gruppi[-1][2].append(codice)
+        else:
+            gruppi.append([prima, ultima, [codice]])
+
+    percorsi = []
+    for prima, ultima, codici in gruppi:
+        if len(codici) == 1:
+            percorsi.append((codici[0], os.path.join(indice['cartella'], f"{codici[0]}.pdf"), None))
+        else:
+            percorsi.append(('+'.join(codici), PDF_RIFERIMENTO_PARAGRAFI, (prima, ultima + 1)))
+    return percorsi
+
 # =============================================
 # ROUTE DEBUG AGGIUNTIVA
 # =============================================
@@ -2996,14 +7079,12 @@ def test_pdf_generation():
             'appaltatore_nome': data.get('appaltatore', {}).get('ragione_sociale', 'N/A'),
         })
 
-        cartella_allegati = os.path.join(app.config['UPLOAD_FOLDER'], f"duvri_{duvri_id}")
-        if os.path.exists(cartella_allegati):
-            pdf_files = [f for f in os.listdir(cartella_allegati) if f.lower().endswith('.pdf')]
-            diagnostica['num_allegati_pdf'] = len(pdf_files)
-            diagnostica['allegati_list'] = pdf_files
-        else:
-            diagnostica['num_allegati_pdf'] = 0
-            diagnostica['allegati_list'] = []
+        pdf_files = [
+            a['nome_originale'] for a in get_allegati_list(duvri_id)
+            if a['mime_type'] == 'application/pdf'
+        ]
+        diagnostica['num_allegati_pdf'] = len(pdf_files)
+        diagnostica['allegati_list'] = pdf_files
 
     # Formatta output HTML
     output = "<h1>🔍 Diagnostica Generazione PDF</h1><pre>"
@@ -3022,11 +7103,13 @@ def reset_data():
     if duvri_id:
         conn = get_db_connection()
         conn.execute(
-            'UPDATE duvri SET committente_data = NULL, appaltatore_data = NULL, signatures = NULL WHERE id = ?',
+            '''UPDATE duvri SET committente_data = NULL, appaltatore_data = NULL, signatures = NULL,
+               committente_da = NULL, appaltatore_da = NULL WHERE id = ?''',
             (duvri_id,)
         )
         conn.commit()
         conn.close()
+        registra_revisione(duvri_id)
 
     session.clear()
     flash("Dati resettati con successo. Puoi iniziare una nuova compilazione.")
@@ -3052,15 +7135,30 @@ def download_pdf(filename):
             flash("File non trovato")
             return redirect(url_for('admin_dashboard'))  # ← CAMBIA QUI
 
-        return send_file(
-            pdf_path,
-            as_attachment=False,
-            download_name=real_filename
-        )
+        return invia_file(pdf_path, 'riferimento', download_name=real_filename, as_attachment=False)
     except Exception as e:
         flash(f"Errore: {str(e)}")
         return redirect(url_for('admin_dashboard'))
 
+@app.route("/download_paragrafo/<codice>")
+def download_paragrafo(codice):
+    """Serve il solo paragrafo 3.3.x della parte statica, già ritagliato in cache"""
+    if codice not in RISCHI_PARAGRAFI:
+        flash("Paragrafo non valido")
+        return redirect(url_for('admin_dashboard'))
+
+    percorsi = get_pdf_paragrafi([codice])
+    if not percorsi or not os.path.exists(percorsi[0][1]):
+        flash("Paragrafo non disponibile")
+        return redirect(url_for('admin_dashboard'))
+
+    return invia_file(
+        percorsi[0][1],
+        'riferimento',
+        download_name=f"DUVRI_Parte_Statica_{codice}.pdf",
+        as_attachment=False
+    )
+
 @app.route('/debug_pdf')
 def debug_pdf():
     """Pagina di debug per la generazione PDF"""
@@ -3078,15 +7176,13 @@ def debug_pdf():
         'allegati_dir_exists': os.path.exists(os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}"))
     }
 
-    # Conta allegati PDF
-    allegati_dir = os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}")
-    if os.path.exists(allegati_dir):
-        pdf_files = [f for f in os.listdir(allegati_dir) if f.lower().endswith('.pdf')]
-        pdf_info['num_allegati_pdf'] = len(pdf_files)
-        pdf_info['allegati_list'] = pdf_files
-    else:
-        pdf_info['num_allegati_pdf'] = 0
-        pdf_info['allegati_list'] = []
+    # Conta allegati PDF dal registro
+    pdf_files = [
+        a['nome_originale'] for a in get_allegati_list(duvri_id)
+        if a['mime_type'] == 'application/pdf'
+    ]
+    pdf_info['num_allegati_pdf'] = len(pdf_files)
+    pdf_info['allegati_list'] = pdf_files
 
     return render_template('debug_pdf.html', pdf_info=pdf_info)
 
@@ -3105,17 +7201,16 @@ def download_duvri_pdf(duvri_id):
             flash("PDF non disponibile. Il DUVRI non è stato completato.", "warning")
             return redirect(url_for('admin_dashboard'))
 
-        # Cerca il PDF nella cartella output
-        output_dir = "output"
-        if os.path.exists(output_dir):
-            for file in os.listdir(output_dir):
-                if file.startswith(f"DUVRI_{duvri_id}_"):
-                    pdf_path = os.path.join(output_dir, file)
-                    return send_file(
-                        pdf_path,
-                        as_attachment=True,
-                        download_name=f"DUVRI_{duvri['nome_progetto']}.pdf"
-                    )
+        # Cerca nel registro artefatti il documento più avanzato disponibile
+        for tipo in ('firmato', 'completo', 'per_firma', 'base'):
+            artefatto = trova_artefatto(duvri_id, tipo)
+            if artefatto:
+                return invia_file(
+                    artefatto['path'],
+                    'firmato' if tipo == 'firmato' else 'artefatto',
+                    download_name=f"DUVRI_{duvri['nome_progetto']}.pdf",
+                    etag=etag_download(artefatto)
+                )
 
         # Se non trova il PDF, reindirizza alla generazione
         session['current_duvri_id'] = duvri_id
@@ -3125,6 +7220,200 @@ def download_duvri_pdf(duvri_id):
         flash(f"Errore nel recupero del PDF: {str(e)}", "danger")
         return redirect(url_for('admin_dashboard'))
 
+# =============================================
+# REGISTRO FIRME DIGITALI
+# =============================================
+# Ogni PDF firmato caricato è una riga della tabella firme_digitali (ruolo,
+# firmatario, data, hash e blob nello store per contenuto), condivisa da
+# tutti i worker e persistente ai riavvii. Lo stato delle firme di un DUVRI
+# si legge con una sola query: per ogni ruolo vale l'ultimo caricamento.
+# I file .txt dei metadati sono solo un'esportazione opzionale
+# (FIRME_ESPORTA_TXT); quelli degli upload precedenti vengono importati.
+RUOLI_FIRMA = ('appaltatore', 'committente')
+
+def get_firme_digitali(duvri_id):
+    """Ultima firma caricata per ogni ruolo, es. {'appaltatore': {...}}"""
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT * FROM firme_digitali WHERE duvri_id = ? ORDER BY data_firma, created_at',
+        (duvri_id,)
+    ).fetchall()
+    conn.close()
+    return {row['ruolo']: dict(row) for row in rows}
+
+def esporta_metadati_firma(firma):
+    """Scrive il file .txt dei metadati della firma nella cartella del DUVRI (formato storico)"""
+    cartella = os.path.join(app.config["UPLOAD_FOLDER"], f"duvri_{firma['duvri_id']}")
+    os.makedirs(cartella, exist_ok=True)
+    meta_path = os.path.join(cartella, os.path.splitext(firma['nome_file'])[0] + '.txt')
+    with open(meta_path, "w", encoding="utf-8") as meta:
+        meta.write(f"Tipo firma: {firma['ruolo']}\n")
+        meta.write(f"Firmatario: {firma['firmatario']}\n")
+        meta.write(f"Data firma upload: {firma['data_firma']}\n")
+        meta.write(f"DUVRI ID: {firma['duvri_id']}\n")
+        meta.write(f"SHA-256: {firma['sha256']}\n")
+    return meta_path
+
+def _inserisci_firma(conn, firma):
+    """Inserisce una firma nel registro"""
+    conn.execute('''
+        INSERT INTO firme_digitali
+        (id, duvri_id, ruolo, firmatario, data_firma, nome_file, sha256, path, dimensione, origine, revisione, created_at)
+        VALUES (:id, :duvri_id, :ruolo, :firmatario, :data_firma, :nome_file, :sha256, :path, :dimensione, :origine,
+                :revisione, :created_at)
+    ''', {'revisione': None, **firma})
+
+def _leggi_metadati_firma(meta_path):
+    """Legge un file .txt dei metadati ('Chiave: valore' per riga)"""
+    metadati = {}
+    with open(meta_path, encoding="utf-8", errors="replace") as meta:
+        for riga in meta:
+            chiave, separatore, valore = riga.partition(':')
+            if separatore:
+                metadati[chiave.strip()] = valore.strip()
+    return metadati
+
+def importa_firme_da_disco():
+    """
+    Registra una tantum le firme caricate prima della tabella, dai file .txt dei metadati
+
+    Il PDF resta dov'è (o nel blob indicato dal file .txt): lo sposta nello
+    store `flask duvri deduplica-upload --applica`.
+    """
+    if not os.path.exists(UPLOAD_FOLDER):
+        return 0
+
+    try:
+        conn = get_db_connection()
+        importate = {row['origine'] for row in conn.execute(
+            'SELECT origine FROM firme_digitali WHERE origine IS NOT NULL').fetchall()}
+
+        nuove = 0
+        for cartella, _, nomi in sorted(os.walk(UPLOAD_FOLDER)):
+            for nome in sorted(nomi):
+                meta_path = os.path.join(cartella, nome)
+                origine = os.path.relpath(meta_path, BASE_DIR)
+                if not nome.endswith('.txt') or origine in importate:
+                    continue
+
+                metadati = _leggi_metadati_firma(meta_path)
+                ruolo = metadati.get('Tipo firma')
+                if ruolo not in RUOLI_FIRMA or not metadati.get('DUVRI ID'):
+                    print(f"⚠️ Metadati firma incompleti, non importati: {origine}")
+                    continue
+
+                pdf_path = os.path.splitext(meta_path)[0] + '.pdf'
+                sha256 = metadati.get('SHA-256')
+                if sha256 and os.path.exists(percorso_blob_upload(sha256)):
+                    # Il riferimento al blob tenuto dal file .txt passa alla riga
+                    filepath = percorso_blob_upload(sha256)
+                elif os.path.isfile(pdf_path):
+                    filepath, sha256 = pdf_path, calcola_sha256(pdf_path)
+                else:
+                    print(f"⚠️ PDF firmato non trovato per {origine}")
+                    continue
+
+                _inserisci_firma(conn, {
+                    'id': str(uuid.uuid4())[:8],
+                    'duvri_id': metadati['DUVRI ID'],
+                    'ruolo': ruolo,
+                    'firmatario': metadati.get('Firmatario', ''),
+                    'data_firma': metadati.get('Data firma upload', ''),
+                    'nome_file': os.path.basename(pdf_path),
+                    'sha256': sha256,
+                    'path': filepath,
+                    'dimensione': os.path.getsize(filepath),
+                    'origine': origine,
+                    'created_at': datetime.now()
+                })
+                nuove += 1
+
+        conn.commit()
+        conn.close()
+        if nuove:
+            print(f"✍️ Importate {nuove} firme digitali nel registro")
+        return nuove
+
+    except Exception as e:
+        print(f"❌ Errore importazione firme da disco: {e}")
+        return 0
+
+def registra_firma_digitale(duvri_id, tipo_firma, firmatario, filepath, data_firma):
+    """
+    Registra il PDF firmato ricevuto in filepath e aggiorna lo stato delle firme del DUVRI
+
+    Il PDF viene spostato nello store per contenuto e la firma registrata
+    nella tabella firme_digitali.
+    """
+    # 1. Il PDF firmato entra nello store per contenuto
+    blob = archivia_upload(filepath)
+
+    # 2. Gli originali firmati entrano nel registro artefatti e non sono mai rimossi dal budget
+    try:
+        salva_artefatto(duvri_id, 'firmato', blob['path'], sposta=False)
+    except Exception as e:
+        print(f"⚠️ Errore registrazione artefatto firmato: {e}")
+
+    # 3. Registra la firma (con il .txt dei metadati solo se richiesto)
+    firma = {
+        'id': str(uuid.uuid4())[:8],
+        'duvri_id': duvri_id,
+        'ruolo': tipo_firma,
+        'firmatario': firmatario,
+        'data_firma': data_firma,
+        'nome_file': secure_filename(f"{tipo_firma}_{firmatario}_{data_firma.replace(':','-')}.pdf"),
+        'sha256': blob['sha256'],
+        'path': blob['path'],
+        'dimensione': blob['dimensione'],
+        'origine': None,
+        # Revisione dei dati firmata, per confrontarla con le modifiche successive
+        'revisione': registra_revisione(duvri_id) or ultima_revisione(duvri_id),
+        'created_at': datetime.now()
+    }
+    if app.config.get('FIRME_ESPORTA_TXT'):
+        firma['origine'] = os.path.relpath(esporta_metadati_firma(firma), BASE_DIR)
+
+    conn = get_db_connection()
+    _inserisci_firma(conn, firma)
+    conn.commit()
+    conn.close()
+    print(f"✍️ Firma {tipo_firma} registrata per DUVRI {duvri_id}: {firmatario} ({blob['sha256'][:12]})")
+
+    # 4. AGGIORNA STATO DELLE FIRME NEL DUVRI
+    duvri = duvri_list.get(duvri_id, {})
+
+    # ✅ INVIA NOTIFICA quando l'appaltatore completa il DUVRI
+    if tipo_firma == 'appaltatore' and duvri.get('dati_appaltatore'):
+        dati_appaltatore = duvri['dati_appaltatore']
+        dati_committente = duvri.get('dati_committente', {})
+
+        # Invia notifica al committente
+        if dati_committente.get('email'):
+            invia_notifica_semplice(duvri_id, dati_committente, dati_appaltatore)
+            print(f"📧 Notifica inviata a: {dati_committente['email']}")
+        else:
+            print("⚠️ Nessuna email committente trovata")
+
+    # Verifica se entrambe le parti hanno firmato
+    firme = get_firme_digitali(duvri_id)
+    if all(ruolo in firme for ruolo in RUOLI_FIRMA):
+        stato = 'completato_firme_digitali'
+        flash("✅ Documento completamente firmato da entrambe le parti!", "success")
+    else:
+        # Aggiorna lo stato parziale
+        stato = f"firmato_{tipo_firma}"
+        flash(f"✅ Firma {tipo_firma} caricata con successo!", "success")
+
+    if duvri:
+        duvri['stato'] = stato
+    conn = get_db_connection()
+    conn.execute(
+        'UPDATE duvri SET stato = ?, updated_at = ? WHERE id = ?',
+        (stato, datetime.now(), duvri_id)
+    )
+    conn.commit()
+    conn.close()
+
 @app.route("/upload_signed/<tipo_firma>", methods=["GET", "POST"])
 def upload_signed(tipo_firma):
     """Upload del DUVRI firmato digitalmente - supporta committente e appaltatore"""
@@ -3156,73 +7445,11 @@ def upload_signed(tipo_firma):
             return redirect(request.url)
 
         if file and allowed_file(file.filename):
-            # 1. Salva il file PDF nella cartella del DUVRI
-            duvri_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"duvri_{duvri_id}")
-            os.makedirs(duvri_folder, exist_ok=True)
-
-            filename = secure_filename(f"{tipo_firma}_{firmatario}_{data_firma.replace(':','-')}.pdf")
-            filepath = os.path.join(duvri_folder, filename)
+            # Il PDF viene archiviato per contenuto da registra_firma_digitale
+            filepath = percorso_temporaneo_upload()
             file.save(filepath)
 
-            # 2. Salva i metadati
-            meta_path = filepath.replace(".pdf", ".txt")
-            with open(meta_path, "w", encoding="utf-8") as meta:
-                meta.write(f"Tipo firma: {tipo_firma}\n")
-                meta.write(f"Firmatario: {firmatario}\n")
-                meta.write(f"Data firma upload: {data_firma}\n")
-                meta.write(f"DUVRI ID: {duvri_id}\n")
-
-            # 3. AGGIORNA STATO DELLE FIRME NEL DUVRI
-            if duvri_id in duvri_list:
-                # Inizializza la struttura per le firme digitali
-                if 'firme_digitali' not in duvri_list[duvri_id]:
-                    duvri_list[duvri_id]['firme_digitali'] = {}
-
-                # Salva i dati della firma
-                duvri_list[duvri_id]['firme_digitali'][tipo_firma] = {
-                    'firmatario': firmatario,
-                    'data_firma': data_firma,
-                    'file_path': filepath
-                }
-
-                # ✅ INVIA NOTIFICA quando l'appaltatore completa il DUVRI
-                if tipo_firma == 'appaltatore' and duvri_list[duvri_id].get('dati_appaltatore'):
-                    dati_appaltatore = duvri_list[duvri_id]['dati_appaltatore']
-                    dati_committente = duvri_list[duvri_id].get('dati_committente', {})
-
-                    # Invia notifica al committente
-                    if dati_committente.get('email'):
-                        invia_notifica_semplice(duvri_id, dati_committente, dati_appaltatore)
-                        print(f"📧 Notifica inviata a: {dati_committente['email']}")
-                    else:
-                        print("⚠️ Nessuna email committente trovata")
-
-                # Verifica se entrambe le parti hanno firmato
-                firme_completate = all(
-                    ruolo in duvri_list[duvri_id]['firme_digitali']
-                    for ruolo in ['committente', 'appaltatore']
-                )
-
-                if firme_completate:
-                    duvri_list[duvri_id]['stato'] = 'completato_firme_digitali'
-                    flash("✅ Documento completamente firmato da entrambe le parti!", "success")
-                else:
-                    # Aggiorna lo stato parziale
-                    if tipo_firma == 'appaltatore':
-                        duvri_list[duvri_id]['stato'] = 'firmato_appaltatore'
-                    else:
-                        duvri_list[duvri_id]['stato'] = 'firmato_committente'
-
-                    flash(f"✅ Firma {tipo_firma} caricata con successo!", "success")
-
-                # Aggiorna anche nel database
-                conn = get_db_connection()
-                conn.execute(
-                    'UPDATE duvri SET stato = ?, updated_at = ? WHERE id = ?',
-                    (duvri_list[duvri_id]['stato'], datetime.now(), duvri_id)
-                )
-                conn.commit()
-                conn.close()
+            registra_firma_digitale(duvri_id, tipo_firma, firmatario, filepath, data_firma)
 
             return redirect(url_for("summary"))
         else:
@@ -3240,63 +7467,34 @@ def download_per_firma(tipo_firma):
         flash("DUVRI non trovato", "danger")
         return redirect(url_for('summary'))
 
-    duvri = duvri_list[duvri_id]
     data = get_current_duvri_data()
 
     if tipo_firma == 'appaltatore':
         # Genera il PDF COMPLETO con allegati per la firma
         try:
-            # Prepara nome file
-            nome_ditta = "Ditta"
-            if data.get('appaltatore', {}).get('ragione_sociale'):
-                nome_ditta = data['appaltatore']['ragione_sociale']
-                nome_ditta = "".join(c for c in nome_ditta if c.isalnum() or c in (' ', '-', '_')).rstrip()
-                nome_ditta = nome_ditta.replace(' ', '_')[:30]
-
-            data_oggi = datetime.now().strftime('%Y-%m-%d')
-            filename_base = f"DUVRI_{nome_ditta}_{data_oggi}.pdf"
-            filename_completo = f"DUVRI_{nome_ditta}_{data_oggi}_PER_FIRMA_APPALTATORE.pdf"
-            output_path_base = os.path.join("output", filename_base)
-            output_path_completo = os.path.join("output", filename_completo)
-
-            os.makedirs("output", exist_ok=True)
-
-            # Genera il PDF base con tutti i dati (sezione 2.6.3 inclusa)
-            dati_pdf = prepara_dati_per_pdf(duvri_id, data)
-            html_content = render_template("pdf_template.html", **dati_pdf)
-
-            pdf_base_path = None
-            if XHTML2PDF_AVAILABLE:
-                try:
-                    pdf_bytes = io.BytesIO()
-                    pisa_status = pisa.CreatePDF(html_content, dest=pdf_bytes)
-                    if not pisa_status.err:
-                        with open(output_path_base, 'wb') as f:
-                            f.write(pdf_bytes.getvalue())
-                        pdf_base_path = output_path_base
-                except Exception as e:
-                    print(f"xhtml2pdf fallito: {e}")
-
-            if not pdf_base_path and WEASYPRINT_AVAILABLE:
-                try:
-                    HTML(string=html_content).write_pdf(output_path_base)
-                    pdf_base_path = output_path_base
-                except Exception as e:
-                    print(f"WeasyPrint fallito: {e}")
-
-            if not pdf_base_path:
+            traccia = TracciaPDF('per_firma', duvri_id)
+            with traccia.fase('costi'):
+                input_pdf = input_pdf_duvri(duvri_id, data)
+            if app.config.get('PDF_RIPRODUCIBILE') and etag_artefatto('per_firma', input_pdf[1]) in request.if_none_match:
+                traccia.chiudi('non_modificato')
+                return risposta_con_traccia(risposta_non_modificata(etag_artefatto('per_firma', input_pdf[1])), traccia)
+
+            artefatto = genera_artefatto_duvri(duvri_id, data, 'per_firma', traccia, input_pdf)
+            if not artefatto:
+                traccia.chiudi('nessun_motore')
                 flash("Errore nella generazione del PDF", "danger")
                 return redirect(url_for('summary'))
 
-            # UNISCI CON ALLEGATI per creare il PDF COMPLETO per la firma
-            pdf_finale_path = unisci_pdf_duvri(duvri_id, pdf_base_path, output_path_completo)
-
             flash("✅ PDF per firma generato con tutti gli allegati", "success")
-            return send_file(
-                pdf_finale_path,
-                as_attachment=True,
-                download_name=filename_completo
-            )
+            with traccia.fase('invio'):
+                response = invia_file(
+                    artefatto['path'],
+                    'artefatto',
+                    download_name=nome_download_duvri(data, '_PER_FIRMA_APPALTATORE'),
+                    etag=etag_download(artefatto)
+                )
+            traccia.chiudi()
+            return risposta_con_traccia(response, traccia)
 
         except Exception as e:
             print(f"Errore generazione PDF per firma: {e}")
@@ -3305,7 +7503,7 @@ def download_per_firma(tipo_firma):
 
     elif tipo_firma == 'committente':
         # Secondo firmatario - verifica che l'appaltatore abbia già firmato
-        firme = duvri.get('firme_digitali', {})
+        firme = get_firme_digitali(duvri_id)
         if 'appaltatore' not in firme:
             flash("L'appaltatore deve prima firmare il documento", "warning")
             return redirect(url_for('summary'))
@@ -3320,9 +7518,9 @@ def download_per_firma(tipo_firma):
         data_oggi = datetime.now().strftime('%Y-%m-%d')
 
         # Restituisci il PDF già firmato dall'appaltatore
-        return send_file(
-            firme['appaltatore']['file_path'],
-            as_attachment=True,
+        return invia_file(
+            firme['appaltatore']['path'],
+            'firmato',
             download_name=f"DUVRI_{nome_ditta}_{data_oggi}_firmato_appaltatore.pdf"
         )
 
@@ -3339,18 +7537,14 @@ def download_duvri_completo():
         flash("DUVRI non trovato", "danger")
         return redirect(url_for('summary'))
 
-    duvri = duvri_list[duvri_id]
-
     # Verifica che entrambe le parti abbiano firmato
-    if not duvri.get('firme_digitali') or not all(
-        ruolo in duvri['firme_digitali']
-        for ruolo in ['committente', 'appaltatore']
-    ):
+    firme = get_firme_digitali(duvri_id)
+    if not all(ruolo in firme for ruolo in RUOLI_FIRMA):
         flash("Il documento non è ancora completamente firmato", "warning")
         return redirect(url_for('summary'))
 
     # Restituisci l'ultimo documento caricato (quello con entrambe le firme)
-    ultimo_file = duvri['firme_digitali']['committente']['file_path']
+    ultimo_file = firme['committente']['path']
 
     # Prepara nome file descrittivo con ragione sociale e data
     data = get_current_duvri_data()
@@ -3363,9 +7557,9 @@ def download_duvri_completo():
     
     data_oggi = datetime.now().strftime('%Y-%m-%d')
 
-    return send_file(
+    return invia_file(
         ultimo_file,
-        as_attachment=True,
+        'firmato',
         download_name=f"DUVRI_{nome_ditta}_{data_oggi}_completo_firmato.pdf"
     )
 
@@ -3378,7 +7572,7 @@ def _genera_pdf_base(duvri_id, destinazione):
 
     # Prepara tutti i dati per il PDF (sezione 2.6.3 inclusa)
     dati_pdf = prepara_dati_per_pdf(duvri_id, data)
-    html_content = render_template("pdf_template.html", **dati_pdf)
+    traccia = TracciaPDF(f"base_{destinazione}", duvri_id)
 
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     filename = f"DUVRI_{duvri_id}_{destinazione}_{timestamp}.pdf"
@@ -3387,20 +7581,15 @@ def _genera_pdf_base(duvri_id, destinazione):
     # Assicurati che la cartella output esista
     os.makedirs("output", exist_ok=True)
 
-    if WEASYPRINT_AVAILABLE:
-        HTML(string=html_content).write_pdf(output_path)
-    elif XHTML2PDF_AVAILABLE:
-        with open(output_path, 'wb') as f:
-            pisa.CreatePDF(html_content, dest=f)
-    else:
+    # Per il download dall'area admin WeasyPrint resta il motore preferito, xhtml2pdf il ripiego
+    motore = genera_pdf_duvri(dati_pdf, output_path, traccia, preferenza='weasyprint')
+    traccia.registra(motore=motore)
+    traccia.chiudi('ok' if motore else 'nessun_motore')
+    if not motore:
         flash("Nessun motore PDF disponibile", "danger")
         return redirect(url_for('summary'))
 
-    return send_file(
-        output_path,
-        as_attachment=True,
-        download_name=f"DUVRI_da_firmare.pdf"
-    )
+    return risposta_con_traccia(invia_file(output_path, 'artefatto', download_name="DUVRI_da_firmare.pdf"), traccia)
 
 @app.route("/logout")
 def logout():
@@ -3436,15 +7625,15 @@ def upload_allegato():
 
         if file and allowed_file(file.filename):
             try:
-                # Crea cartella per il DUVRI
-                duvri_folder = os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}")
-                os.makedirs(duvri_folder, exist_ok=True)
-
-                # Salva il file
+                # Salva il file (archiviato per contenuto da registra_allegato)
                 filename = secure_filename(file.filename)
-                filepath = os.path.join(duvri_folder, filename)
+                filepath = percorso_temporaneo_upload()
                 file.save(filepath)
 
+                # Registra hash, pagine e preflight una sola volta
+                registra_allegato(duvri_id, filepath, filename)
+                pianifica_prerender_per_firma(duvri_id)
+
                 flash(f"✅ Allegato '{filename}' caricato con successo!", "success")
                 return redirect(url_for('summary'))
 
@@ -3457,9 +7646,9 @@ def upload_allegato():
 
     return render_template('upload_allegato.html')
 
-@app.route('/elimina_allegato/<int:allegato_index>', methods=['POST'])
-def elimina_allegato(allegato_index):
-    """Elimina un allegato specifico tramite indice"""
+@app.route('/elimina_allegato/<allegato_id>', methods=['POST'])
+def elimina_allegato(allegato_id):
+    """Elimina un allegato specifico tramite ID del registro"""
     duvri_id = session.get('current_duvri_id')
 
     if not duvri_id:
@@ -3467,37 +7656,30 @@ def elimina_allegato(allegato_index):
         return redirect(url_for('summary'))
 
     try:
-        # Ottieni la lista degli allegati
-        allegati_dir = os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}")
-        if not os.path.exists(allegati_dir):
-            flash("❌ Nessun allegato trovato", "danger")
-            return redirect(url_for('summary'))
-
-        # Lista tutti i file nella directory
-        files = [f for f in os.listdir(allegati_dir) if os.path.isfile(os.path.join(allegati_dir, f))]
-        files.sort()  # Ordina per nome
-
-        if allegato_index < 0 or allegato_index >= len(files):
+        allegato = get_allegato(duvri_id, allegato_id)
+        if not allegato:
             flash("❌ Allegato non trovato", "danger")
             return redirect(url_for('summary'))
 
-        filename = files[allegato_index]
-        filepath = os.path.join(allegati_dir, filename)
+        conn = get_db_connection()
+        conn.execute('DELETE FROM allegati WHERE id = ?', (allegato_id,))
+        conn.commit()
+        conn.close()
 
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            flash(f"✅ Allegato '{filename}' eliminato con successo!", "success")
-        else:
-            flash("❌ Allegato non trovato", "danger")
+        # Il blob resta finché altri DUVRI lo referenziano
+        rimuovi_file_caricato(allegato['path'], allegato['sha256'])
+        pianifica_prerender_per_firma(duvri_id)
+
+        flash(f"✅ Allegato '{allegato['nome_originale']}' eliminato con successo!", "success")
 
     except Exception as e:
         flash(f"❌ Errore durante l'eliminazione: {str(e)}", "danger")
 
     return redirect(url_for('summary'))
 
-@app.route('/download_allegato/<int:allegato_index>')
-def download_allegato(allegato_index):
-    """Scarica un allegato specifico tramite indice"""
+@app.route('/download_allegato/<allegato_id>')
+def download_allegato(allegato_id):
+    """Scarica un allegato specifico tramite ID del registro"""
     duvri_id = session.get('current_duvri_id')
 
     if not duvri_id:
@@ -3505,33 +7687,284 @@ def download_allegato(allegato_index):
         return redirect(url_for('summary'))
 
     try:
-        # Ottieni la lista degli allegati
-        allegati_dir = os.path.join(ALLEGATI_FOLDER, f"duvri_{duvri_id}")
-        if not os.path.exists(allegati_dir):
-            flash("❌ Nessun allegato trovato", "danger")
-            return redirect(url_for('summary'))
-
-        # Lista tutti i file nella directory
-        files = [f for f in os.listdir(allegati_dir) if os.path.isfile(os.path.join(allegati_dir, f))]
-        files.sort()  # Ordina per nome
-
-        if allegato_index < 0 or allegato_index >= len(files):
+        allegato = get_allegato(duvri_id, allegato_id)
+        if not allegato:
             flash("❌ Allegato non trovato", "danger")
             return redirect(url_for('summary'))
 
-        filename = files[allegato_index]
-        filepath = os.path.join(allegati_dir, filename)
-
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=filename
+        return invia_file(
+            allegato['path'],
+            'allegato',
+            download_name=allegato['nome_originale'],
+            mimetype=allegato['mime_type'],
+            etag=allegato['sha256']
         )
 
     except Exception as e:
         flash(f"❌ Errore durante il download: {str(e)}", "danger")
         return redirect(url_for('summary'))
 
+# =============================================
+# UPLOAD A BLOCCHI RIPRENDIBILE
+# =============================================
+# Per file grandi o connessioni instabili il client apre una sessione
+# (POST /upload/sessioni), invia il file a blocchi con PUT e l'header
+# Upload-Offset e, se la connessione cade, chiede a che punto è arrivato
+# (GET) e riprende dall'ultimo offset confermato. Ogni blocco è scritto
+# direttamente nel file temporaneo e aggiunto all'hash SHA-256 in corso;
+# all'ultimo blocco il file viene spostato con una rename atomica nella
+# cartella di destinazione e registrato come farebbe l'upload tradizionale.
+UPLOAD_PARZIALI_FOLDER = os.path.join(BASE_DIR, "uploads", "parziali")
+DESTINAZIONI_UPLOAD = ('allegato', 'firmato', 'estar')
+UPLOAD_SCADENZA = timedelta(hours=24)
+_DIMENSIONE_LETTURA_UPLOAD = 64 * 1024
+
+# Hash in corso per sessione: (offset, hashlib) — ricostruito dal file se manca o non è allineato
+_hash_upload = {}
+_hash_upload_lock = threading.Lock()
+
+def _errore_upload(messaggio, status, **extra):
+    """Risposta JSON di errore del protocollo di upload"""
+    return {'errore': messaggio, **extra}, status
+
+def _stato_upload(sessione):
+    """Stato di una sessione di upload per il client"""
+    return {
+        'id': sessione['id'],
+        'destinazione': sessione['destinazione'],
+        'nome': sessione['nome_originale'],
+        'dimensione': sessione['dimensione'],
+        'ricevuti': sessione['ricevuti'],
+        'dimensione_blocco': app.config['UPLOAD_BLOCCO_MB'] * 1024 * 1024
+    }
+
+def get_sessione_upload(upload_id, duvri_id):
+    """Sessione di upload del DUVRI indicato, None se inesistente"""
+    conn = get_db_connection()
+    sessione = conn.execute('SELECT * FROM upload_sessioni WHERE id = ? AND duvri_id = ?',
+                            (upload_id, duvri_id)).fetchone()
+    conn.close()
+    return dict(sessione) if sessione else None
+
+def rimuovi_sessione_upload(sessione):
+    """Elimina una sessione di upload e il suo file temporaneo"""
+    conn = get_db_connection()
+    conn.execute('DELETE FROM upload_sessioni WHERE id = ?', (sessione['id'],))
+    conn.commit()
+    conn.close()
+    with _hash_upload_lock:
+        _hash_upload.pop(sessione['id'], None)
+    if sessione['tmp_path'] and os.path.exists(sessione['tmp_path']):
+        os.remove(sessione['tmp_path'])
+
+def pulisci_upload_scaduti():
+    """Rimuove le sessioni non più aggiornate da oltre UPLOAD_SCADENZA"""
+    limite = datetime.now() - UPLOAD_SCADENZA
+    conn = get_db_connection()
+    scadute = conn.execute('SELECT * FROM upload_sessioni WHERE updated_at < ?', (limite,)).fetchall()
+    conn.close()
+    for sessione in scadute:
+        rimuovi_sessione_upload(dict(sessione))
+    return len(scadute)
+
+def _hash_fino_a(sessione):
+    """Hash dei byte già confermati, dalla cache del processo o rileggendo il file temporaneo"""
+    with _hash_upload_lock:
+        voce = _hash_upload.get(sessione['id'])
+    if voce and voce[0] == sessione['ricevuti']:
+        return voce[1].copy()
+
+    h = hashlib.sha256()
+    da_leggere = sessione['ricevuti']
+    with open(sessione['tmp_path'], 'rb') as f:
+        while da_leggere > 0:
+            blocco = f.read(min(_DIMENSIONE_LETTURA_UPLOAD, da_leggere))
+            if not blocco:
+                break
+            h.update(blocco)
+            da_leggere -= len(blocco)
+    return h
+
+def _completa_upload(sessione, sha256):
+    """
+    Sposta il file completo nella destinazione e lo registra
+
+    Returns:
+        dict: esito per il client (redirect al riepilogo o nome del file salvato)
+    """
+    duvri_id = sessione['duvri_id']
+    parametri = json.loads(sessione['parametri'] or '{}')
+    nome = secure_filename(sessione['nome_originale'])
+
+    if sessione['destinazione'] == 'allegato':
+        registra_allegato(duvri_id, sessione['tmp_path'], nome, sha256=sha256)
+        pianifica_prerender_per_firma(duvri_id)
+        flash(f"✅ Allegato '{nome}' caricato con successo!", "success")
+        return {'redirect': url_for('summary')}
+
+    if sessione['destinazione'] == 'firmato':
+        data_firma = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        registra_firma_digitale(duvri_id, parametri['tipo_firma'], parametri['firmatario'], sessione['tmp_path'], data_firma)
+        return {'redirect': url_for('summary')}
+
+    # DUVRI ESTAR: il nome del file viene salvato insieme al form del committente
+    safe_filename = f"{duvri_id}_{nome}"
+    os.replace(sessione['tmp_path'], os.path.join(app.config['UPLOAD_FOLDER_DUVRI_ESTAR'], safe_filename))
+    print(f"✅ DUVRI ESTAR salvato: {safe_filename}")
+    return {'filename': safe_filename}
+
+@app.route('/upload/sessioni', methods=['POST'])
+def crea_sessione_upload():
+    """Apre una sessione di upload a blocchi per il DUVRI corrente"""
+    duvri_id = session.get('current_duvri_id')
+    if not duvri_id:
+        return _errore_upload("Nessun DUVRI selezionato", 400)
+
+    richiesta = request.get_json(silent=True) or {}
+    destinazione = richiesta.get('destinazione')
+    nome = (richiesta.get('nome') or '').strip()
+    dimensione = richiesta.get('dimensione')
+    parametri = {}
+
+    if destinazione not in DESTINAZIONI_UPLOAD:
+        return _errore_upload("Destinazione non valida", 400)
+    if not nome or not allowed_file(nome) or not secure_filename(nome):
+        return _errore_upload("Tipo file non consentito", 400)
+    if not isinstance(dimensione, int) or dimensione <= 0:
+        return _errore_upload("Dimensione non valida", 400)
+    if dimensione > app.config['UPLOAD_DIMENSIONE_MAX_MB'] * 1024 * 1024:
+        return _errore_upload(f"File oltre il limite di {app.config['UPLOAD_DIMENSIONE_MAX_MB']} MB", 413)
+    if destinazione == 'firmato':
+        parametri = {
+            'tipo_firma': richiesta.get('tipo_firma'),
+            'firmatario': (richiesta.get('firmatario') or '').strip()
+        }
+        if parametri['tipo_firma'] not in ['committente', 'appaltatore'] or not parametri['firmatario']:
+            return _errore_upload("Tipo di firma o firmatario non validi", 400)
+        if not nome.lower().endswith('.pdf'):
+            return _errore_upload("Formato file non valido. Carica solo PDF.", 400)
+
+    pulisci_upload_scaduti()
+    os.makedirs(UPLOAD_PARZIALI_FOLDER, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    tmp_path = os.path.join(UPLOAD_PARZIALI_FOLDER, f"{upload_id}.part")
+    open(tmp_path, 'wb').close()
+
+    ora = datetime.now()
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO upload_sessioni
+        (id, duvri_id, destinazione, nome_originale, dimensione, ricevuti, sha256_atteso, parametri, tmp_path, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)
+    ''', (
+        upload_id,
+        duvri_id,
+        destinazione,
+        nome,
+        dimensione,
+        (richiesta.get('sha256') or '').lower() or None,
+        json.dumps(parametri),
+        tmp_path,
+        ora,
+        ora
+    ))
+    conn.commit()
+    conn.close()
+
+    print(f"📤 Upload a blocchi avviato: {nome} ({dimensione} bytes, {destinazione}) DUVRI {duvri_id}")
+    return _stato_upload(get_sessione_upload(upload_id, duvri_id)), 201
+
+@app.route('/upload/sessioni/<upload_id>', methods=['GET'])
+def stato_sessione_upload(upload_id):
+    """Offset confermato di una sessione, per riprendere un upload interrotto"""
+    sessione = get_sessione_upload(upload_id, session.get('current_duvri_id'))
+    if not sessione:
+        return _errore_upload("Sessione di upload non trovata", 404)
+    return _stato_upload(sessione)
+
+@app.route('/upload/sessioni/<upload_id>', methods=['PUT'])
+def ricevi_blocco_upload(upload_id):
+    """
+    Riceve un blocco a partire dall'offset indicato nell'header Upload-Offset
+
+    Il corpo della richiesta è il contenuto grezzo del blocco: viene letto a
+    pezzi dal flusso, scritto nel file temporaneo e aggiunto all'hash senza
+    mai essere tenuto tutto in memoria.
+    """
+    sessione = get_sessione_upload(upload_id, session.get('current_duvri_id'))
+    if not sessione:
+        return _errore_upload("Sessione di upload non trovata", 404)
+
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset != sessione['ricevuti']:
+        # Il client riparte dall'ultimo offset confermato
+        return _errore_upload("Offset non allineato", 409, ricevuti=sessione['ricevuti'])
+
+    lunghezza = request.content_length
+    if lunghezza is None:
+        return _errore_upload("Content-Length obbligatorio", 411)
+    if lunghezza > app.config['UPLOAD_BLOCCO_MB'] * 1024 * 1024 or offset + lunghezza > sessione['dimensione']:
+        return _errore_upload("Blocco troppo grande", 413)
+
+    h = _hash_fino_a(sessione)
+    scritti = 0
+    with open(sessione['tmp_path'], 'r+b') as f:
+        f.seek(offset)
+        while scritti < lunghezza:
+            pezzo = request.stream.read(min(_DIMENSIONE_LETTURA_UPLOAD, lunghezza - scritti))
+            if not pezzo:
+                break
+            f.write(pezzo)
+            h.update(pezzo)
+            scritti += len(pezzo)
+        f.truncate(offset + scritti)
+    if scritti < lunghezza:
+        # Blocco interrotto: non viene confermato e il client lo rinvia dallo stesso offset
+        return _errore_upload("Blocco incompleto", 400, ricevuti=sessione['ricevuti'])
+
+    ricevuti = offset + scritti
+    conn = get_db_connection()
+    aggiornate = conn.execute(
+        'UPDATE upload_sessioni SET ricevuti = ?, updated_at = ? WHERE id = ? AND ricevuti = ?',
+        (ricevuti, datetime.now(), upload_id, offset)
+    ).rowcount
+    conn.commit()
+    conn.close()
+    if not aggiornate:
+        attuale = get_sessione_upload(upload_id, sessione['duvri_id'])
+        return _errore_upload("Blocco ricevuto in concorrenza", 409, ricevuti=attuale['ricevuti'] if attuale else 0)
+    sessione['ricevuti'] = ricevuti
+
+    if ricevuti < sessione['dimensione']:
+        with _hash_upload_lock:
+            _hash_upload[upload_id] = (ricevuti, h)
+        return _stato_upload(sessione)
+
+    sha256 = h.hexdigest()
+    if sessione['sha256_atteso'] and sessione['sha256_atteso'] != sha256:
+        rimuovi_sessione_upload(sessione)
+        return _errore_upload("Il file ricevuto non corrisponde all'hash dichiarato", 422)
+
+    try:
+        esito = _completa_upload(sessione, sha256)
+    except Exception as e:
+        print(f"❌ Errore completamento upload {upload_id}: {e}")
+        rimuovi_sessione_upload(sessione)
+        return _errore_upload(f"Errore durante il caricamento: {e}", 500)
+
+    rimuovi_sessione_upload(sessione)
+    print(f"✅ Upload a blocchi completato: {sessione['nome_originale']} ({ricevuti} bytes, sha256 {sha256[:12]})")
+    return {**_stato_upload(sessione), 'completato': True, 'sha256': sha256, **esito}
+
+@app.route('/upload/sessioni/<upload_id>', methods=['DELETE'])
+def annulla_sessione_upload(upload_id):
+    """Annulla un upload a blocchi e libera il file temporaneo"""
+    sessione = get_sessione_upload(upload_id, session.get('current_duvri_id'))
+    if not sessione:
+        return _errore_upload("Sessione di upload non trovata", 404)
+    rimuovi_sessione_upload(sessione)
+    return {'annullato': True}
+
 # =============================================
 # ROUTES DI DEBUG
 # =============================================
@@ -3580,7 +8013,7 @@ def recover_duvri():
         return "Nessun DUVRI in sessione"
 
     conn = get_db_connection()
-    duvri_db = conn.execute('SELECT * FROM duvri WHERE id = ?', (duvri_id,)).fetchone()
+    duvri_db = conn.execute('SELECT * FROM duvri_completi WHERE id = ?', (duvri_id,)).fetchone()
     conn.close()
 
     if duvri_db:
@@ -3623,18 +8056,269 @@ def load_environment():
     print("⚠️ Nessun file .env trovato, usando variabili di sistema")
     return False
 
+# =============================================
+# GESTIONE ASSET STATICI PER PDF
+# =============================================
+# I file (logo, immagini) vengono letti e codificati una sola volta per
+# versione del file: la cache è invalidata da mtime/dimensione.
+# Nel rendering PDF l'HTML contiene solo un riferimento "asset:<file>",
+# risolto dal motore tramite link_callback (xhtml2pdf) o url_fetcher (WeasyPrint).
+ASSET_SCHEME = 'asset:'
+
+_asset_cache = {}
+
+def _carica_asset(full_path):
+    """Restituisce la voce di cache (bytes, MIME, data URI) per un file"""
+    impronta = _impronta_file(full_path)
+    voce = _asset_cache.get(full_path)
+    if voce and voce['impronta'] == impronta:
+        return voce
+
+    with open(full_path, 'rb') as f:
+        contenuto = f.read()
+    mime_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    voce = {
+        'impronta': impronta,
+        'bytes': contenuto,
+        'mime_type': mime_type,
+        'base64': base64.b64encode(contenuto).decode('utf-8')
+    }
+    voce['data_uri'] = f"data:{mime_type};base64,{voce['base64']}"
+    _asset_cache[full_path] = voce
+    print(f"🖼️ Asset caricato in cache: {os.path.basename(full_path)} ({len(contenuto)} bytes)")
+    return voce
+
+def get_asset_path(nome_asset):
+    """Percorso assoluto di un asset in static/, senza uscire dalla cartella"""
+    full_path = os.path.normpath(os.path.join(app.static_folder, nome_asset))
+    if not full_path.startswith(os.path.normpath(app.static_folder) + os.sep):
+        return None
+    return full_path if os.path.exists(full_path) else None
+
+def get_asset_data_uri(nome_asset):
+    """Data URI di un asset in static/, calcolato una volta per versione del file"""
+    full_path = get_asset_path(nome_asset)
+    if not full_path:
+        return None
+    return _carica_asset(full_path)['data_uri']
+
+def pdf_link_callback(uri, rel):
+    """link_callback per xhtml2pdf: risolve gli asset sul file locale"""
+    if uri.startswith(ASSET_SCHEME):
+        return get_asset_path(uri[len(ASSET_SCHEME):]) or uri
+    return uri
+
+def pdf_url_fetcher(url, *args, **kwargs):
+    """url_fetcher per WeasyPrint: serve gli asset dalla cache in memoria"""
+    if url.startswith(ASSET_SCHEME):
+        full_path = get_asset_path(url[len(ASSET_SCHEME):])
+        if full_path:
+            voce = _carica_asset(full_path)
+            return {'string': voce['bytes'], 'mime_type': voce['mime_type']}
+    from weasyprint import default_url_fetcher
+    return default_url_fetcher(url, *args, **kwargs)
+
+@app.template_filter('asset_uri')
+@pass_context
+def asset_uri_filter(context, nome_asset):
+    """
+    Riferimento a un asset di static/ da usare nei template
+
+    Nel rendering PDF (default) restituisce "asset:<file>", risolto dal motore;
+    con asset_mode='inline' nel contesto restituisce il data URI in cache.
+    """
+    if context.get('asset_mode') == 'inline':
+        return get_asset_data_uri(nome_asset) or ''
+    return f"{ASSET_SCHEME}{nome_asset}"
+
 @app.template_filter('b64encode')
 def b64encode_filter(filepath):
-    """Legge un file e lo converte in base64"""
+    """Legge un file e lo converte in base64 (in cache per versione del file)"""
     try:
         full_path = os.path.join(app.root_path, filepath)
         if os.path.exists(full_path):
-            with open(full_path, 'rb') as f:
-                return base64.b64encode(f.read()).decode('utf-8')
+            return _carica_asset(full_path)['base64']
     except Exception as e:
         print(f"Errore caricamento file {filepath}: {e}")
     return None
 
+# =============================================
+# FRAMMENTI STATICI DEL TEMPLATE PDF
+# =============================================
+# Le parti fisse (normativa, sommario, misure generali) stanno in templates/pdf/
+# e vengono renderizzate una volta per versione del file.
+_frammenti_cache = {}
+
+@app.template_global('frammento_statico')
+def frammento_statico(nome_template):
+    """Restituisce l'HTML di un frammento statico, in cache per versione del file"""
+    impronta = _impronta_file(os.path.join(app.template_folder, nome_template))
+    voce = _frammenti_cache.get(nome_template)
+    if voce and voce['impronta'] == impronta and app.config.get('CACHE_FRAMMENTI_PDF'):
+        return voce['html']
+
+    html = Markup(app.jinja_env.get_template(nome_template).render())
+    _frammenti_cache[nome_template] = {'impronta': impronta, 'html': html}
+    return html
+
+# =============================================
+# CAPITOLI STATICI IN PDF
+# =============================================
+# I capitoli che occupano pagine intere senza dati del DUVRI (introduzione,
+# misure preliminari e generali di tutela) sono convertiti in PDF una volta
+# per versione dei template e tenuti in cache/capitoli: per ogni DUVRI il
+# motore converte solo le parti dinamiche e il documento è ricomposto unendo
+# le pagine nell'ordine del template.
+CAPITOLI_CACHE_FOLDER = os.path.join(BASE_DIR, "cache", "capitoli")
+_MARCATORE_CAPITOLO = re.compile(r'<!--capitolo:([\w./-]+)-->')
+_CHIUSURA_DOCUMENTO = '\n</body>\n</html>'
+_capitoli_lock = threading.Lock()
+
+@app.template_global('capitolo_statico')
+@pass_context
+def capitolo_statico(context, nome_template):
+    """
+    Capitolo statico su pagine proprie
+
+    Con capitoli_separati nel contesto lascia solo un segnaposto, sostituito
+    da genera_pdf_duvri con le pagine del PDF in cache.
+    """
+    if context.get('capitoli_separati'):
+        return Markup(f"<!--capitolo:{nome_template}-->")
+    return Markup(f'<div class="page-break"></div>\n{frammento_statico(nome_template)}\n<div class="page-break"></div>')
+
+def percorso_capitolo_statico(nome_template, preferenza='xhtml2pdf'):
+    """Percorso in cache del PDF di un capitolo per la versione corrente dei template"""
+    impronta = hashlib.sha256(impronta_template('pdf_template.html').encode('utf-8')).hexdigest()[:16]
+    # I capitoli convertiti con un motore diverso da quello predefinito hanno un file proprio
+    suffisso = '.pdf' if preferenza == 'xhtml2pdf' else f'.{preferenza}.pdf'
+    return os.path.join(CAPITOLI_CACHE_FOLDER, impronta, os.path.basename(nome_template).replace('.html', suffisso))
+
+def pdf_capitolo_statico(nome_template, apertura, preferenza='xhtml2pdf'):
+    """
+    Restituisce il PDF di un capitolo statico, generandolo alla prima richiesta
+
+    Args:
+        apertura: HTML del documento fino a <body> compreso (stile condiviso)
+        preferenza: motore da provare per primo (vedi genera_pdf_da_html)
+
+    Returns:
+        str: percorso del PDF in cache, None se nessun motore PDF ha funzionato
+    """
+    pdf_path = percorso_capitolo_statico(nome_template, preferenza)
+    if os.path.exists(pdf_path):
+        return pdf_path
+    cartella = os.path.dirname(pdf_path)
+    impronta = os.path.basename(cartella)
+
+    with _capitoli_lock:
+        if os.path.exists(pdf_path):
+            return pdf_path
+
+        os.makedirs(cartella, exist_ok=True)
+        tmp_path = pdf_path + '.tmp'
+        motore = genera_pdf_da_html(apertura + str(frammento_statico(nome_template)) + _CHIUSURA_DOCUMENTO, tmp_path,
+                                    preferenza)
+        if not motore:
+            return None
+        os.replace(tmp_path, pdf_path)
+        print(f"📄 Capitolo statico {nome_template} convertito in PDF ({motore})")
+
+        # Rimuove i capitoli delle versioni precedenti dei template
+        for voce in os.listdir(CAPITOLI_CACHE_FOLDER):
+            voce_path = os.path.join(CAPITOLI_CACHE_FOLDER, voce)
+            if os.path.isdir(voce_path) and voce != impronta:
+                shutil.rmtree(voce_path, ignore_errors=True)
+
+    return pdf_path
+
+def dividi_in_capitoli(html_content):
+    """
+    Divide l'HTML renderizzato con capitoli_separati nei segnaposto dei capitoli
+
+    Returns:
+        tuple: (apertura, parti) con parti = [dinamica, capitolo, dinamica, ..., dinamica];
+               apertura è None se il documento non contiene capitoli statici
+    """
+    parti = _MARCATORE_CAPITOLO.split(html_content)
+    corpo = re.search(r'<body[^>]*>', parti[0])
+    if len(parti) == 1 or not corpo:
+        return None, parti
+    return parti[0][:corpo.end()], parti
+
+def html_parte_dinamica(apertura, parti, indice):
+    """Documento HTML completo per la parte dinamica in posizione indice ('' se vuota)"""
+    parte = parti[indice]
+    if indice > 0:
+        if not parte.strip():
+            return ''
+        parte = apertura + parte
+    if indice < len(parti) - 1:
+        parte += _CHIUSURA_DOCUMENTO
+    return parte
+
+def genera_pdf_duvri(dati_pdf, output_path, traccia, debug_nome=None, preferenza='xhtml2pdf'):
+    """
+    Renderizza pdf_template.html e lo converte nel PDF base del DUVRI
+
+    Con PDF_CAPITOLI_STATICI il template è diviso nei segnaposto dei capitoli
+    statici: ogni parte dinamica passa dal motore come documento a sé (con lo
+    stesso stile) e le pagine sono unite a quelle dei capitoli in cache.
+    preferenza indica il motore da provare per primo (vedi genera_pdf_da_html).
+
+    Returns:
+        str: motore usato, None se nessun motore ha funzionato
+    """
+    separati = app.config.get('PDF_CAPITOLI_STATICI')
+    with traccia.fase('template'):
+        html_content = render_template("pdf_template.html", capitoli_separati=separati, **dati_pdf)
+    traccia.registra(html_bytes=len(html_content.encode('utf-8')))
+    if debug_nome:
+        salva_html_debug(html_content, os.path.join(BASE_DIR, "output"), debug_nome)
+
+    apertura, parti = dividi_in_capitoli(html_content)
+    if not apertura:
+        with traccia.fase('motore'):
+            return genera_pdf_da_html(html_content, output_path, preferenza)
+
+    with traccia.fase('capitoli'):
+        capitoli = {nome: pdf_capitolo_statico(nome, apertura, preferenza) for nome in parti[1::2]}
+    if not all(capitoli.values()):
+        with traccia.fase('motore'):
+            return genera_pdf_da_html(render_template("pdf_template.html", **dati_pdf), output_path, preferenza)
+
+    segmenti, temporanei, motore = [], [], None
+    try:
+        with traccia.fase('motore'):
+            for i, parte in enumerate(parti):
+                if i % 2:
+                    segmenti.append(capitoli[parte])
+                    continue
+                html_parte = html_parte_dinamica(apertura, parti, i)
+                if not html_parte:
+                    continue
+                parte_path = percorso_temporaneo_artefatto()
+                temporanei.append(parte_path)
+                motore = genera_pdf_da_html(html_parte, parte_path, preferenza)
+                if not motore:
+                    return None
+                segmenti.append(parte_path)
+
+        with traccia.fase('composizione'):
+            merger = PyPDF2.PdfMerger()
+            for segmento in segmenti:
+                merger.append(segmento)
+            with open(output_path, 'wb') as f:
+                merger.write(f)
+            merger.close()
+    finally:
+        for parte_path in temporanei:
+            if os.path.exists(parte_path):
+                os.remove(parte_path)
+
+    traccia.registra(capitoli_statici=len(capitoli), parti_dinamiche=len(temporanei))
+    return motore
+
 # =============================================
 # ROUTE privacy
 # =============================================
@@ -3649,7 +8333,7 @@ def load_duvri_on_every_request():
     try:
         # Controlla se la memoria è vuota ma il database ha dati
         conn = get_db_connection()
-        db_count = conn.execute('SELECT COUNT(*) as count FROM duvri').fetchone()['count']
+        db_count = conn.execute('SELECT COUNT(*) as count FROM duvri WHERE eliminato_il IS NULL').fetchone()['count']
         conn.close()
 
         if db_count > 0 and len(duvri_list) == 0:
@@ -3684,6 +8368,12 @@ if __name__ == "__main__":
 
     print(f"🚀 Avviato con {len(duvri_list)} DUVRI in memoria")
 
+    # Backup orari e giornalieri in background (BACKUP_AUTOMATICO=1)
+    avvia_backup_automatico()
+
+    # Purga dei DUVRI eliminati e archiviazione dei chiusi in background
+    avvia_manutenzione()
+
     # =============================================
     # AVVIO SERVER
     # =============================================
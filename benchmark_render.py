@@ -0,0 +1,88 @@
+"""
+Benchmark del rendering di pdf_template.html
+Misura il tempo di compilazione (con e senza bytecode cache Jinja) e il
+tempo di render con e senza la cache dei frammenti statici.
+
+Uso:
+    python benchmark_render.py [numero_render]
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from jinja2 import FileSystemBytecodeCache
+
+from app import app, JINJA_CACHE_FOLDER, _frammenti_cache
+
+
+DATI_ESEMPIO = {
+    'committente': {
+        'nome': 'Mario Rossi',
+        'oggetto': 'Installazione apparecchiatura HTA',
+        'importo_gara_base': '150000',
+        'rischi_struttura': ['Presenza di gas medicinali (ossigeno, azoto, ecc.)'],
+    },
+    'appaltatore': {
+        'ragione_sociale': 'Ditta Esempio Srl',
+        'max_addetti': '3',
+        'durata_giorni': '10',
+        'rischi': ['Lavori in quota', 'Uso di attrezzature elettriche portatili o fisse'],
+        'costi_presenti': True,
+        'costo_incontri': 300.0,
+        'costo_dpi': 120.0,
+    },
+    'signatures': {},
+}
+
+
+def _tempo_compilazione(bytecode_cache):
+    """Compila pdf_template.html in un ambiente nuovo e restituisce i millisecondi"""
+    env = app.jinja_env.overlay(cache_size=0, bytecode_cache=bytecode_cache)
+    inizio = time.perf_counter()
+    env.get_template('pdf_template.html')
+    return (time.perf_counter() - inizio) * 1000
+
+
+def _tempo_render(n, cache_frammenti):
+    """Renderizza n volte pdf_template.html e restituisce i millisecondi medi"""
+    app.config['CACHE_FRAMMENTI_PDF'] = cache_frammenti
+    _frammenti_cache.clear()
+    contesto = {
+        'data': DATI_ESEMPIO,
+        'datetime': datetime,
+        'confronto_costi': None,
+        'extra_costo': None,
+    }
+    with app.test_request_context():
+        template = app.jinja_env.get_template('pdf_template.html')
+        template.render(**contesto)  # riscaldamento
+        inizio = time.perf_counter()
+        for _ in range(n):
+            html = template.render(**contesto)
+        return (time.perf_counter() - inizio) * 1000 / n, len(html)
+
+
+def esegui_benchmark(n=200):
+    print("=" * 60)
+    print("BENCHMARK RENDER pdf_template.html")
+    print("=" * 60)
+
+    senza_cache = _tempo_compilazione(None)
+    bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_FOLDER)
+    _tempo_compilazione(bytecode_cache)  # popola la cache su disco
+    con_cache = _tempo_compilazione(bytecode_cache)
+    print(f"⚙️  Compilazione senza bytecode cache: {senza_cache:8.2f} ms")
+    print(f"⚙️  Compilazione con bytecode cache:   {con_cache:8.2f} ms")
+
+    ms_senza, dim_senza = _tempo_render(n, cache_frammenti=False)
+    ms_con, dim_con = _tempo_render(n, cache_frammenti=True)
+    print(f"🎨 Render senza cache frammenti:       {ms_senza:8.3f} ms ({dim_senza} caratteri)")
+    print(f"🎨 Render con cache frammenti:         {ms_con:8.3f} ms ({dim_con} caratteri)")
+    if ms_con > 0:
+        print(f"📊 Speed-up render: x{ms_senza / ms_con:.2f} su {n} render")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    esegui_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
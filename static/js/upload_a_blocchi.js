@@ -0,0 +1,166 @@
+// Upload a blocchi riprendibile (protocollo /upload/sessioni in app.py)
+//
+// I form con data-upload-blocchi inviano il file selezionato nell'input con
+// data-upload-destinazione a blocchi: se la connessione cade il caricamento
+// riprende dall'ultimo offset confermato dal server, anche dopo aver
+// ricaricato la pagina. Senza fetch o Blob.slice il form viene inviato
+// normalmente.
+(function () {
+  'use strict';
+
+  const BASE_URL = '/upload/sessioni';
+  const MAX_TENTATIVI = 8;
+
+  class ErroreUpload extends Error {}
+
+  function attesa(ms) {
+    return new Promise(function (resolve) { setTimeout(resolve, ms); });
+  }
+
+  function chiaveRipresa(destinazione, file) {
+    return ['upload', destinazione, file.name, file.size, file.lastModified].join(':');
+  }
+
+  async function leggiJson(risposta) {
+    try {
+      return await risposta.json();
+    } catch (e) {
+      return {};
+    }
+  }
+
+  async function apriSessione(file, parametri) {
+    const chiave = chiaveRipresa(parametri.destinazione, file);
+    const salvata = localStorage.getItem(chiave);
+    if (salvata) {
+      const risposta = await fetch(BASE_URL + '/' + salvata);
+      if (risposta.ok) {
+        return await risposta.json();
+      }
+      localStorage.removeItem(chiave);
+    }
+
+    const risposta = await fetch(BASE_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(Object.assign({}, parametri, { nome: file.name, dimensione: file.size }))
+    });
+    const stato = await leggiJson(risposta);
+    if (!risposta.ok) {
+      throw new ErroreUpload(stato.errore || 'Impossibile avviare il caricamento');
+    }
+    localStorage.setItem(chiave, stato.id);
+    return stato;
+  }
+
+  async function caricaFile(file, parametri, progresso) {
+    const chiave = chiaveRipresa(parametri.destinazione, file);
+    let stato = await apriSessione(file, parametri);
+    let tentativi = 0;
+    progresso(stato.ricevuti / file.size);
+
+    while (true) {
+      const fine = Math.min(stato.ricevuti + stato.dimensione_blocco, file.size);
+      try {
+        const risposta = await fetch(BASE_URL + '/' + stato.id, {
+          method: 'PUT',
+          headers: { 'Upload-Offset': String(stato.ricevuti), 'Content-Type': 'application/octet-stream' },
+          body: file.slice(stato.ricevuti, fine)
+        });
+        const corpo = await leggiJson(risposta);
+
+        if (risposta.status === 409 || (risposta.status === 400 && 'ricevuti' in corpo)) {
+          // Il server indica l'ultimo offset confermato: si riparte da lì
+          stato.ricevuti = corpo.ricevuti;
+          continue;
+        }
+        if (!risposta.ok) {
+          localStorage.removeItem(chiave);
+          throw new ErroreUpload(corpo.errore || 'Errore durante il caricamento');
+        }
+
+        stato = Object.assign(stato, corpo);
+        tentativi = 0;
+        progresso(stato.ricevuti / file.size);
+        if (corpo.completato) {
+          localStorage.removeItem(chiave);
+          return corpo;
+        }
+      } catch (errore) {
+        if (errore instanceof ErroreUpload || ++tentativi > MAX_TENTATIVI) {
+          throw errore;
+        }
+        // Connessione interrotta: attesa crescente e riallineamento con il server
+        await attesa(Math.min(30000, 1000 * Math.pow(2, tentativi)));
+        try {
+          const risposta = await fetch(BASE_URL + '/' + stato.id);
+          if (risposta.ok) {
+            stato = Object.assign(stato, await risposta.json());
+          }
+        } catch (e) {
+          // ancora offline: si ritenta al giro successivo
+        }
+      }
+    }
+  }
+
+  function barraProgresso(input) {
+    const contenitore = document.createElement('div');
+    contenitore.className = 'progress mt-2';
+    const barra = document.createElement('div');
+    barra.className = 'progress-bar progress-bar-striped progress-bar-animated';
+    barra.setAttribute('role', 'progressbar');
+    contenitore.appendChild(barra);
+    input.insertAdjacentElement('afterend', contenitore);
+    return function (frazione) {
+      const percentuale = Math.floor(frazione * 100);
+      barra.style.width = percentuale + '%';
+      barra.textContent = percentuale + '%';
+    };
+  }
+
+  function collegaForm(form) {
+    const input = form.querySelector('input[type="file"][data-upload-destinazione]');
+    if (!input) {
+      return;
+    }
+
+    form.addEventListener('submit', async function (evento) {
+      const file = input.files && input.files[0];
+      if (!file) {
+        return;
+      }
+      evento.preventDefault();
+
+      const parametri = { destinazione: input.dataset.uploadDestinazione };
+      if (input.dataset.tipoFirma) {
+        parametri.tipo_firma = input.dataset.tipoFirma;
+        parametri.firmatario = (form.elements.firmatario && form.elements.firmatario.value) || '';
+      }
+
+      const pulsanti = form.querySelectorAll('button[type="submit"]');
+      pulsanti.forEach(function (pulsante) { pulsante.disabled = true; });
+      try {
+        const esito = await caricaFile(file, parametri, barraProgresso(input));
+        if (esito.redirect) {
+          window.location.href = esito.redirect;
+          return;
+        }
+        // DUVRI ESTAR: il form prosegue senza file, con il nome già salvato sul server
+        const campo = form.querySelector('input[name="' + input.dataset.uploadCampo + '"]');
+        if (campo) {
+          campo.value = esito.filename;
+        }
+        input.value = '';
+        form.submit();
+      } catch (errore) {
+        alert('❌ ' + errore.message);
+        pulsanti.forEach(function (pulsante) { pulsante.disabled = false; });
+      }
+    });
+  }
+
+  if (window.fetch && window.Blob && Blob.prototype.slice) {
+    document.querySelectorAll('form[data-upload-blocchi]').forEach(collegaForm);
+  }
+})();